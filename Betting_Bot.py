@@ -1,452 +1,83 @@
 # Imports
+import aiohttp
 import discord
 from discord.ext import commands
 
-import configparser
-from datetime import datetime, timedelta
-from pytz import timezone
-
-import pickle
 import os
-
-################################################
-# Setup
-TOKEN = ""
-PREFIX = ""
-TIMEZONE = "Australia/Sydney"
-DAILY = 100
-STARTING_MONEY = 10000
-
-CONFIG = 'config.ini'
-parser = configparser.ConfigParser()
-try:
-    parser.read(CONFIG)
-    TOKEN = str(parser['DISCORD']['token'])
-    PREFIX = str(parser['DISCORD']['prefix'])
-    TIMEZONE = str(parser['DISCORD']['timezone'])
-    DAILY = int(parser['DISCORD']['daily'])
-    STARTING_MONEY = int(parser['DISCORD']['starting_money'])
-except:
-    TOKEN = str(os.environ['token'])
-    PREFIX = str(os.environ['prefix'])
-    TIMEZONE = str(os.environ['timezone'])
-    DAILY = int(os.environ['daily'])
-    STARTING_MONEY = int(os.environ['starting_money'])
-
-################################################
-# Classes
-
-class BettingSystem():
-    def __init__(self):
-        self._users = {}
-        self._curr_events = {}
-        self._past_events = {}
-        self._eventIds = 0
-        self._valid_yes = ["y", "yes", "w", "win", "t", "true"]
-        self._valid_no = ["n", "no", "l", "loss", "lose", "f", "false"]
-        self._invalid_side_message = "result must be one of " + str(self._valid_yes + self._valid_no)
-        self.MAX_BET = 100000
-        self.MIN_BET = 1
-
-    # todo remove
-    def clear(self):
-        self._past_events = {}
-        for key in self._users:
-            user = self._users[key]
-            user._past_bets = []
-        return "Cleared all historical data. PnL and money remains."
-
-    def add_event(self, description, odds = 2.00):
-        event = BetEvent(self.next_event_id(), "\"" + description + "\"", odds)
-        self._curr_events[event._id] = event
-        return "<" + str(event._id) + "> " + event.information() + "\n"
-
-    def resolve_event(self, event_id, result):
-        side = False
-        if any(sstring in result.lower() for sstring in self._valid_yes):
-            side = True
-        elif not(any(sstring in result.lower() for sstring in self._valid_no)):
-            return self._invalid_side_message
-
-        if not (event_id in self._curr_events):
-            return "Invalid eventId, try using <ongoing> to see current events."
-
-        event = self._curr_events.pop(event_id)
-        event.payout(side)
-        self._past_events[event_id] = event
-        return event.information(True)
-
-    def lock_event(self, event_id):
-        if not (event_id in self._curr_events):
-            return "Invalid eventId, try using <ongoing> to see current events."
-        if self._curr_events[event_id].locked():
-            return self._curr_events[event_id]._description + " is already locked."
-        return self._curr_events[event_id].lock()
-    
-    def unlock_event(self, event_id):
-        if not (event_id in self._curr_events):
-            return "Invalid eventId, try using <ongoing> to see current events."
-        if not(self._curr_events[event_id].locked()):
-            return self._curr_events[event_id]._description + " is not locked."
-        return self._curr_events[event_id].unlock()
-
-    def next_event_id(self):
-        self._eventIds += 1
-        return self._eventIds
-
-    def update_max_bet(self, max_bet):
-        if max_bet < self.MIN_BET:
-            return "The maximum bet must be greater than the minimum bet."
-        self.MAX_BET = max_bet
-        return "Maximum bet updated to " + str(max_bet) + "."
-
-    def cancel_bet(self, user_id, event_id):
-        if not (event_id in self._curr_events):
-            return "Invalid eventId, try using <ongoing> to see current events."
-        if not user_id in self._users:
-            return "That user does not have any current bets."
-        user = self._users[user_id]
-        event = self._curr_events[event_id]
-        #remove from event bets list
-        for bet in list(event._bets):
-            if bet.user()._id == user._id:
-                event._bets.remove(bet)
-        # for bet in user._current_bets:
-        #     if bet._underlying._id == event_id:
-                user._current_bets.remove(bet)
-                user._money += bet.amount()
-        return user.name() + "'s bets on " + str(event_id) + " have been deleted."
-    
-    def list_current_events(self):
-        output = ""
-        for key in self._curr_events:
-            event = self._curr_events[key]
-            output += "<" + str(event._id) + "> " + event.information() + "\n"
-        if output == "":
-            output = "No ongoing events."
-        return output
-
-    def list_past_events(self):
-        output = ""
-        for key in self._past_events:
-            event = self._past_events[key]
-            output += "<" + str(event._id) + "> " + event.information() + "\n"
-        if output == "":
-            output = "No past events."
-        return output
-
-    def user_bet(self, event_id, user, result, amount):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        if not person.has_money(amount):
-            return person.name() + " does not have enough money for that bet! You have " + "$" + "{:.2f}".format(person.money()) + "."
-        
-        if amount > self.MAX_BET:
-            return person.name() + " that amount is above the maximum of " + "$" + "{:.2f}".format(self.MAX_BET) + "."
-
-        if amount < self.MIN_BET:
-            return person.name() + " that amount is below the minimum of " + "$" + "{:.2f}".format(self.MIN_BET) + "."
-
-        if not event_id in self._curr_events:
-            return person.name() + " that event could not be found."
-
-        if self._curr_events[event_id].locked():
-            return person.name() + " that event is closed for betting."
-
-        side = True
-        if any(sstring in result.lower() for sstring in self._valid_no): # self._valid_no in result:
-            side = False
-        elif not(any(sstring in result.lower() for sstring in self._valid_yes)) :
-            return self._invalid_side_message
-        event = self._curr_events[event_id]
-        
-        return event.add_bet(person, amount, side)
-
-    def list_user_bets(self, user):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        return person.list_bets()
-
-    def list_user_past_bets(self, user):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        return person.list_past_bets()
-    
-    def list_money_leaderboard(self):
-        output = "LEADERBOARD ($):\n"
-        i = 1
-        users_sorted_by_money = sorted(self._users.items(), key=lambda x: x[1].money_including_ongoing(), reverse=True)
-        for (_id, user) in users_sorted_by_money:
-            output +=  f"{str(i): >{2}}" + ". " + f"{user.name(): <{20}}" + " $" + f"{user.money_including_ongoing(): <20.2f}\n"
-            i += 1
-        return output
-
-    def list_best_pnl(self):
-        output = "LEADERBOARD (PnL):\n"
-        i = 1
-        users_sorted_by_money = sorted(self._users.items(), key=lambda x: x[1].pnl(), reverse=True)
-        for (_id, user) in users_sorted_by_money:
-            neg = " "
-            if user.pnl() < 0:
-                neg = "-"
-            output +=  f"{str(i): >{2}}" + ". " + f"{user.name(): <{20}} " + neg + "$" + f"{abs(user.pnl()): <20.2f}\n"
-            i += 1
-        return output
-
-    def print_money(self, user):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        return person.print_money()
-
-    def daily(self, user):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        return person.daily()
-
-    def rename_user(self, user):
-        if not user.id in self._users:
-            self._users[user.id] = User(user.display_name, user.id)
-
-        person = self._users[user.id]
-        return person.rename(user.display_name)
-
-def custom_format(td):
-    minutes, _seconds = divmod(td.seconds, 60)
-    hours, minutes = divmod(minutes, 60)
-    return '{:d}hr {:02d}m'.format(hours, minutes)
-
-class User():
-    def __init__(self, name, userId):
-        self._id = userId
-        self._name = name
-        self._money = STARTING_MONEY
-        self._current_bets = []
-        self._past_bets = []
-        self._daily = self._today() - timedelta(days=1)
-        self._total_pnl = 0
-
-    def name(self):
-        return self._name
-
-    def rename(self, name):
-        self._name = name
-        return name + " was renamed successfully."
-
-    def pnl(self):
-        return self._total_pnl
-
-    def money(self):
-        return self._money
-
-    def money_including_ongoing(self):
-        return sum([bet._amount for bet in self._current_bets]) + self.money()
-
-    def mention(self):
-        return "<@" + str(self._id) + ">"
-
-    def print_money(self):
-        return self.name() + " has " + "$" + "{:.2f}".format(self.money()) + "."
-
-    def list_bets(self):
-        neg = ""
-        if self._total_pnl < 0:
-            neg = "-"
-        output = self.name() + " has total PnL " + neg + "${:.2f}".format(abs(self._total_pnl)) + ".\n"
-        if len(self._current_bets) > 0:
-            output += "Live bets:\n"
-        else:
-            output += "No current bets.\n"
-        for bet in self._current_bets:
-            output += "\t" + bet.description() + "\n"
-        return output
-    
-    def list_past_bets(self):
-        neg = ""
-        if self._total_pnl < 0:
-            neg = "-"
-        output = self.mention() + " has total PnL " + neg + "${:.2f}".format(abs(self._total_pnl)) + ".\n```Past bets:\n"
-        for bet in self._past_bets:
-            output += "\t" + bet.description() + "\n"
-        return output + "```"
-
-    def archive_bet(self, event_id):
-        i = 0
-        for bet in self._current_bets:
-            if bet._underlying._id == event_id:
-                self._past_bets.append(self._current_bets.pop(i))
-            i += 1
-        return
-
-    def _today(self):
-        dt = datetime.today()
-        return datetime(dt.year, dt.month, dt.day)
-
-    def daily(self):
-        if self._today() - self._daily < timedelta(days=1):
-            return self.name() + " you need to wait " + custom_format(timedelta(days=1) - (datetime.today() - self._daily)) + " more to retrieve your daily reward!"
-        self._money += abs(DAILY)
-        self._daily = self._today()
-        return self.name() + " gained ${:.2f}".format(abs(DAILY))
-
-    def has_money(self, amount):
-        return self._money >= amount
-
-    def win_bet(self, amount, odds):
-        self._money += amount * odds
-        self._total_pnl += amount * (odds-1)
-
-    def lose_bet(self, amount):
-        self._total_pnl -= amount
-
-    def place_bet(self, betEvent, amount, side):
-        assert(self.has_money(amount))
-        bet = Bet(betEvent, self, amount, side)
-        self._money -= amount
-        self._current_bets.append(bet)
-        return bet
-
-class BetEvent():
-    def __init__(self, eventId, description, odds):
-        self._id = eventId
-        self._description = description
-        self._bets = []
-        self._odds = odds #odds for "yes"
-        self._resolved = False
-        self._result = "n/a"
-        self._locked = False
-
-    def add_bet(self, user, amount, side):
-        if user.has_money(amount):
-            self._bets.append(user.place_bet(self, amount, side))
-            return  user.name() + "'s $" + "{:.2f}".format(amount) + " bet placed successfully."
-        else:
-            return "insufficient funds " + user.name() + "!"
-
-    def payout(self, winning_side):
-        self._resolved = True
-        self._locked = True
-        self._result = winning_side
-        for bet in self._bets:
-            bet.resolve(winning_side, self.odds(bet.side()))
-            bet.user().archive_bet(bet._underlying._id)
-    
-    def resolved(self):
-            return self._resolved
-
-    def odds(self, side):
-        if side:
-            return self._odds
-        return self._odds/(self._odds-1)  # x/(x-1) is the other side
-
-    def information(self, mention=False):
-        output = ""
-        if mention:
-            output = "```"
-
-        locked = ""
-        if self.locked() and not(self.resolved()):
-            locked = " (locked)"
-        output += self._description + " @ $" + "{:.2f}".format(self.odds(True)) + locked + "\n"
-        if self.resolved():
-            output += "RESULT: " + str(self._result).upper() + "\n"
-        if mention:
-            output += "```"
-        for bet in self._bets:
-            output += "\t" + bet.short_info(mention) + "\n"
-        return output
-
-    def locked(self):
-        return self._locked
-
-    def lock(self):
-        if self._locked:
-            return "Already locked."
-        else:
-            self._locked = True
-            return "Event " + str(self._id) + " locked. Bets are now closed."
-    
-    def unlock(self):
-        if not(self._locked):
-            return "Already unlocked."
-        if self._resolved:
-            return "Already resolved - can't unlock."
-        else:
-            self._locked = False
-            return "Event " + str(self._id) + " unlocked. Bets are now reopened."
-
-class Bet():
-    def __init__(self, event, user, amount, side):
-        self._underlying = event
-        self._user = user
-        self._amount = amount
-        self._side = side
-        self._resolution = "n/a"
-
-    def description(self):
-        join = " that "
-        if not(self.side()):
-            join = " against "
-        if self._resolution == "n/a":
-            return self.user().name() + " bet " + "$" + "{:.2f}".format(self.amount()) + " @ $" + "{:.2f}".format(self.underlying().odds(self.side())) + join + self.underlying()._description
-        else:
-            return self.user().name() + " " + self._resolution + " " + "$" + "{:.2f}".format(self.winnings()) + " betting" + join + self.underlying()._description
-
-    def short_info(self, mention=False):
-        join = "DOUBTER:  "
-        if self.side():
-            join = "BELIEVER: "
-
-        name = self.user().name()
-        if mention:
-            name = self.user().mention()
-
-        if self._resolution == "n/a":
-            return join + self.user().name() + " bet " + "$" + "{:.2f}".format(self.amount())
-        else:
-            return join + name + " " + self._resolution + " " + "$" + "{:.2f}".format(self.winnings())
-
-    def winnings(self):
-        if self._resolution != "won":
-            return self._amount
-        return self.amount()*(self._underlying.odds(self.side())-1)
-
-    def resolve(self, outcome, odds):
-        if self._resolution != "n/a":
-            raise Exception("oops - double resolve bet")
-
-        if outcome == self.side():
-            self._resolution = "won"
-            self._user.win_bet(self.amount(), odds)
-        else:
-            self._resolution = "lost"
-            self._user.lose_bet(self.amount())
-
-    def side(self):
-        return self._side
-
-    def amount(self):
-        return self._amount
-
-    def user(self):
-        return self._user
-
-    def underlying(self):
-        return self._underlying
+import tempfile
+import time
+
+from settings import TOKEN, PREFIX, SNAPSHOT_FILENAME, LEADERBOARD_SIZE, METRICS_FILENAME, METRICS_INTERVAL, REPLY_WINDOW, BACKUP_FILENAME, STATE_SOCKET, SHARD_COUNT, SHARD_ID, BATCH_SIZE
+# old pickles reference these classes through __main__
+from betting import BettingSystem, User, BetEvent, Bet
+from states import LocalStates, member
+from service import StateClient
+from outbox import Outbox
+from render import chunk, MESSAGE_LIMIT
+from metrics import METRICS, Exporter, process_filename
 
 # wraps the text in ```<text>``` for ascii table output
 def wrap(text):
     return "```" + text + "```"
 
+# sends lines in as few messages as fit under discord's length limit
+async def send_lines(ctx, lines, wrapped=True):
+    limit = MESSAGE_LIMIT
+    if wrapped:
+        limit -= len(wrap(""))
+    for text in chunk(lines, limit):
+        if wrapped:
+            text = wrap(text)
+        await ctx.send(text)
+
+# event ids from arguments like 3 5 7-10, raises ValueError saying what is wrong
+def parse_event_ids(items):
+    ids = []
+    for item in items:
+        (first, dash, last) = item.partition("-")
+        try:
+            (start, end) = (int(first), int(last if dash else first))
+        except ValueError:
+            raise ValueError(item + " isn't an eventId or a range of them, e.g. 3-17.")
+        if end < start:
+            raise ValueError(item + " isn't a range of eventIds, the lower one comes first.")
+        if len(ids) + end - start + 1 > BATCH_SIZE:
+            raise ValueError("At most " + str(BATCH_SIZE) + " events can be changed at once.")
+        ids.extend(range(start, end + 1))
+    return ids
+
+# (eventId, result) pairs from arguments like 21:y 22-24:n
+def parse_results(items):
+    pairs = []
+    for item in items:
+        (event_ids, colon, result) = item.partition(":")
+        if not colon:
+            raise ValueError("Give each event as <eventId>:<result>, e.g. 21:y.")
+        pairs.extend([(event_id, result) for event_id in parse_event_ids([event_ids])])
+        if len(pairs) > BATCH_SIZE:
+            raise ValueError("At most " + str(BATCH_SIZE) + " events can be changed at once.")
+    return pairs
+
+# (description, odds) for each line of an event command, every line after the first starts with its own odds
+def parse_events(odds, description):
+    events = []
+    for line in description.splitlines():
+        if not line.strip():
+            continue
+        if events:
+            (odds, _space, line) = line.strip().partition(" ")
+        try:
+            events.append((line.strip(), float(odds)))
+        except ValueError:
+            raise ValueError("Give each further event on its own line as <odds> <description>, e.g. 1.5 Oslo gets a penta.")
+        if len(events) > BATCH_SIZE:
+            raise ValueError("At most " + str(BATCH_SIZE) + " events can be created at once.")
+    return events
+
+# sends a short confirmation, combined with others sent to the same channel around the same time
+async def confirm(ctx, text):
+    await client.outbox.send(ctx.channel, text)
+
 ################################################
 
 #intents - todo
@@ -455,136 +86,309 @@ def wrap(text):
 # intents.members = True
 #reactions
 
+# records the size of every reply against the command that sent it
+class BettingContext(commands.Context):
+    async def send(self, content=None, **kwargs):
+        if content is not None and self.command is not None:
+            METRICS.size("command." + self.command.qualified_name, len(str(content).encode('utf-8')))
+        return await super().send(content, **kwargs)
+
+class BettingBot(commands.Bot):
+    async def get_context(self, message, *, cls=BettingContext):
+        return await super().get_context(message, cls=cls)
+
+    # commands rejected before they run (e.g. missing role) still count as errors
+    async def on_command_error(self, ctx, exception):
+        if ctx.command is not None and not ctx.command_failed:
+            METRICS.error("command." + ctx.command.qualified_name)
+        await super().on_command_error(ctx, exception)
+
+    # saves any unsaved changes before disconnecting
+    async def close(self):
+        await self.states.close()
+        self.exporter.stop()
+        await super().close()
+
+STARTED = time.perf_counter()
+
 help_command = commands.DefaultHelpCommand(
     no_category = 'Commands'
 )
-client = commands.Bot(case_insensitive=True, command_prefix=commands.when_mentioned_or(PREFIX), description="Simple betting bot to gamble on the outcome of admin created events.", help_command = help_command)#, intents=intents)
-
-#### PICKLE (object persistence)
-PICKLE_FILENAME = 'betting_system.pickle'
-try:
-    with open(PICKLE_FILENAME, 'rb') as handle:
-        client.system = pickle.load(handle)
-    print("Successfully loaded " + PICKLE_FILENAME)
-except:
-    print("Couldn't find pickle file " + PICKLE_FILENAME)
-    client.system = BettingSystem()
+# with several bot processes each one connects as one shard and sees only its share of the guilds
+shards = {"shard_id": SHARD_ID, "shard_count": SHARD_COUNT} if SHARD_COUNT > 1 else {}
+client = BettingBot(case_insensitive=True, command_prefix=commands.when_mentioned_or(PREFIX), description="Simple betting bot to gamble on the outcome of admin created events.", help_command = help_command, **shards)#, intents=intents)
+
+#### PERSISTENCE (per guild: snapshot + journal of every change since, or an sqlite database, see states.py)
+PICKLE_FILENAME = os.path.basename(SNAPSHOT_FILENAME)
+BACKUP_NAME = os.path.basename(BACKUP_FILENAME)
+
+# posts a scheduled lock, if the channel is one this bot can see
+async def announce(channel_id, text):
+    channel = client.get_channel(channel_id)
+    if channel is not None:
+        await channel.send(wrap(text))
+
+# the betting state lives in this process, or in a state service shared by several bot processes
+if STATE_SOCKET:
+    client.states = StateClient(STATE_SOCKET, announce)
+else:
+    client.states = LocalStates(announce)
+client.outbox = Outbox(REPLY_WINDOW, wrap)
+client.exporter = Exporter(METRICS, process_filename(METRICS_FILENAME, "shard" + str(SHARD_ID)) if SHARD_COUNT > 1 else METRICS_FILENAME, METRICS_INTERVAL)
+
+# runs a read-only BettingSystem method for the guild a command was sent in, loading it if need be
+async def query(ctx, name, *args):
+    return await client.states.query(ctx.guild.id, name, *args)
+
+# applies a BettingSystem method as a change to the guild a command was sent in, returns its reply once saved
+async def update(ctx, name, *args):
+    return await client.states.update(ctx.guild.id, name, *args)
+
+# every guild has its own betting state, so commands only work in a guild
+@client.check
+async def guild_only(ctx):
+    if ctx.guild is None:
+        raise commands.NoPrivateMessage()
+    return True
+
+#### METRICS (every command is timed from just before it runs until it returns)
+@client.before_invoke
+async def start_timer(ctx):
+    ctx.started = time.perf_counter()
+
+@client.after_invoke
+async def stop_timer(ctx):
+    name = "command." + ctx.command.qualified_name
+    METRICS.observe(name, time.perf_counter() - ctx.started)
+    if ctx.command_failed:
+        METRICS.error(name)
 
 # Startup Information
 @client.event
 async def on_ready():
     print('Connected to bot: {}'.format(client.user.name))
     print('Bot ID: {}'.format(client.user.id))
+    # on_ready runs again after reconnecting, only the first one is startup
+    if not hasattr(client, 'ready'):
+        client.ready = time.perf_counter()
+        METRICS.observe("startup.ready", client.ready - STARTED)
+    client.states.start()
+    client.exporter.start()
 
 ################################################
 # BETTING
 
-# Create event
-@client.command(aliases=["e"], usage="<odds> <description>", help="Allows a BettingAdmin to create an event for users to bet on.\ne.g. event 2 Oslo gets a penta this game.")
+# Create event, or one per line
+@client.command(aliases=["e"], usage="<odds> <description>", help="Allows a BettingAdmin to create an event for users to bet on. Several can be created at once with one per line, each starting with its odds; either all of them are created or none are.\ne.g. event 2 Oslo gets a penta this game.")
 @commands.has_role("BettingAdmin")
 async def event(ctx, odds, *, description):
-    await ctx.send(wrap(client.system.add_event(description, float(odds))))
+    if not "\n" in description:
+        await ctx.send(wrap(await update(ctx, "add_event", description, float(odds))))
+        return
+    try:
+        events = parse_events(odds, description)
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    output = await update(ctx, "add_events", events)
+    await send_lines(ctx, output.splitlines(keepends=True))
+
+# resolves every (eventId, result) given like 21:y 22-24:n as one change, with one summary line per event
+async def resolve_all(ctx, results):
+    try:
+        pairs = parse_results(results)
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    output = await update(ctx, "resolve_events", pairs)
+    await send_lines(ctx, output.splitlines(keepends=True))
 
 # Resolve event
-@client.command(aliases=["r"], usage="<eventId> <result (yes/no)>", help="Allows a BettingAdmin to resolve an event that users have bet on.\ne.g. resolve 21 y.")
+@client.command(aliases=["r"], usage="<eventId> <result (yes/no)>", help="Allows a BettingAdmin to resolve an event that users have bet on, or several given as <eventId>:<result> like settle.\ne.g. resolve 21 y or resolve 4:y 5:n 6:y.")
 @commands.has_role("BettingAdmin")
-async def resolve(ctx, event_id, result):
-    await ctx.send(client.system.resolve_event(int(event_id), result))
+async def resolve(ctx, *results):
+    if len(results) == 2 and not ":" in results[0]:
+        output = await update(ctx, "resolve_event", int(results[0]), results[1])
+        await send_lines(ctx, output.splitlines(keepends=True), wrapped=False)
+        return
+    await resolve_all(ctx, results)
+
+# Resolve many events at once
+@client.command(aliases=["rs"], usage="<eventId>:<result (yes/no)> ...", help="Allows a BettingAdmin to resolve several events in one go, e.g. at the end of a tournament. Either all of them are resolved or none are, and a range of events can share a result.\ne.g. settle 21:y 22:n 23-25:y.")
+@commands.has_role("BettingAdmin")
+async def settle(ctx, *results):
+    await resolve_all(ctx, results)
 
 # Bet on an event
 @client.command(aliases=["b"], usage="<eventId> <result (yes/no)> <amount>", help="Allows any user to bet on an ongoing event.\ne.g. bet 1 y 100.")
 async def bet(ctx, event_id, result, amount):
-    await ctx.send(wrap(client.system.user_bet(int(event_id), ctx.author, result, float(amount))))
+    await confirm(ctx, await update(ctx, "user_bet", int(event_id), member(ctx.author), result, float(amount)))
+
+# Lock events
+@client.command(aliases=["lo"], usage="<eventId> ...", help="Allows a BettingAdmin to lock current events, given as ids or ranges of them. Either all of them are locked or none are.\ne.g. lock 11 or lock 3-17 20.")
+@commands.has_role("BettingAdmin")
+async def lock(ctx, *event_ids):
+    try:
+        ids = parse_event_ids(event_ids)
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    if len(ids) == 1:
+        await ctx.send(wrap(await update(ctx, "lock_event", ids[0])))
+    else:
+        await ctx.send(wrap(await update(ctx, "lock_events", ids)))
 
-# Lock an event
-@client.command(aliases=["lo"], usage="<eventId>", help="Allows a BettingAdmin to lock a current event.\ne.g. lock 11.")
+# Lock an event later
+@client.command(aliases=["lt"], usage="<eventId> <hours>", help="Allows a BettingAdmin to lock a current event after some hours, bets close at that time.\ne.g. locktime 11 1.5.")
 @commands.has_role("BettingAdmin")
-async def lock(ctx, event_id):
-    await ctx.send(wrap(client.system.lock_event(int(event_id))))
+async def locktime(ctx, event_id, hours):
+    await ctx.send(wrap(await update(ctx, "schedule_lock", int(event_id), float(hours), ctx.channel.id)))
 
-# Unlock an event
-@client.command(aliases=["unlo"], usage="<eventId>", help="Allows a BettingAdmin to unlock a current event.\ne.g. unlock 11.")
+# Unlock events
+@client.command(aliases=["unlo"], usage="<eventId> ...", help="Allows a BettingAdmin to unlock current events, given as ids or ranges of them. Either all of them are unlocked or none are.\ne.g. unlock 11 or unlock 3-17.")
 @commands.has_role("BettingAdmin")
-async def unlock(ctx, event_id):
-    await ctx.send(wrap(client.system.unlock_event(int(event_id))))
+async def unlock(ctx, *event_ids):
+    try:
+        ids = parse_event_ids(event_ids)
+    except ValueError as error:
+        await ctx.send(str(error))
+        return
+    if len(ids) == 1:
+        await ctx.send(wrap(await update(ctx, "unlock_event", ids[0])))
+    else:
+        await ctx.send(wrap(await update(ctx, "unlock_events", ids)))
 
 ################################################
 # See current money
 @client.command(aliases=["m"], usage="", help="Allows any user to see their current money supply.")
 async def money(ctx):
-    await ctx.send(wrap(client.system.print_money(ctx.author)))
+    await confirm(ctx, await query(ctx, "print_money", member(ctx.author)))
 
 # Get daily money reward
 @client.command(aliases=["d"], usage="", help="Retrieve daily login reward.")
 async def daily(ctx):
-    await ctx.send(wrap(client.system.daily(ctx.author)))
+    await confirm(ctx, await update(ctx, "daily", member(ctx.author)))
 
 ################################################
 # System information
 
 # list all ongoing events
-@client.command(aliases=["list", "o", "on", "live"], usage="", help="Allows any user to see all live events and bets.")
-async def ongoing(ctx):
-    await ctx.send(wrap(client.system.list_current_events()))
+@client.command(aliases=["list", "o", "on", "live"], usage="[page]", help="Allows any user to see live events and bets, a page at a time.")
+async def ongoing(ctx, page=1):
+    await send_lines(ctx, await query(ctx, "iter_current_events", int(page)))
 
 # list all past events
-@client.command(aliases=["pastevents", "past", "all"], usage="", help="Allows any user to see all past events and bets.")
-async def allhistory(ctx):
-    await ctx.send(wrap(client.system.list_past_events()))
+@client.command(aliases=["pastevents", "past", "all"], usage="[page]", help="Allows any user to see past events and bets, newest first and a page at a time.")
+async def allhistory(ctx, page=1):
+    await send_lines(ctx, await query(ctx, "iter_past_events", int(page)))
+
+# money on each side of an event
+@client.command(aliases=["po"], usage="<eventId>", help="Allows any user to see how much is bet on each side of an event, by how many users, and the current odds.\ne.g. pool 11.")
+async def pool(ctx, event_id):
+    await ctx.send(wrap(await query(ctx, "event_pool", int(event_id))))
 
 # list a users current bets
 @client.command(aliases=["bs"], usage="", help="Allows any user to see their current bets.")
 async def bets(ctx):
-    await ctx.send(wrap(client.system.list_user_bets(ctx.author)))
+    await send_lines(ctx, [await query(ctx, "user_pnl", member(ctx.author)) + "\n"] + await query(ctx, "iter_user_bets", member(ctx.author)))
 
 # cancel a user's current bets for a particular event
 @client.command(aliases=["can"], usage="<@user> <event_id>", help="Allows a BettingAdmin to cancel someone's bets.")
 @commands.has_role("BettingAdmin")
 async def cancel(ctx, user, event_id):
-    await ctx.send(wrap(client.system.cancel_bet(int(ctx.message.mentions[0].id), int(event_id))))
+    await ctx.send(wrap(await update(ctx, "cancel_bet", int(ctx.message.mentions[0].id), int(event_id))))
 
 # A user's betting history
-@client.command(aliases=["h", "hist"], usage="", help="Allows any user to see their past betting history.")
-async def history(ctx):
-    await ctx.send(client.system.list_user_past_bets(ctx.author))
+@client.command(aliases=["h", "hist"], usage="[page]", help="Allows any user to see their past betting history, newest first and a page at a time.")
+async def history(ctx, page=1):
+    await ctx.send(await query(ctx, "user_pnl", member(ctx.author), True))
+    await send_lines(ctx, await query(ctx, "iter_user_past_bets", member(ctx.author), int(page)))
 
 # Leaderboard ranked by money
-@client.command(aliases=["top", "leader", "l"], usage="", help="Ranks everyone by money.")
-async def leaderboard(ctx):
-    await ctx.send(wrap(client.system.list_money_leaderboard()))
+@client.command(aliases=["top", "leader", "l"], usage="[count]", help="Ranks the top users by money.")
+async def leaderboard(ctx, count=LEADERBOARD_SIZE):
+    await ctx.send(wrap(await query(ctx, "list_money_leaderboard", int(count))))
 
 # Leaderboard ranked by PnL
-@client.command(aliases=["allpnl", "pnl", "p"], usage="", help="Ranks everyone by profit/loss.")
-async def bestpnl(ctx):
-    await ctx.send(wrap(client.system.list_best_pnl()))
-
-# Store all user data (serialized)
-@client.command(aliases=["s", "shutdown"], usage="", help="Save current system state to file.")
+@client.command(aliases=["allpnl", "pnl", "p"], usage="[count]", help="Ranks the top users by profit/loss.")
+async def bestpnl(ctx, count=LEADERBOARD_SIZE):
+    await ctx.send(wrap(await query(ctx, "list_best_pnl", int(count))))
+
+# Leaderboard ranked by a betting statistic
+@client.command(aliases=["sb", "ranking"], usage="<roi|winrate|streak> [count]", help="Ranks the top users by return on investment, share of bets won or longest winning streak.\ne.g. statboard roi 10.")
+async def statboard(ctx, kind, count=LEADERBOARD_SIZE):
+    await ctx.send(wrap(await query(ctx, "list_stat_leaderboard", kind.lower(), int(count))))
+
+# A user's betting statistics
+@client.command(aliases=["st"], usage="[@user]", help="Shows bets won and lost, total staked, ROI, streaks and open exposure for you or the mentioned user.\ne.g. stats @Oslo.")
+async def stats(ctx, user=None):
+    user = ctx.message.mentions[0] if ctx.message.mentions else ctx.author
+    await ctx.send(wrap(await query(ctx, "user_stats", member(user))))
+
+# A user's own leaderboard positions
+@client.command(aliases=["myrank"], usage="", help="Shows your position on the money and PnL leaderboards.")
+async def rank(ctx):
+    await ctx.send(wrap(await query(ctx, "user_rank", member(ctx.author))))
+
+# downloads an attachment a block at a time, so it is never held in memory whole
+async def download(attachment, filename):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            with open(filename, 'wb') as handle:
+                async for block in response.content.iter_chunked(65536):
+                    handle.write(block)
+
+# Store all user data (as a backup file, see backup.py)
+@client.command(aliases=["s", "shutdown"], usage="", help="Save current system state and upload a backup of it.")
 async def save(ctx):
-    with open(PICKLE_FILENAME, 'wb') as handle:
-        pickle.dump(client.system, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    filename = await client.states.save(ctx.guild.id)
     await ctx.send(wrap("Data saved successfully."))
-    with open(PICKLE_FILENAME, 'rb') as handle:
-        await ctx.send(file=discord.File(handle))
+    await ctx.send(file=discord.File(filename, filename=BACKUP_NAME))
 
-# Load user data (serialized)
-@client.command(aliases=["reload"], usage="", help="Load current system state from file. Must be attached with the command and named " + PICKLE_FILENAME + ".")
+# Load user data from a backup, or from a pickle saved by an older version
+@client.command(aliases=["reload"], usage="", help="Load the system state from a backup made by save (" + BACKUP_NAME + "), or import a " + PICKLE_FILENAME + " from an older version. The file must be attached with the command.")
 @commands.has_role("BettingAdmin")
 async def load(ctx):
     if not(ctx.message.attachments):
         await ctx.send(wrap(ctx.author.display_name + " loading requires an attachment."))
         return
     for attachment in ctx.message.attachments:
-        if attachment.filename == PICKLE_FILENAME:
-            file_bytes = await attachment.read()
-            client.system = pickle.loads(file_bytes)
-            await ctx.send(wrap("file loaded successfully."))
-            return      
+        if attachment.filename.endswith(".pickle"):
+            legacy = True
+        elif attachment.filename.endswith(".jsonl") or attachment.filename.endswith(".jsonl.gz"):
+            legacy = False
+        else:
+            continue
+        (handle, filename) = tempfile.mkstemp(suffix=".upload")
+        os.close(handle)
+        try:
+            await download(attachment, filename)
+            await client.states.load(ctx.guild.id, filename, legacy)
+        except ValueError as error:
+            await ctx.send(wrap(attachment.filename + " could not be loaded, " + str(error) + "."))
+            return
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+        await ctx.send(wrap("file loaded successfully."))
+        return
+    await ctx.send(wrap("Attach a backup (" + BACKUP_NAME + ") or a " + PICKLE_FILENAME + " to load."))
 
 @client.command(aliases=["latency"], usage="", help="Show bot latency.")
 async def ping(ctx):
     await ctx.send(wrap(str(round(client.latency*1000,2)) + "ms"))
 
+# Command and betting system timings
+@client.command(aliases=["metrics"], usage="", help="Allows a BettingAdmin to see call counts, errors, latencies and reply sizes of commands and the betting system, across all servers.")
+@commands.has_role("BettingAdmin")
+async def botstats(ctx):
+    lines = METRICS.summary()
+    service = await client.states.metrics()
+    if service:
+        lines = lines + ["\nState service\n"] + service
+    await send_lines(ctx, lines)
+
 # test
 @client.command(usage="", help="When you're mad.")
 async def rage(ctx):
@@ -593,24 +397,26 @@ async def rage(ctx):
 # renaming users
 @client.command(usage="", help="Regenerate a users' name (using their current display name).")
 async def rename(ctx):
-    await ctx.send(wrap(client.system.rename_user(ctx.author)))
+    await ctx.send(wrap(await update(ctx, "rename_user", member(ctx.author))))
 
 # Features
 @client.command(usage="", help="Upcoming features.")
 async def features(ctx):
-    await ctx.send(wrap("Integrate with lolesports and sportsbet apis to automatically generate and resolve events.\nAdd ~locktime command to lock an event after x hours."))
+    await ctx.send(wrap("Integrate with lolesports and sportsbet apis to automatically generate and resolve events."))
 
 
 # Update max bet
 @client.command(aliases=["max"], usage="<eventId>", help="Allows a BettingAdmin to update the maximum betting amount.")
 @commands.has_role("BettingAdmin")
 async def max_bet(ctx, maxbet):
-    await ctx.send(wrap(client.system.update_max_bet(int(maxbet))))
+    await ctx.send(wrap(await update(ctx, "update_max_bet", int(maxbet))))
 
 # Clear history
 @client.command(aliases=["clear_past"], usage="", help="Allows a BettingAdmin to clear past events (lowers save space).")
 @commands.has_role("BettingAdmin")
 async def clear(ctx):
-    await ctx.send(wrap(client.system.clear()))
+    await ctx.send(wrap(await update(ctx, "clear")))
 
-client.run(TOKEN)
+# importing the bot (e.g. benchmarks/bench_bot.py) sets up the client without connecting
+if __name__ == "__main__":
+    client.run(TOKEN)
@@ -0,0 +1,54 @@
+# Imports
+import asyncio
+import time
+import traceback
+
+from metrics import METRICS
+
+################################################
+# Autosave
+#
+# Snapshots the attached store in the background whenever it has unsaved
+# changes and either the interval has passed or enough changes have piled up,
+# and once more on shutdown. Saves never overlap, a save requested while one is
+# running waits for it and then starts its own.
+
+class Autosaver():
+    def __init__(self, store, interval=300, poll=1):
+        self._store = store
+        self._interval = interval
+        self._poll = poll
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._last_save = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    # snapshots now, returns the file holding the state
+    async def save(self):
+        async with self._lock:
+            start = time.perf_counter()
+            filename = await self._store.snapshot_in_background()
+            METRICS.observe("store.snapshot", time.perf_counter() - start)
+            self._last_save = time.monotonic()
+            return filename
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        async with self._lock:
+            if self._store.dirty():
+                self._store.snapshot()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._poll)
+            due = time.monotonic() - self._last_save >= self._interval
+            if self._store.dirty() and (due or self._store.needs_snapshot()):
+                try:
+                    await self.save()
+                except Exception:
+                    traceback.print_exc()
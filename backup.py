@@ -0,0 +1,322 @@
+# Imports
+import asyncio
+import copyreg
+import gzip
+import io
+import json
+import math
+import os
+import pickle
+from datetime import datetime
+from itertools import chain
+import traceback
+
+from betting import BettingSystem, User, BetEvent, Bet, SettledBet, MonthSummary
+
+################################################
+# Backups
+#
+# What save uploads and load accepts: one JSON record per line, starting with
+# a header naming the format and its version and ending with the number of
+# records written, gzipped when the file name ends in .gz. It is written one
+# record at a time and read back one line at a time, and every record is
+# checked before anything is replaced, so a truncated or tampered file is
+# refused rather than half loaded.
+#
+# Pickles from before this format can still be imported, through an unpickler
+# that will only build the betting classes.
+
+FORMAT = "betting_bot"
+VERSION = 2 # 2 added monthly totals and resolution times
+
+NUMBER = (int, float)
+
+# record type -> field -> types its value may have
+RECORDS = {
+    "header": {"format": (str,), "version": (int,)},
+    "system": {"event_ids": (int,), "max_bet": NUMBER},
+    "user": {"id": (int,), "name": (str,), "money": NUMBER, "pnl": NUMBER, "daily": (str,), "won": (int,), "lost": (int,), "staked": NUMBER, "streak": (int,), "best_streak": (int,), "worst_streak": (int,)},
+    "event": {"id": (int,), "description": (str,), "odds": NUMBER, "pool_weight": NUMBER, "locked": (bool,), "resolved": (bool,), "result": (bool, str)},
+    "bet": {"event": (int,), "user": (int,), "amount": NUMBER, "side": (bool,), "resolution": (str,)},
+    "lock_at": {"event": (int,), "at": NUMBER, "channel": (int, type(None))},
+    "summary": {"user": (int,), "month": (str,), "won": (int,), "lost": (int,), "staked": NUMBER, "pnl": NUMBER},
+    "rolled_up": {"month": (str,), "events": (int,)},
+    "end": {"records": (int,)},
+}
+
+# fields older versions didn't write, with what they stand for when missing
+OPTIONAL = {
+    "event": {"resolved_at": (NUMBER + (type(None),), None)},
+}
+
+# the records of a system in the order read_backup expects them. Each user is
+# followed by their monthly totals, past events come before live ones, and each
+# event is followed by its bets.
+def iter_records(system):
+    yield {"type": "header", "format": FORMAT, "version": VERSION}
+    yield {"type": "system", "event_ids": system._eventIds, "max_bet": system.MAX_BET}
+    for (month, events) in system._rolled_up.items():
+        yield {"type": "rolled_up", "month": month, "events": events}
+    for user in system._users.values():
+        yield {"type": "user", "id": user._id, "name": user._name, "money": user._money, "pnl": user._total_pnl, "daily": user._daily.isoformat(),
+               "won": user._won, "lost": user._lost, "staked": user._staked, "streak": user._streak, "best_streak": user._best_streak, "worst_streak": user._worst_streak}
+        for (month, summary) in user._monthly.items():
+            yield {"type": "summary", "user": user._id, "month": month, "won": summary._won, "lost": summary._lost, "staked": summary._staked, "pnl": summary._pnl}
+    for event in chain(system._past_events.values(), system._curr_events.values()):
+        yield {"type": "event", "id": event._id, "description": event._description, "odds": event._odds, "pool_weight": event._pool_weight,
+               "locked": event._locked, "resolved": event._resolved, "result": event._result, "resolved_at": event._resolved_at}
+        for bet in event._bets:
+            yield {"type": "bet", "event": event._id, "user": bet._user._id, "amount": bet._amount, "side": bet._side, "resolution": bet._resolution}
+    for (event_id, (at, channel)) in system.lock_schedule().items():
+        yield {"type": "lock_at", "event": event_id, "at": at, "channel": channel}
+
+# writes a backup of the system, replacing the file only once it is complete
+def write_backup(system, filename):
+    temp_filename = filename + ".tmp"
+    if filename.endswith(".gz"):
+        handle = gzip.open(temp_filename, 'wt', encoding='utf-8')
+    else:
+        handle = open(temp_filename, 'w', encoding='utf-8')
+    with handle:
+        count = 0
+        for record in iter_records(system):
+            handle.write(json.dumps(record, separators=(",", ":")) + "\n")
+            count += 1
+        handle.write(json.dumps({"type": "end", "records": count - 1}, separators=(",", ":")) + "\n")
+    os.replace(temp_filename, filename)
+    return filename
+
+# same as write_backup but without blocking the event loop: a forked child process
+# sees the system exactly as it is now and writes it while this process carries on.
+# reopen is run in the child first, for stores whose connections can't be shared with it
+async def write_backup_in_background(system, filename, reopen=None):
+    if not hasattr(os, 'fork'):
+        return write_backup(system, filename)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if reopen is not None:
+                reopen()
+            write_backup(system, filename)
+            os._exit(0)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+    (_pid, status) = await asyncio.get_event_loop().run_in_executor(None, os.waitpid, pid, 0)
+    if status != 0:
+        raise OSError("backup process failed with status " + str(status))
+    return filename
+
+# builds a system from a backup file, raises ValueError naming the first bad line
+def read_backup(filename):
+    with open(filename, 'rb') as raw:
+        compressed = raw.read(2) == b"\x1f\x8b"
+    if compressed:
+        handle = io.TextIOWrapper(gzip.open(filename, 'rb'), encoding='utf-8')
+    else:
+        handle = open(filename, 'r', encoding='utf-8')
+    with handle:
+        reader = BackupReader()
+        try:
+            for (number, line) in enumerate(handle, 1):
+                reader.read(number, line)
+        except (OSError, EOFError, UnicodeDecodeError) as error:
+            raise ValueError("the backup could not be read: " + str(error))
+        return reader.finish()
+
+class BackupReader():
+    def __init__(self):
+        self._system = BettingSystem()
+        self._records = 0
+        self._event = None # event whose bets are being read
+        self._settled = [] # settled bets of that event, in order
+        self._started = False
+        self._ended = False
+
+    def read(self, number, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError("line " + str(number) + " is not JSON")
+        try:
+            self._check(record)
+            if self._ended:
+                raise ValueError("records after the end")
+            if not self._started:
+                self._header(record)
+                self._started = True
+                return
+            if record["type"] == "header":
+                raise ValueError("a second header")
+            getattr(self, "_read_" + record["type"])(record)
+            self._records += 1
+        except ValueError as error:
+            raise ValueError("line " + str(number) + ": " + str(error))
+
+    # the loaded system, once the whole file has been read
+    def finish(self):
+        if not self._ended:
+            raise ValueError("the backup is incomplete, its end is missing")
+        self._system._rebuild_indexes()
+        return self._system
+
+    def _check(self, record):
+        if not isinstance(record, dict) or not record.get("type") in RECORDS:
+            raise ValueError("unknown record")
+        for (field, types) in RECORDS[record["type"]].items():
+            if not field in record:
+                raise ValueError(record["type"] + " record without " + field)
+            if not self._valid(record[field], types):
+                raise ValueError(record["type"] + " record with a bad " + field)
+        for (field, (types, default)) in OPTIONAL.get(record["type"], {}).items():
+            record.setdefault(field, default)
+            if not self._valid(record[field], types):
+                raise ValueError(record["type"] + " record with a bad " + field)
+
+    # JSON allows NaN and infinities, which would poison every sum they end up in
+    def _valid(self, value, types):
+        return type(value) in types and not (isinstance(value, float) and not math.isfinite(value))
+
+    def _header(self, record):
+        if record["type"] != "header" or record["format"] != FORMAT:
+            raise ValueError("not a betting bot backup")
+        if record["version"] > VERSION:
+            raise ValueError("the backup is from a newer version (" + str(record["version"]) + ") of the bot")
+
+    def _read_system(self, record):
+        self._system._eventIds = record["event_ids"]
+        self._system.MAX_BET = record["max_bet"]
+
+    def _read_user(self, record):
+        if record["id"] in self._system._users:
+            raise ValueError("user " + str(record["id"]) + " appears twice")
+        user = User(record["name"], record["id"])
+        user._money = record["money"]
+        user._total_pnl = record["pnl"]
+        try:
+            user._daily = datetime.fromisoformat(record["daily"])
+        except ValueError:
+            raise ValueError("bad daily date")
+        (user._won, user._lost, user._staked, user._streak, user._best_streak, user._worst_streak) = (record["won"], record["lost"], record["staked"], record["streak"], record["best_streak"], record["worst_streak"])
+        self._system._users[user._id] = user
+
+    def _read_summary(self, record):
+        if not record["user"] in self._system._users:
+            raise ValueError("monthly totals of unknown user " + str(record["user"]))
+        user = self._system._users[record["user"]]
+        if record["month"] in user._monthly:
+            raise ValueError("monthly totals for " + (record["month"] or "earlier months") + " appear twice")
+        if record["won"] < 0 or record["lost"] < 0 or record["staked"] < 0:
+            raise ValueError("monthly totals cannot be negative")
+        user._monthly[record["month"]] = MonthSummary(record["won"], record["lost"], record["staked"], record["pnl"])
+
+    def _read_rolled_up(self, record):
+        if record["month"] in self._system._rolled_up or record["events"] <= 0:
+            raise ValueError("bad or repeated rolled up month " + (record["month"] or "earlier"))
+        self._system._rolled_up[record["month"]] = record["events"]
+
+    def _read_event(self, record):
+        self._close_event()
+        system = self._system
+        if record["id"] in system._curr_events or record["id"] in system._past_events or not 0 < record["id"] <= system._eventIds:
+            raise ValueError("bad or repeated event id " + str(record["id"]))
+        if record["odds"] <= 1:
+            raise ValueError("odds must be above 1")
+        if record["pool_weight"] < 0:
+            raise ValueError("pool weight cannot be negative")
+        if record["resolved"] != isinstance(record["result"], bool) or (not record["resolved"] and record["result"] != "n/a"):
+            raise ValueError("the result does not match whether the event is resolved")
+        if system._curr_events and record["resolved"]:
+            raise ValueError("past events must come before live ones")
+        event = BetEvent(record["id"], record["description"], record["odds"], record["pool_weight"])
+        event._locked = record["locked"] or record["resolved"]
+        event._resolved = record["resolved"]
+        event._resolved_at = record["resolved_at"]
+        event._result = record["result"]
+        if event._resolved:
+            system._past_events[event._id] = event
+        else:
+            system._curr_events[event._id] = event
+        self._event = event
+
+    def _read_bet(self, record):
+        event = self._event
+        if event is None or record["event"] != event._id:
+            raise ValueError("a bet must follow its event")
+        if not record["user"] in self._system._users:
+            raise ValueError("bet by unknown user " + str(record["user"]))
+        if record["amount"] <= 0:
+            raise ValueError("bet amounts must be positive")
+        user = self._system._users[record["user"]]
+        if not event._resolved:
+            if record["resolution"] != "n/a":
+                raise ValueError("a bet on a live event cannot be settled")
+            bet = Bet(event, user, record["amount"], record["side"])
+            event._track_bet(bet)
+            user._track_bet(bet)
+            user._ongoing += bet._amount
+            return
+        if record["resolution"] != ("won" if record["side"] == event._result else "lost"):
+            raise ValueError("the bet's resolution does not match the event's result")
+        self._settled.append(SettledBet(event, user, record["amount"], record["side"], record["resolution"]))
+
+    def _read_lock_at(self, record):
+        self._close_event()
+        if not record["event"] in self._system._curr_events:
+            raise ValueError("lock time for an event that is not live")
+        self._system._lock_times[record["event"]] = (record["at"], record["channel"])
+
+    def _read_end(self, record):
+        self._close_event()
+        if record["records"] != self._records:
+            raise ValueError("the backup should have " + str(record["records"]) + " records but has " + str(self._records))
+        self._ended = True
+
+    # settled bets go into their users' histories grouped by user, the way payout archives them
+    def _close_event(self):
+        event = self._event
+        self._event = None
+        if event is None or not event._resolved:
+            return
+        event._bets = tuple(self._settled)
+        event._bets_by_user = None
+        event._rebuild_pools()
+        by_user = {}
+        for bet in self._settled:
+            by_user.setdefault(bet._user._id, []).append(bet)
+        for bets in by_user.values():
+            bets[0]._user._past_bets.extend(bets)
+        self._settled = []
+
+# classes a pickled BettingSystem may be built from, by module and name. Older
+# pickles were written by the bot script and refer to its __main__.
+PICKLE_CLASSES = {
+    ("betting", "BettingSystem"): BettingSystem,
+    ("betting", "User"): User,
+    ("betting", "BetEvent"): BetEvent,
+    ("betting", "Bet"): Bet,
+    ("betting", "SettledBet"): SettledBet,
+    ("betting", "MonthSummary"): MonthSummary,
+    ("datetime", "datetime"): datetime,
+    ("copyreg", "_reconstructor"): copyreg._reconstructor,
+    ("builtins", "object"): object,
+}
+
+class RestrictedUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == "__main__":
+            module = "betting"
+        if not (module, name) in PICKLE_CLASSES:
+            raise pickle.UnpicklingError(module + "." + name + " is not allowed in a betting system pickle")
+        return PICKLE_CLASSES[(module, name)]
+
+# loads a pickled BettingSystem without running anything else it may contain
+def read_pickle(filename):
+    with open(filename, 'rb') as handle:
+        try:
+            system = RestrictedUnpickler(handle).load()
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError) as error:
+            raise ValueError("the pickle could not be loaded: " + str(error))
+    if not isinstance(system, BettingSystem):
+        raise ValueError("the pickle does not hold a betting system")
+    return system
@@ -0,0 +1,57 @@
+# Regression benchmark for cancelling and settling bets on one huge event.
+#
+#   python benchmarks/bench_bet_indexes.py [bets]
+#
+# Times cancel_bet for every bettor and resolve_event on an event with the
+# given number of bets (default 5000, 5 per user), then repeats at 4x the size.
+# The cost per bet should stay flat, the run fails if it grows more than 3x.
+
+# Imports
+import os
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from betting import BettingSystem
+
+Member = namedtuple('Member', ['id', 'display_name'])
+BETS_PER_USER = 5
+
+def run(bets):
+    users = [Member(i, "user" + str(i)) for i in range(bets // BETS_PER_USER)]
+    system = BettingSystem()
+    system.MAX_BET = 10
+    system.add_event("cancel everything")
+    system.add_event("settle everything")
+    for _ in range(BETS_PER_USER):
+        for user in users:
+            system.user_bet(1, user, "y", 1)
+            system.user_bet(2, user, "y" if user.id % 2 else "n", 1)
+
+    start = time.perf_counter()
+    for user in users:
+        system.cancel_bet(user.id, 1)
+    cancel = time.perf_counter() - start
+
+    start = time.perf_counter()
+    system.resolve_event(2, "y")
+    settle = time.perf_counter() - start
+    return (cancel, settle)
+
+def main():
+    bets = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    small = run(bets)
+    large = run(bets * 4)
+    failed = False
+    for (name, small_time, large_time) in [("cancel", small[0], large[0]), ("settle", small[1], large[1])]:
+        small_per_bet = small_time / bets * 1e6
+        large_per_bet = large_time / (bets * 4) * 1e6
+        print("{: <8}{: >8} bets {:9.2f}ms ({:.2f}us/bet)  {: >8} bets {:9.2f}ms ({:.2f}us/bet)".format(name, bets, small_time * 1000, small_per_bet, bets * 4, large_time * 1000, large_per_bet))
+        if large_per_bet > small_per_bet * 3:
+            print(name + " cost per bet grew " + "{:.1f}".format(large_per_bet / small_per_bet) + "x, expected it to stay flat")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
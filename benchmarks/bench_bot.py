@@ -0,0 +1,278 @@
+# End-to-end load test of the bot's commands against a local fake Discord.
+#
+#   python benchmarks/bench_bot.py [--users N] [--commands N] [--events N] [--concurrency N]
+#                                  [--trace FILE] [--save-trace FILE] [--prefix P] [--seed N]
+#                                  [--json FILE] [--compare FILE]
+#
+# Starts the bot from Betting_Bot.py in a scratch directory, connected to
+# fakediscord.py instead of Discord, and replays a trace of commands through
+# it: a synthetic one (an admin creating and resolving events while users bet,
+# claim dailies and look at listings), or one read from --trace with one JSON
+# object per line, e.g. {"user": 7, "content": "~bet 3 y 10", "admin": false}.
+#
+# Commands before the first one from a non-admin are sent one at a time to set
+# things up. The rest are spread over `concurrency` senders, each with its own
+# channel and always the same users, so every user's commands keep their order.
+# A sender waits for the bot to finish a command before sending its next one.
+#
+# Reports throughput, the latency from each message being sent until its first
+# reply reaches the fake API per command (parsing, dispatch, the betting system,
+# formatting, reply batching and the HTTP round trip), and how late the event
+# loop ran a timer meant to fire every 10ms. The fake server shares the event
+# loop with the bot, like a busy gateway would.
+#
+# Commands that raise are counted per command and exception type, the first
+# traceback of each is printed, and the run exits with status 1 if any did.
+
+# Imports
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from bench_system import summarize, revision
+from fakediscord import FakeDiscord, GUILD_ID
+
+ADMIN = 1
+LAG_INTERVAL = 0.01
+TIMEOUT = 30 # seconds a command may take before it counts as lost
+
+def synthetic_trace(users, commands, events, seed, prefix="~"):
+    rng = random.Random(seed)
+    members = list(range(ADMIN + 1, ADMIN + 1 + users))
+    trace = []
+    next_event = 1
+    open_events = []
+
+    def admin(content):
+        trace.append({"user": ADMIN, "content": prefix + content, "admin": True})
+
+    def add_event():
+        nonlocal next_event
+        admin("event " + rng.choice(["1.5", "2", "3"]) + " synthetic event " + str(next_event))
+        open_events.append(next_event)
+        next_event += 1
+
+    for _ in range(events):
+        add_event()
+    listings = ["money", "daily", "bets", "ongoing", "leaderboard", "bestpnl", "rank", "stats", "history", "allhistory", "statboard roi"]
+    for _ in range(commands):
+        roll = rng.random()
+        user = rng.choice(members)
+        if roll < 0.02 and open_events:
+            admin("resolve " + str(open_events.pop(0)) + " " + rng.choice(["y", "n"]))
+            add_event()
+        elif roll < 0.55:
+            trace.append({"user": user, "content": prefix + "bet " + str(rng.choice(open_events)) + " " + rng.choice(["y", "n"]) + " " + str(rng.randint(1, 50))})
+        elif roll < 0.6:
+            trace.append({"user": user, "content": prefix + "pool " + str(rng.choice(open_events))})
+        else:
+            trace.append({"user": user, "content": prefix + rng.choice(listings)})
+    return trace
+
+def read_trace(filename):
+    with open(filename) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+def write_trace(trace, filename):
+    with open(filename, 'w') as handle:
+        for entry in trace:
+            handle.write(json.dumps(entry) + "\n")
+
+class Replay():
+    def __init__(self, client, prefix, concurrency):
+        self.client = client
+        self.prefix = prefix
+        self.channels = [GUILD_ID + 100 + i for i in range(concurrency)]
+        self.fake = FakeDiscord(self.channels, on_reply=self._reply)
+        self.finished = {} # message id -> future set once the bot is done with it
+        self.replies = {} # channel id -> future set when the next reply arrives
+        self.latencies = {} # command -> seconds until its first reply
+        self.lost = 0 # commands without a reply or that never finished
+        self.errors = {} # command -> exception type -> times it was raised
+        self.lag = []
+        client.add_listener(self._completed, "on_command_completion")
+        client.add_listener(self._failed, "on_command_error")
+
+    async def _completed(self, ctx):
+        self._finish(ctx.message.id)
+
+    # listening to errors stops the bot printing them, so the first of each kind is printed here
+    async def _failed(self, ctx, error):
+        error = getattr(error, "original", error)
+        name = ctx.command.qualified_name if ctx.command is not None else ctx.invoked_with
+        counts = self.errors.setdefault(str(name), {})
+        kind = type(error).__name__
+        if not kind in counts:
+            print("Command " + str(name) + " raised:", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__)
+        counts[kind] = counts.get(kind, 0) + 1
+        self._finish(ctx.message.id)
+
+    def _finish(self, message_id):
+        future = self.finished.pop(message_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _reply(self, channel_id, content, arrived):
+        future = self.replies.get(channel_id)
+        if future is not None and not future.done():
+            future.set_result(arrived)
+
+    # sends one command and waits until the bot is done with it, every reply is posted by then
+    async def command(self, channel_id, entry):
+        loop = asyncio.get_event_loop()
+        message_id = self.fake.new_id()
+        self.finished[message_id] = loop.create_future()
+        self.replies[channel_id] = reply = loop.create_future()
+        name = entry["content"][len(self.prefix):].split(" ", 1)[0]
+        start = time.perf_counter()
+        await self.fake.send(channel_id, entry["user"], entry["content"], entry.get("admin", False), message_id)
+        try:
+            await asyncio.wait_for(self.finished[message_id], TIMEOUT)
+        except asyncio.TimeoutError:
+            self.finished.pop(message_id, None)
+        if not reply.done():
+            self.lost += 1
+            return
+        self.latencies.setdefault(name, []).append(reply.result() - start)
+
+    async def sender(self, channel_id, entries):
+        for entry in entries:
+            await self.command(channel_id, entry)
+
+    async def measure_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lag.append(max(0, time.perf_counter() - start - LAG_INTERVAL))
+
+    # returns the seconds the concurrent part of the trace took
+    async def run(self, trace):
+        setup = 0
+        while setup < len(trace) and trace[setup].get("admin", False):
+            setup += 1
+        for entry in trace[:setup]:
+            await self.command(self.channels[0], entry)
+        queues = [[] for _ in self.channels]
+        for entry in trace[setup:]:
+            queues[entry["user"] % len(queues)].append(entry)
+        lag = asyncio.ensure_future(self.measure_lag())
+        start = time.perf_counter()
+        await asyncio.gather(*[self.sender(channel_id, entries) for (channel_id, entries) in zip(self.channels, queues)])
+        elapsed = time.perf_counter() - start
+        lag.cancel()
+        return elapsed
+
+async def run_bot(args, trace):
+    import discord
+    from discord.ext import commands
+    from Betting_Bot import client
+
+    # settings were already read when bench_system imported the betting system
+    client.command_prefix = commands.when_mentioned_or(args.prefix)
+    replay = Replay(client, args.prefix, args.concurrency)
+    await replay.fake.start()
+    discord.http.Route.BASE = replay.fake.api_url
+    bot = asyncio.ensure_future(client.start("load-test"))
+    ready = asyncio.ensure_future(client.wait_until_ready())
+    await asyncio.wait([bot, ready], return_when=asyncio.FIRST_COMPLETED)
+    if bot.done():
+        ready.cancel()
+        bot.result()
+        raise RuntimeError("the bot stopped before it was ready")
+    elapsed = await replay.run(trace)
+    await client.close()
+    await bot
+    await replay.fake.stop()
+
+    commands = sum([len(samples) for samples in replay.latencies.values()]) + replay.lost
+    return {
+        "elapsed_s": elapsed,
+        "commands_per_sec": commands / elapsed if elapsed > 0 else None,
+        "lost": replay.lost,
+        "errors": replay.errors,
+        "commands": {name: summarize(samples) for (name, samples) in sorted(replay.latencies.items())},
+        "all": summarize([sample for samples in replay.latencies.values() for sample in samples] or [0]),
+        "loop_lag": summarize(replay.lag or [0]),
+    }
+
+def compare(report, filename):
+    with open(filename) as handle:
+        baseline = json.load(handle)
+    print("against " + str(baseline.get("revision")) + ", " + json.dumps(baseline.get("workload")))
+    print("{: <20} {: >7.2f}x".format("commands/sec", report["commands_per_sec"] / baseline["commands_per_sec"]))
+    for (name, result) in list(report["commands"].items()) + [("all", report["all"]), ("loop lag", report["loop_lag"])]:
+        base = baseline["all"] if name == "all" else baseline["loop_lag"] if name == "loop lag" else baseline["commands"].get(name)
+        if base is not None and base["p50_us"] > 0 and base["p99_us"] > 0:
+            print("{: <20} p50 {: >7.2f}x  p99 {: >7.2f}x".format(name, result["p50_us"] / base["p50_us"], result["p99_us"] / base["p99_us"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay commands through the bot against a local fake Discord.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--commands", type=int, default=5000, help="commands in the synthetic trace")
+    parser.add_argument("--events", type=int, default=10, help="events open at any time in the synthetic trace")
+    parser.add_argument("--concurrency", type=int, default=16, help="commands in flight at once")
+    parser.add_argument("--trace", help="replay this trace instead of a synthetic one")
+    parser.add_argument("--save-trace", help="write the trace that is replayed to this file")
+    parser.add_argument("--prefix", default="~", help="command prefix the trace uses")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results as JSON to this file, - for stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.users, args.commands, args.events, args.seed, args.prefix)
+    if args.save_trace:
+        write_trace(trace, args.save_trace)
+    for (name, path) in [("json", args.json), ("compare", args.compare)]:
+        if path and path != "-":
+            setattr(args, name, os.path.abspath(path))
+
+    # the bot reads its settings and keeps its files relative to where it runs
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    directory = tempfile.mkdtemp(prefix="bench_bot")
+    os.chdir(directory)
+    try:
+        results = asyncio.get_event_loop().run_until_complete(run_bot(args, trace))
+    finally:
+        os.chdir("/")
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "workload": {"commands": len(trace), "concurrency": args.concurrency, "trace": args.trace or "synthetic", "users": args.users, "events": args.events, "seed": args.seed},
+    }
+    report.update(results)
+    failed = sum([sum(counts.values()) for counts in report["errors"].values()])
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if failed else 0)
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    print("revision " + str(report["revision"]) + ", python " + report["python"] + ", " + json.dumps(report["workload"]))
+    print("{:.0f} commands/sec over {:.2f}s, {} lost, {} failed".format(report["commands_per_sec"] or 0, report["elapsed_s"], report["lost"], failed))
+    for (name, counts) in sorted(report["errors"].items()):
+        print("{: <20} ".format(name) + ", ".join([kind + " x" + str(count) for (kind, count) in sorted(counts.items())]))
+    print("{: <20}{: >8}{: >10}{: >10}{: >10}".format("command", "count", "p50 ms", "p99 ms", "max ms"))
+    for (name, result) in list(report["commands"].items()) + [("all", report["all"]), ("loop lag", report["loop_lag"])]:
+        print("{: <20}{: >8}{: >10.2f}{: >10.2f}{: >10.2f}".format(name, result["count"], result["p50_us"] / 1000, result["p99_us"] / 1000, result["max_us"] / 1000))
+    if args.compare:
+        compare(report, args.compare)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Cross-check and benchmark for bulk settlement.
+#
+#   python benchmarks/bench_settlement.py [--users N] [--events N] [--bets-per-event N] [--seed N]
+#
+# Builds the same system twice (see workload.py, with fractional amounts and
+# some events on pool odds), resolves every open event one at a time with
+# resolve_event on one copy and all at once with resolve_events on the other,
+# and fails unless every user's money, PnL and history come out identical. The
+# check is repeated without NumPy when it is installed, then both ways are timed.
+
+# Imports
+import argparse
+import sys
+import time
+
+from workload import Workload
+import settlement
+
+def build(args):
+    workload = Workload(users=args.users, events=0, bets_per_event=args.bets_per_event, history=0, seed=args.seed)
+    system = workload.build()
+    for i in range(args.events):
+        system.add_event("synthetic event " + str(i + 1), workload.random.choice([1.5, 2.0, 3.0]), pool_weight=workload.random.choice([0, 0, 500]))
+        for _ in range(args.bets_per_event):
+            system.user_bet(system._eventIds, workload.member(), workload.side(), workload.amount() + workload.random.random())
+    results = [(event_id, workload.side()) for event_id in system._curr_events]
+    return (system, results)
+
+def outcome(system):
+    users = [(user._id, user._money, user._total_pnl, user._ongoing, len(user._current_bets), [bet.description() for bet in user._past_bets], user._won, user._lost, user._staked, user._streak, user._best_streak, user._worst_streak) for user in system._users.values()]
+    events = [(event._id, event._result, event._odds, [bet._resolution for bet in event._bets]) for event in system._past_events.values()]
+    return (users, events)
+
+def one_at_a_time(args):
+    (system, results) = build(args)
+    start = time.perf_counter()
+    for (event_id, result) in results:
+        system.resolve_event(event_id, result)
+    return (time.perf_counter() - start, outcome(system))
+
+def all_at_once(args):
+    (system, results) = build(args)
+    start = time.perf_counter()
+    system.resolve_events(results)
+    return (time.perf_counter() - start, outcome(system))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check resolve_events against resolve_event and time both.")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--events", type=int, default=100)
+    parser.add_argument("--bets-per-event", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    (single_time, expected) = one_at_a_time(args)
+    runs = [("numpy" if settlement.numpy is not None else "python", all_at_once(args))]
+    if settlement.numpy is not None:
+        numpy = settlement.numpy
+        settlement.numpy = None
+        runs.append(("python", all_at_once(args)))
+        settlement.numpy = numpy
+
+    bets = args.events * args.bets_per_event
+    print("{: <24}{: >10.2f}ms ({:.2f}us/bet)".format("resolve_event", single_time * 1000, single_time / bets * 1e6))
+    failed = False
+    for (name, (bulk_time, result)) in runs:
+        same = result == expected
+        print("{: <24}{: >10.2f}ms ({:.2f}us/bet) {}".format("resolve_events " + name, bulk_time * 1000, bulk_time / bets * 1e6, "matches" if same else "DIFFERS"))
+        failed = failed or not same
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
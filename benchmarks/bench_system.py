@@ -0,0 +1,165 @@
+# Benchmark suite for the BettingSystem hot paths on a synthetic workload.
+#
+#   python benchmarks/bench_system.py [--users N] [--events N] [--bets-per-event N]
+#                                     [--history N] [--ops N] [--seed N] [--json FILE]
+#                                     [--compare FILE]
+#
+# Builds a system (see workload.py), then times placing bets, the leaderboards,
+# the bet and history listings, cancelling, resolving and claiming dailies, one
+# call at a time. Listings are timed right after a bet so they see the caches
+# invalidated the way they would be in use. Also reports peak memory while
+# building, and the size and save/load time of the pickled state.
+#
+# --json writes the results as JSON (- for stdout) so runs on different
+# revisions can be compared, --compare prints this run against such a file.
+
+# Imports
+import argparse
+import json
+import os
+import pickle
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from workload import Workload
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples):
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "ops_per_sec": len(ordered) / total if total > 0 else None,
+        "p50_us": percentile(ordered, 0.50) * 1e6,
+        "p90_us": percentile(ordered, 0.90) * 1e6,
+        "p99_us": percentile(ordered, 0.99) * 1e6,
+        "max_us": ordered[-1] * 1e6,
+    }
+
+class Timings():
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, name, call, *args):
+        start = time.perf_counter()
+        call(*args)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def results(self):
+        return {name: summarize(samples) for (name, samples) in self.samples.items()}
+
+def run_ops(workload, system, ops):
+    timings = Timings()
+    open_events = list(system._curr_events)
+    pages = max(1, workload.history // 5)
+
+    for event_id in open_events:
+        for _ in range(workload.bets_per_event):
+            timings.time("user_bet", system.user_bet, event_id, workload.member(), workload.side(), workload.amount())
+
+    # each listing follows a bet so the caches see realistic churn
+    listings = [
+        ("money_leaderboard", lambda member: system.list_money_leaderboard()),
+        ("pnl_leaderboard", lambda member: system.list_best_pnl()),
+        ("user_rank", lambda member: system.user_rank(member)),
+        ("user_bets", lambda member: system.list_user_bets(member)),
+        ("user_past_bets", lambda member: system.list_user_past_bets(member, workload.random.randint(1, 3))),
+        ("current_events", lambda member: system.list_current_events()),
+        ("past_events", lambda member: system.list_past_events(workload.random.randint(1, pages))),
+    ]
+    for (name, listing) in listings:
+        for _ in range(ops):
+            system.user_bet(workload.random.choice(open_events), workload.member(), workload.side(), workload.amount())
+            timings.time(name, listing, workload.member())
+
+    for _ in range(ops):
+        timings.time("cancel_bet", system.cancel_bet, workload.member().id, workload.random.choice(open_events))
+
+    for member in workload.members:
+        timings.time("daily", system.daily, member)
+
+    for event_id in open_events:
+        timings.time("resolve_event", system.resolve_event, event_id, workload.side())
+    return timings.results()
+
+def measure_memory(workload):
+    tracemalloc.start()
+    Workload(workload.users, workload.events, workload.bets_per_event, workload.history, workload.seed).build()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"build_peak_bytes": peak}
+
+def measure_pickle(system):
+    start = time.perf_counter()
+    data = pickle.dumps(system, protocol=pickle.HIGHEST_PROTOCOL)
+    save = time.perf_counter() - start
+    start = time.perf_counter()
+    pickle.loads(data)
+    load = time.perf_counter() - start
+    return {"bytes": len(data), "save_ms": save * 1000, "load_ms": load * 1000}
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, filename):
+    with open(filename) as handle:
+        baseline = json.load(handle)
+    print("against " + str(baseline.get("revision")) + ", " + json.dumps(baseline.get("workload")))
+    for (name, result) in report["ops"].items():
+        if name in baseline["ops"] and baseline["ops"][name]["p50_us"] > 0:
+            print("{: <20} p50 {: >7.2f}x  p99 {: >7.2f}x".format(name, result["p50_us"] / baseline["ops"][name]["p50_us"], result["p99_us"] / baseline["ops"][name]["p99_us"]))
+    print("{: <20} {: >7.2f}x".format("pickle bytes", report["pickle"]["bytes"] / baseline["pickle"]["bytes"]))
+    print("{: <20} {: >7.2f}x".format("peak memory", report["memory"]["build_peak_bytes"] / baseline["memory"]["build_peak_bytes"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BettingSystem on a synthetic workload.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=20, help="open events")
+    parser.add_argument("--bets-per-event", type=int, default=20)
+    parser.add_argument("--history", type=int, default=200, help="resolved events before the run")
+    parser.add_argument("--ops", type=int, default=500, help="calls per listing and cancel benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results as JSON to this file, - for stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    workload = Workload(args.users, args.events, args.bets_per_event, args.history, args.seed)
+    start = time.perf_counter()
+    system = workload.build()
+    build = time.perf_counter() - start
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "workload": workload.config(),
+        "build_ms": build * 1000,
+        "pickle": measure_pickle(system),
+        "ops": run_ops(workload, system, args.ops),
+        "memory": measure_memory(workload),
+    }
+
+    if args.json == "-":
+        print(json.dumps(report, indent=2))
+        return
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    print("revision " + str(report["revision"]) + ", python " + report["python"] + ", " + json.dumps(report["workload"]))
+    print("{: <20}{: >8}{: >12}{: >10}{: >10}{: >10}{: >10}".format("op", "count", "ops/sec", "p50 us", "p90 us", "p99 us", "max us"))
+    for (name, result) in report["ops"].items():
+        print("{: <20}{: >8}{: >12.0f}{: >10.1f}{: >10.1f}{: >10.1f}{: >10.1f}".format(name, result["count"], result["ops_per_sec"] or 0, result["p50_us"], result["p90_us"], result["p99_us"], result["max_us"]))
+    print("build {:.1f}ms, peak memory {:.2f}MB".format(report["build_ms"], report["memory"]["build_peak_bytes"] / 1e6))
+    print("pickle {:.2f}MB, save {:.1f}ms, load {:.1f}ms".format(report["pickle"]["bytes"] / 1e6, report["pickle"]["save_ms"], report["pickle"]["load_ms"]))
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == "__main__":
+    main()
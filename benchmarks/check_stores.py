@@ -0,0 +1,88 @@
+# Cross-check of history kept by each store.
+#
+#   python benchmarks/check_stores.py [--users N] [--events N] [--bets-per-event N] [--keep N] [--seed N]
+#
+# Builds the same system in memory, on a journal and on SQLite (see workload.py),
+# resolves its events out of id order, one at a time and in shuffled batches,
+# then rolls all but the last `keep` past events up into monthly totals. Fails
+# unless every store lists the same past events and settled bets in the same
+# order before and after the roll up, and again once loaded back from disk.
+
+# Imports
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from workload import Workload
+from betting import BettingSystem
+from journal import JournalStore
+from storage import SqliteStore
+
+def open_stores(directory):
+    return {
+        "journal": JournalStore(os.path.join(directory, "betting_system.pickle"), os.path.join(directory, "betting_system.journal")),
+        "sqlite": SqliteStore(os.path.join(directory, "betting_system.db")),
+    }
+
+# the same seed resolves the same events in the same order on every system
+def build(args, system):
+    workload = Workload(users=args.users, events=0, bets_per_event=args.bets_per_event, history=0, seed=args.seed)
+    for _ in range(args.events):
+        workload.place_bets(system, workload.open_event(system))
+    order = list(system._curr_events)
+    workload.random.shuffle(order)
+    while order:
+        batch = order[:workload.random.randint(1, 4)]
+        order = order[len(batch):]
+        if len(batch) == 1:
+            system.resolve_event(batch[0], workload.side())
+        else:
+            system.resolve_events([(event_id, workload.side()) for event_id in batch])
+
+# past events both ways and every user's settled bets as history lists them
+def history(system):
+    bets = {user_id: [bet.description() for bet in reversed(user._past_bets)] for (user_id, user) in system._users.items()}
+    return (list(system._past_events), list(reversed(system._past_events)), bets)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every store keeps history in the same order.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--events", type=int, default=40)
+    parser.add_argument("--bets-per-event", type=int, default=5)
+    parser.add_argument("--keep", type=int, default=10, help="past events kept by the roll up")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="check_stores")
+    try:
+        systems = {"memory": BettingSystem()}
+        stores = open_stores(directory)
+        for (name, store) in stores.items():
+            systems[name] = store.load()
+        for system in systems.values():
+            build(args, system)
+        results = {name: [history(system)] for (name, system) in systems.items()}
+        for (name, system) in systems.items():
+            system.retain_history(keep_events=args.keep, keep_days=0)
+            results[name].append(history(system))
+        for store in stores.values():
+            store.close()
+        for (name, store) in open_stores(directory).items():
+            results[name].append(history(store.load()))
+            store.close()
+        results["memory"].append(results["memory"][-1])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    expected = results["memory"]
+    failed = False
+    for (name, result) in results.items():
+        stages = [stage for (stage, (got, want)) in zip(["resolved", "rolled up", "reloaded"], zip(result, expected)) if got != want]
+        print("{: <10} {}".format(name, "matches" if not stages else "DIFFERS after " + ", ".join(stages)))
+        failed = failed or bool(stages)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# A local stand-in for the Discord gateway and HTTP API, enough for the bot to
+# log in, see one guild with one text channel per simulated user group, and
+# post replies. Messages are pushed to the bot as MESSAGE_CREATE events and
+# every message the bot posts is handed to `on_reply` with the time it arrived.
+#
+# Point discord.py at it by setting discord.http.Route.BASE to `api_url`
+# before the client logs in; the gateway URL is then read from the fake API.
+
+# Imports
+import itertools
+import json
+import time
+
+from aiohttp import web, WSMsgType
+
+GUILD_ID = 1000
+ADMIN_ROLE_ID = 1001
+BOT_ID = 1002
+TIMESTAMP = "2021-01-01T00:00:00+00:00"
+
+def user_data(user_id, bot=False):
+    return {"id": str(user_id), "username": "user" + str(user_id), "discriminator": "0001", "avatar": None, "bot": bot}
+
+# discord.py only decodes bodies whose content type is exactly application/json
+def respond(data):
+    return web.Response(body=json.dumps(data).encode('utf-8'), headers={"Content-Type": "application/json"})
+
+class FakeDiscord():
+    def __init__(self, channels, admin_role="BettingAdmin", on_reply=None):
+        self.channels = channels # ids of the guild's text channels
+        self.admin_role = admin_role
+        self.on_reply = on_reply # called with (channel id, content, time.perf_counter() it arrived)
+        self._ids = itertools.count(10 ** 6)
+        self._sequence = itertools.count(1)
+        self._sockets = []
+        self._runner = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_get("/api/v7/users/@me", self._me)
+        app.router.add_get("/api/v7/gateway", self._gateway)
+        app.router.add_get("/api/v7/gateway/bot", self._gateway)
+        app.router.add_post("/api/v7/channels/{channel_id}/messages", self._create_message)
+        app.router.add_get("/gateway", self._socket)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.api_url = "http://" + host + ":" + str(self.port) + "/api/v7"
+        self.gateway_url = "ws://" + host + ":" + str(self.port) + "/gateway"
+
+    async def stop(self):
+        for socket in list(self._sockets):
+            await socket.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def new_id(self):
+        return next(self._ids)
+
+    # sends a message from a user to a channel, returns its id
+    async def send(self, channel_id, user_id, content, admin=False, message_id=None):
+        if message_id is None:
+            message_id = self.new_id()
+        roles = [str(ADMIN_ROLE_ID)] if admin else []
+        data = {
+            "id": str(message_id), "channel_id": str(channel_id), "guild_id": str(GUILD_ID), "type": 0,
+            "author": user_data(user_id), "member": {"roles": roles, "joined_at": TIMESTAMP, "nick": None, "deaf": False, "mute": False},
+            "content": content, "timestamp": TIMESTAMP, "edited_timestamp": None, "tts": False, "pinned": False,
+            "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+        }
+        await self._dispatch("MESSAGE_CREATE", data)
+        return message_id
+
+    async def _dispatch(self, event, data):
+        payload = json.dumps({"op": 0, "t": event, "s": next(self._sequence), "d": data})
+        for socket in self._sockets:
+            await socket.send_str(payload)
+
+    def _guild(self):
+        channels = [{"id": str(channel_id), "type": 0, "name": "bets-" + str(channel_id), "position": i, "permission_overwrites": [], "guild_id": str(GUILD_ID)} for (i, channel_id) in enumerate(self.channels)]
+        roles = [
+            {"id": str(GUILD_ID), "name": "@everyone", "permissions": "104324673", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False},
+            {"id": str(ADMIN_ROLE_ID), "name": self.admin_role, "permissions": "104324673", "position": 1, "color": 0, "hoist": False, "managed": False, "mentionable": False},
+        ]
+        me = {"user": user_data(BOT_ID, bot=True), "roles": [], "joined_at": TIMESTAMP, "nick": None, "deaf": False, "mute": False}
+        return {"id": str(GUILD_ID), "name": "load test", "owner_id": str(BOT_ID), "region": "local", "unavailable": False,
+                "member_count": 1, "large": False, "roles": roles, "channels": channels, "members": [me], "emojis": [], "features": []}
+
+    async def _me(self, request):
+        return respond(user_data(BOT_ID, bot=True))
+
+    async def _gateway(self, request):
+        return respond({"url": self.gateway_url, "shards": 1})
+
+    async def _create_message(self, request):
+        arrived = time.perf_counter()
+        channel_id = int(request.match_info["channel_id"])
+        content = ""
+        if request.content_type == "application/json":
+            content = (await request.json()).get("content") or ""
+        else:
+            await request.read() # file uploads, only their arrival matters here
+        if self.on_reply is not None:
+            self.on_reply(channel_id, content, arrived)
+        return respond({
+            "id": str(next(self._ids)), "channel_id": str(channel_id), "guild_id": str(GUILD_ID), "type": 0,
+            "author": user_data(BOT_ID, bot=True), "content": content, "timestamp": TIMESTAMP, "edited_timestamp": None,
+            "tts": False, "pinned": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+        })
+
+    # HELLO, then READY and the guild once the bot identifies, heartbeats are acknowledged
+    async def _socket(self, request):
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+        self._sockets.append(socket)
+        try:
+            await socket.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": 41250}}))
+            async for message in socket:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+                if payload["op"] == 1:
+                    await socket.send_str(json.dumps({"op": 11}))
+                elif payload["op"] == 2:
+                    await socket.send_str(json.dumps({"op": 0, "t": "READY", "s": next(self._sequence), "d": {
+                        "v": 6, "user": user_data(BOT_ID, bot=True), "session_id": "load-test",
+                        "guilds": [{"id": str(GUILD_ID), "unavailable": True}], "private_channels": [], "relationships": []}}))
+                    await self._dispatch("GUILD_CREATE", self._guild())
+        finally:
+            self._sockets.remove(socket)
+        return socket
@@ -0,0 +1,60 @@
+# Synthetic workload for benchmarking BettingSystem without Discord.
+#
+# Builds a system with the given number of users, settled history (events that
+# have already been resolved) and open events, with bets spread over random
+# users. The same seed always builds the same system.
+
+# Imports
+import os
+import random
+import sys
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from betting import BettingSystem
+
+# stands in for a discord member, BettingSystem only reads these two fields
+Member = namedtuple('Member', ['id', 'display_name'])
+
+class Workload():
+    def __init__(self, users=200, events=20, bets_per_event=20, history=200, seed=1):
+        self.users = users
+        self.events = events
+        self.bets_per_event = bets_per_event
+        self.history = history
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.members = [Member(i, "user" + str(i)) for i in range(users)]
+
+    def config(self):
+        return {"users": self.users, "events": self.events, "bets_per_event": self.bets_per_event, "history": self.history, "seed": self.seed}
+
+    def member(self):
+        return self.random.choice(self.members)
+
+    def side(self):
+        return self.random.choice(["y", "n"])
+
+    def amount(self):
+        return self.random.randint(1, 20)
+
+    # a system with `history` resolved events followed by `events` open ones
+    def build(self):
+        system = BettingSystem()
+        for member in self.members:
+            system._get_user(member)
+        for _ in range(self.history):
+            event_id = self.open_event(system)
+            self.place_bets(system, event_id)
+            system.resolve_event(event_id, self.side())
+        for _ in range(self.events):
+            self.place_bets(system, self.open_event(system))
+        return system
+
+    def open_event(self, system):
+        system.add_event("synthetic event " + str(system._eventIds + 1), self.random.choice([1.5, 2.0, 3.0]))
+        return system._eventIds
+
+    def place_bets(self, system, event_id):
+        for _ in range(self.bets_per_event):
+            system.user_bet(event_id, self.member(), self.side(), self.amount())
@@ -0,0 +1,1214 @@
+# Imports
+from datetime import datetime, timedelta
+import heapq
+from itertools import chain, islice
+import time
+
+from settings import DAILY, STARTING_MONEY, LEADERBOARD_SIZE, EVENTS_PER_PAGE, BETS_PER_PAGE, RENDER_CACHE_SIZE, POOL_ODDS_WEIGHT, HISTORY_KEEP_EVENTS, HISTORY_KEEP_DAYS
+from leaderboard import RankIndex
+from days import CLOCK, DailyIndex
+from render import page_bounds, page_header, RenderCache
+from metrics import timed
+from settlement import settle
+
+# extra leaderboards: kind -> (title, sort key, how the key is shown), highest first
+STAT_BOARDS = {
+    "roi": ("ROI", lambda user: user.roi(), lambda value: "{:.1f}".format(value * 100) + "%"),
+    "winrate": ("win rate", lambda user: user.win_rate(), lambda value: "{:.1f}".format(value * 100) + "%"),
+    "streak": ("longest winning streak", lambda user: user.best_streak(), lambda value: str(value) + " in a row"),
+}
+
+################################################
+# Classes
+
+class BettingSystem():
+    def __init__(self):
+        self._users = {}
+        self._curr_events = {}
+        self._past_events = {}
+        self._eventIds = 0
+        self._lock_times = {} # event id -> (time it locks at, channel to announce it in)
+        self._rolled_up = {} # month -> number of past events rolled up into monthly totals
+        self._valid_yes = ["y", "yes", "w", "win", "t", "true"]
+        self._valid_no = ["n", "no", "l", "loss", "lose", "f", "false"]
+        self._invalid_side_message = "result must be one of " + str(self._valid_yes + self._valid_no)
+        self.MAX_BET = 100000
+        self.MIN_BET = 1
+        self._journal_seq = 0 # last journal record reflected in this state
+        self._store = None
+        self._rebuild_indexes()
+
+    # the attached store is a live file handle and the indexes and caches are derived, none of them are part of a snapshot
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        state['_money_rank'] = None
+        state['_pnl_rank'] = None
+        state['_stat_ranks'] = None
+        state['_render_cache'] = None
+        state['_dailies'] = None
+        # users and events are written without their bets and every bet list follows
+        # them in one flat ledger, otherwise pickle recurses from user to bet to event
+        # to the next user and runs out of stack once there is enough history
+        # history a store reads from disk on demand is written out in full
+        state['_past_events'] = dict(self._past_events.items())
+        events = list(self._curr_events.values()) + list(state['_past_events'].values())
+        state['_ledger'] = ([(user, list(user._current_bets), list(user._past_bets)) for user in self._users.values()],
+                            [(event, list(event._bets)) for event in events])
+        return state
+
+    def __setstate__(self, state):
+        ledger = state.pop('_ledger', None)
+        self.__dict__.update(state)
+        self._journal_seq = state.get('_journal_seq', 0)
+        self._lock_times = state.get('_lock_times', {})
+        self._rolled_up = state.get('_rolled_up', {})
+        self._store = None
+        if ledger is not None:
+            (users, events) = ledger
+            for (user, current_bets, past_bets) in users:
+                for bet in current_bets:
+                    user._track_bet(bet)
+                user._past_bets = past_bets
+            for (event, bets) in events:
+                if event._resolved:
+                    event._bets = tuple(bets)
+                    event._bets_by_user = None
+                else:
+                    event._bets = {}
+                    event._bets_by_user = {}
+                    event._reset_pools()
+                    for bet in bets:
+                        event._track_bet(bet)
+        # the root is unpickled last, so every user, event and bet is complete by now
+        for user in self._users.values():
+            user._upgrade()
+        for event in list(self._curr_events.values()) + list(self._past_events.values()):
+            event._upgrade()
+        # settled bets from older saves are swapped for their compact form, keeping
+        # each one shared between its event and its user's history
+        settled = {}
+        for event in self._past_events.values():
+            settled.update(event._settle())
+        for user in self._users.values():
+            user._past_bets = [settled.get(bet) or bet.settled() for bet in user._past_bets]
+        self._rebuild_indexes()
+
+    def _rebuild_indexes(self):
+        self._render_cache = RenderCache(RENDER_CACHE_SIZE)
+        self._money_rank = RankIndex()
+        self._pnl_rank = RankIndex()
+        self._stat_ranks = {kind: RankIndex() for kind in STAT_BOARDS}
+        self._dailies = DailyIndex()
+        for user in self._users.values():
+            self._reindex(user)
+
+    # repositions a user on the leaderboards after their money or PnL changed, and
+    # by the day they can next claim their daily reward
+    def _reindex(self, user):
+        self._dailies.update(user._id, user._daily)
+        self._rerank(self._money_rank, "money", user._id, -user.money_including_ongoing())
+        self._rerank(self._pnl_rank, "pnl", user._id, -user.pnl())
+        for (kind, (_title, key, _format)) in STAT_BOARDS.items():
+            self._rerank(self._stat_ranks[kind], kind, user._id, (user.settled_count() == 0, -key(user)))
+
+    # cached leaderboards long enough to show the user's old or new position are re-rendered
+    def _rerank(self, index, kind, user_id, key):
+        if not self._render_cache.has_boards(kind):
+            index.update(user_id, key)
+            return
+        old_rank = None
+        if user_id in index:
+            old_rank = index.rank(user_id)
+        if index.update(user_id, key):
+            new_rank = index.rank(user_id)
+            self._render_cache.drop_boards(kind, new_rank if old_rank is None else min(old_rank, new_rank))
+
+    # appends a change to the attached store, called once the change has been applied
+    @timed("store.record")
+    def _log(self, op, **fields):
+        if self._store is not None:
+            self._store.record(op, fields)
+
+    # re-applies a journal record written by _log
+    def replay(self, record):
+        op = record["op"]
+        if op == "user":
+            self._users[record["user"]] = User(record["name"], record["user"])
+            self._reindex(self._users[record["user"]])
+        elif op == "rename":
+            self._users[record["user"]].rename(record["name"])
+        elif op == "event":
+            self.add_event(record["description"], record["odds"], record.get("pool_weight", 0))
+        elif op == "bet":
+            self._curr_events[record["event"]].add_bet(self._users[record["user"]], record["amount"], record["side"])
+            self._reindex(self._users[record["user"]])
+        elif op == "resolve":
+            event = self._curr_events.pop(record["event"])
+            event.payout(record["side"])
+            event._resolved_at = record.get("at")
+            self._past_events[event._id] = event
+            self._lock_times.pop(event._id, None)
+            for user in event.bettors():
+                self._reindex(user)
+        elif op == "cancel":
+            self.cancel_bet(record["user"], record["event"])
+        elif op == "daily":
+            self._users[record["user"]].claim_daily(datetime.fromisoformat(record["day"]))
+            self._reindex(self._users[record["user"]])
+        elif op == "lock":
+            self._curr_events[record["event"]].lock()
+            self._lock_times.pop(record["event"], None)
+        elif op == "lock_at":
+            self._lock_times[record["event"]] = (record["at"], record["channel"])
+        elif op == "unlock":
+            self._curr_events[record["event"]].unlock()
+        elif op == "max_bet":
+            self.MAX_BET = record["amount"]
+        elif op == "clear":
+            self.clear()
+        elif op == "compact":
+            self._compact(record["events"])
+        else:
+            raise ValueError("unknown journal record " + str(op))
+        self._journal_seq = record["seq"]
+
+    # looks up the betting account for a discord member, creating it on first use
+    def _get_user(self, member):
+        if not member.id in self._users:
+            self._users[member.id] = User(member.display_name, member.id)
+            self._reindex(self._users[member.id])
+            self._log("user", user=member.id, name=member.display_name)
+        return self._users[member.id]
+
+    # todo remove
+    @timed("betting.clear")
+    def clear(self):
+        # cleared in place, a store may back these with its own containers
+        self._past_events.clear()
+        self._rolled_up.clear()
+        for key in self._users:
+            user = self._users[key]
+            user._past_bets.clear()
+            user._monthly.clear()
+        self._render_cache.clear()
+        self._log("clear")
+        return "Cleared all historical data. PnL and money remains."
+
+    @timed("betting.add_event")
+    def add_event(self, description, odds = 2.00, pool_weight = POOL_ODDS_WEIGHT):
+        event = BetEvent(self.next_event_id(), "\"" + description + "\"", odds, pool_weight)
+        self._curr_events[event._id] = event
+        self._log("event", event=event._id, description=description, odds=odds, pool_weight=pool_weight)
+        return "<" + str(event._id) + "> " + event.information() + "\n"
+
+    # creates several events at once, events are (description, odds) pairs.
+    # Nothing is created unless every pair is valid.
+    @timed("betting.add_events")
+    def add_events(self, events):
+        for (description, odds) in events:
+            if not description.strip():
+                return "Every event needs a description."
+            if odds <= 1:
+                return description + ": odds must be greater than 1."
+        if len(events) == 0:
+            return "No events to create."
+        return "".join([self.add_event(description, odds) for (description, odds) in events])
+
+    @timed("betting.resolve_event")
+    def resolve_event(self, event_id, result):
+        side = False
+        if any(sstring in result.lower() for sstring in self._valid_yes):
+            side = True
+        elif not(any(sstring in result.lower() for sstring in self._valid_no)):
+            return self._invalid_side_message
+
+        if not (event_id in self._curr_events):
+            return "Invalid eventId, try using <ongoing> to see current events."
+
+        event = self._curr_events.pop(event_id)
+        event.payout(side)
+        event._resolved_at = time.time()
+        self._past_events[event_id] = event
+        self._lock_times.pop(event_id, None)
+        self._render_cache.drop(("event", event_id))
+        for user in event.bettors():
+            self._reindex(user)
+            self._render_cache.drop(("bets", user._id))
+            self._render_cache.drop(("history", user._id))
+        self._log("resolve", event=event_id, side=side, at=event._resolved_at)
+        self.retain_history()
+        return event.information(True)
+
+    # resolves several events at once through the settlement engine, results are
+    # (eventId, result) pairs. Nothing is resolved unless every pair is valid.
+    @timed("betting.resolve_events")
+    def resolve_events(self, results):
+        sides = []
+        for (event_id, result) in results:
+            if any(sstring in result.lower() for sstring in self._valid_yes):
+                sides.append((event_id, True))
+            elif any(sstring in result.lower() for sstring in self._valid_no):
+                sides.append((event_id, False))
+            else:
+                return str(event_id) + ": " + self._invalid_side_message
+            if not (event_id in self._curr_events):
+                return str(event_id) + ": Invalid eventId, try using <ongoing> to see current events."
+        if len(set([event_id for (event_id, side) in sides])) != len(sides):
+            return "Each event can only be resolved once."
+        if len(sides) == 0:
+            return "No events to resolve."
+
+        events = [(self._curr_events.pop(event_id), side) for (event_id, side) in sides]
+        users = settle(events)
+        at = time.time()
+        for (event, side) in events:
+            event._resolved_at = at
+            self._past_events[event._id] = event
+            self._lock_times.pop(event._id, None)
+            self._render_cache.drop(("event", event._id))
+            self._log("resolve", event=event._id, side=side, at=at)
+        for user in users:
+            self._reindex(user)
+            self._render_cache.drop(("bets", user._id))
+            self._render_cache.drop(("history", user._id))
+        output = "".join([event.settlement_summary() for (event, side) in events])
+        self.retain_history()
+        return output
+
+    # rolls the oldest past events into per-user monthly totals once there are more
+    # than keep_events of them or they were resolved more than keep_days ago, 0
+    # turns either limit off. Money, PnL and results are kept on each user, so
+    # leaderboards and stats don't change, only the details of each bet go.
+    # Returns how many events were rolled up.
+    @timed("betting.retain_history")
+    def retain_history(self, keep_events=HISTORY_KEEP_EVENTS, keep_days=HISTORY_KEEP_DAYS, now=None):
+        if keep_events <= 0 and keep_days <= 0:
+            return 0
+        event_ids = list(self._past_events)
+        count = 0
+        if keep_events > 0:
+            count = max(0, len(event_ids) - keep_events)
+        if keep_days > 0:
+            cutoff = (time.time() if now is None else now) - keep_days * 86400
+            # events resolved before resolution times were kept count as old
+            while count < len(event_ids):
+                resolved_at = self._past_events[event_ids[count]]._resolved_at
+                if resolved_at is not None and resolved_at >= cutoff:
+                    break
+                count += 1
+        if count > 0:
+            self._compact(event_ids[:count])
+            self._log("compact", events=event_ids[:count])
+        return count
+
+    # replaces the oldest past events and the bets on them with monthly totals
+    def _compact(self, event_ids):
+        bettors = {} # user id -> number of their bets rolled up
+        for event_id in event_ids:
+            event = self._past_events[event_id]
+            month = event.month()
+            self._rolled_up[month] = self._rolled_up.get(month, 0) + 1
+            for bet in event._bets:
+                bet._user.roll_up(month, bet)
+                bettors[bet._user._id] = bettors.get(bet._user._id, 0) + 1
+            self._render_cache.drop(("event", event_id))
+        if isinstance(self._past_events, dict):
+            # histories are in the order events were resolved, so each user's oldest bets are the ones to go
+            for event_id in event_ids:
+                del self._past_events[event_id]
+            for (user_id, count) in bettors.items():
+                del self._users[user_id]._past_bets[:count]
+        else:
+            # history kept by a store drops the events and every bet on them itself
+            self._past_events.compact(event_ids)
+        for user_id in bettors:
+            self._render_cache.drop(("history", user_id))
+
+    @timed("betting.lock_event")
+    def lock_event(self, event_id):
+        if not (event_id in self._curr_events):
+            return "Invalid eventId, try using <ongoing> to see current events."
+        if self._curr_events[event_id].locked():
+            return self._curr_events[event_id]._description + " is already locked."
+        output = self._curr_events[event_id].lock()
+        self._lock_times.pop(event_id, None)
+        self._render_cache.drop(("event", event_id))
+        self._log("lock", event=event_id)
+        return output
+
+    # locks several events at once, nothing is locked unless every one of them can be
+    @timed("betting.lock_events")
+    def lock_events(self, event_ids):
+        for event_id in event_ids:
+            if not (event_id in self._curr_events):
+                return str(event_id) + ": Invalid eventId, try using <ongoing> to see current events."
+            if self._curr_events[event_id].locked():
+                return str(event_id) + ": " + self._curr_events[event_id]._description + " is already locked."
+        if len(set(event_ids)) != len(event_ids):
+            return "Each event can only be locked once."
+        if len(event_ids) == 0:
+            return "No events to lock."
+        for event_id in event_ids:
+            self._curr_events[event_id].lock()
+            self._lock_times.pop(event_id, None)
+            self._render_cache.drop(("event", event_id))
+            self._log("lock", event=event_id)
+        return "Events " + ", ".join([str(event_id) for event_id in event_ids]) + " locked. Bets are now closed."
+
+    @timed("betting.schedule_lock")
+    def schedule_lock(self, event_id, hours, channel_id=None):
+        if not (event_id in self._curr_events):
+            return "Invalid eventId, try using <ongoing> to see current events."
+        if self._curr_events[event_id].locked():
+            return self._curr_events[event_id]._description + " is already locked."
+        if hours <= 0:
+            return "The lock time must be in the future."
+        at = time.time() + hours * 3600
+        self._lock_times[event_id] = (at, channel_id)
+        self._log("lock_at", event=event_id, at=at, channel=channel_id)
+        return "Event " + str(event_id) + " will lock in " + custom_format(timedelta(hours=hours)) + "."
+
+    # (time it locks at, channel id) of an event's scheduled lock, or None
+    def scheduled_lock(self, event_id):
+        return self._lock_times.get(event_id)
+
+    def lock_schedule(self):
+        return dict(self._lock_times)
+
+    # locks an event whose scheduled time has passed, returns the lock's reply to
+    # announce, or None if it isn't due
+    def lock_if_due(self, event_id):
+        scheduled = self._lock_times.get(event_id)
+        if scheduled is None or scheduled[0] > time.time():
+            return None
+        return self.lock_event(event_id)
+    
+    @timed("betting.unlock_event")
+    def unlock_event(self, event_id):
+        if not (event_id in self._curr_events):
+            return "Invalid eventId, try using <ongoing> to see current events."
+        if not(self._curr_events[event_id].locked()):
+            return self._curr_events[event_id]._description + " is not locked."
+        output = self._curr_events[event_id].unlock()
+        self._render_cache.drop(("event", event_id))
+        self._log("unlock", event=event_id)
+        return output
+
+    # unlocks several events at once, nothing is unlocked unless every one of them can be
+    @timed("betting.unlock_events")
+    def unlock_events(self, event_ids):
+        for event_id in event_ids:
+            if not (event_id in self._curr_events):
+                return str(event_id) + ": Invalid eventId, try using <ongoing> to see current events."
+            if not(self._curr_events[event_id].locked()):
+                return str(event_id) + ": " + self._curr_events[event_id]._description + " is not locked."
+        if len(set(event_ids)) != len(event_ids):
+            return "Each event can only be unlocked once."
+        if len(event_ids) == 0:
+            return "No events to unlock."
+        for event_id in event_ids:
+            self._curr_events[event_id].unlock()
+            self._render_cache.drop(("event", event_id))
+            self._log("unlock", event=event_id)
+        return "Events " + ", ".join([str(event_id) for event_id in event_ids]) + " unlocked. Bets are now reopened."
+
+    def next_event_id(self):
+        self._eventIds += 1
+        return self._eventIds
+
+    @timed("betting.update_max_bet")
+    def update_max_bet(self, max_bet):
+        if max_bet < self.MIN_BET:
+            return "The maximum bet must be greater than the minimum bet."
+        self.MAX_BET = max_bet
+        self._log("max_bet", amount=max_bet)
+        return "Maximum bet updated to " + str(max_bet) + "."
+
+    @timed("betting.cancel_bet")
+    def cancel_bet(self, user_id, event_id):
+        if not (event_id in self._curr_events):
+            return "Invalid eventId, try using <ongoing> to see current events."
+        if not user_id in self._users:
+            return "That user does not have any current bets."
+        user = self._users[user_id]
+        event = self._curr_events[event_id]
+        event.remove_bets(user_id)
+        user.refund_bets(event_id)
+        self._reindex(user)
+        self._render_cache.drop(("event", event_id))
+        self._render_cache.drop(("bets", user_id))
+        self._drop_pool_odds(event)
+        self._log("cancel", event=event_id, user=user_id)
+        return user.name() + "'s bets on " + str(event_id) + " have been deleted."
+    
+    # bets on an event with pool odds show odds that just moved
+    def _drop_pool_odds(self, event):
+        if event._pool_weight > 0:
+            for user in event.bettors():
+                self._render_cache.drop(("bets", user._id))
+
+    @timed("betting.event_pool")
+    def event_pool(self, event_id):
+        if event_id in self._curr_events:
+            return self._curr_events[event_id].pool_information()
+        if event_id in self._past_events:
+            return self._past_events[event_id].pool_information()
+        return "Invalid eventId, try using <ongoing> to see current events."
+
+    def list_current_events(self, page=1):
+        return "".join(self.iter_current_events(page))
+
+    def list_past_events(self, page=1):
+        return "".join(self.iter_past_events(page))
+
+    # ongoing events oldest first, only the events on the page are rendered
+    @timed("betting.iter_current_events")
+    def iter_current_events(self, page=1):
+        (start, end, pages) = page_bounds(len(self._curr_events), page, EVENTS_PER_PAGE)
+        if len(self._curr_events) == 0:
+            yield "No ongoing events."
+        elif start >= end:
+            yield "There are only " + str(pages) + " pages of ongoing events."
+        else:
+            yield page_header(page, pages)
+            for event in islice(self._curr_events.values(), start, end):
+                yield from self._event_lines(event._id, event)
+
+    # past events newest first, only the events on the page are read and rendered
+    @timed("betting.iter_past_events")
+    def iter_past_events(self, page=1):
+        total = len(self._past_events)
+        (start, end, pages) = page_bounds(total, page, EVENTS_PER_PAGE)
+        if total == 0:
+            yield "No past events."
+        elif start >= end:
+            yield "There are only " + str(pages) + " pages of past events."
+            return
+        else:
+            yield page_header(page, pages)
+            for event_id in islice(reversed(self._past_events), start, end):
+                yield from self._event_lines(event_id)
+        if self._rolled_up and end >= total:
+            yield ("\n" if total == 0 else "") + str(sum(self._rolled_up.values())) + " older events are rolled up into monthly totals, see <history>.\n"
+
+    # cached lines of an event, a past event is only loaded if it has to be rendered
+    def _event_lines(self, event_id, event=None):
+        lines = self._render_cache.get(("event", event_id))
+        if lines is None:
+            if event is None:
+                event = self._past_events[event_id]
+            lines = self._render_cache.put(("event", event_id), tuple(self._iter_event(event)), [user._id for user in event.bettors()])
+        return lines
+
+    def _iter_event(self, event):
+        lines = event.iter_information()
+        yield "<" + str(event._id) + "> " + next(lines)
+        yield from lines
+        yield "\n"
+
+    @timed("betting.user_bet")
+    def user_bet(self, event_id, user, result, amount):
+        person = self._get_user(user)
+        if not person.has_money(amount):
+            return person.name() + " does not have enough money for that bet! You have " + "$" + "{:.2f}".format(person.money()) + "."
+        
+        if amount > self.MAX_BET:
+            return person.name() + " that amount is above the maximum of " + "$" + "{:.2f}".format(self.MAX_BET) + "."
+
+        if amount < self.MIN_BET:
+            return person.name() + " that amount is below the minimum of " + "$" + "{:.2f}".format(self.MIN_BET) + "."
+
+        if not event_id in self._curr_events:
+            return person.name() + " that event could not be found."
+
+        # a scheduled lock applies from its deadline even if the scheduler hasn't run yet,
+        # the lock itself is left to lock_if_due so that whoever calls it can announce it
+        scheduled = self._lock_times.get(event_id)
+        if self._curr_events[event_id].locked() or (scheduled is not None and scheduled[0] <= time.time()):
+            return person.name() + " that event is closed for betting."
+
+        side = True
+        if any(sstring in result.lower() for sstring in self._valid_no): # self._valid_no in result:
+            side = False
+        elif not(any(sstring in result.lower() for sstring in self._valid_yes)) :
+            return self._invalid_side_message
+        event = self._curr_events[event_id]
+        
+        output = event.add_bet(person, amount, side)
+        self._reindex(person)
+        self._render_cache.drop(("event", event_id))
+        self._render_cache.drop(("bets", person._id))
+        self._drop_pool_odds(event)
+        self._log("bet", event=event_id, user=person._id, side=side, amount=amount)
+        return output
+
+    def list_user_bets(self, user):
+        person = self._get_user(user)
+        return person.list_bets()
+
+    def list_user_past_bets(self, user, page=1):
+        person = self._get_user(user)
+        return person.list_past_bets(page)
+
+    @timed("betting.user_pnl")
+    def user_pnl(self, user, mention=False):
+        person = self._get_user(user)
+        if mention:
+            return person.pnl_summary(person.mention())
+        return person.pnl_summary(person.name())
+
+    @timed("betting.iter_user_bets")
+    def iter_user_bets(self, user):
+        person = self._get_user(user)
+        lines = self._render_cache.get(("bets", person._id))
+        if lines is None:
+            lines = self._render_cache.put(("bets", person._id), tuple(person.iter_bets()), [person._id])
+        return lines
+
+    @timed("betting.iter_user_past_bets")
+    def iter_user_past_bets(self, user, page=1):
+        person = self._get_user(user)
+        pages = self._render_cache.get(("history", person._id))
+        if pages is None:
+            pages = self._render_cache.put(("history", person._id), {}, [person._id])
+        if page in pages:
+            return pages[page]
+        lines = tuple(person.iter_past_bets(page))
+        # only pages that exist are kept, so asking for any other number can't grow the cache
+        if 1 <= page <= person.past_bet_pages():
+            pages[page] = lines
+        return lines
+    
+    @timed("betting.list_money_leaderboard")
+    def list_money_leaderboard(self, count=LEADERBOARD_SIZE):
+        output = self._render_cache.board("money", count)
+        if output is not None:
+            return output
+        output = "LEADERBOARD ($):\n"
+        i = 1
+        for user_id in self._money_rank.top(count):
+            user = self._users[user_id]
+            output +=  f"{str(i): >{2}}" + ". " + f"{user.name(): <{20}}" + " $" + f"{user.money_including_ongoing(): <20.2f}\n"
+            i += 1
+        return self._render_cache.put_board("money", count, output)
+
+    @timed("betting.list_best_pnl")
+    def list_best_pnl(self, count=LEADERBOARD_SIZE):
+        output = self._render_cache.board("pnl", count)
+        if output is not None:
+            return output
+        output = "LEADERBOARD (PnL):\n"
+        i = 1
+        for user_id in self._pnl_rank.top(count):
+            user = self._users[user_id]
+            neg = " "
+            if user.pnl() < 0:
+                neg = "-"
+            output +=  f"{str(i): >{2}}" + ". " + f"{user.name(): <{20}} " + neg + "$" + f"{abs(user.pnl()): <20.2f}\n"
+            i += 1
+        return self._render_cache.put_board("pnl", count, output)
+
+    # leaderboard by one of the STAT_BOARDS keys, users without settled bets rank last and are left out
+    @timed("betting.list_stat_leaderboard")
+    def list_stat_leaderboard(self, kind, count=LEADERBOARD_SIZE):
+        if not kind in STAT_BOARDS:
+            return "Leaderboards can be sorted by " + ", ".join(STAT_BOARDS) + "."
+        output = self._render_cache.board(kind, count)
+        if output is not None:
+            return output
+        (title, key, format) = STAT_BOARDS[kind]
+        output = "LEADERBOARD (" + title + "):\n"
+        i = 1
+        for user_id in self._stat_ranks[kind].top(count):
+            user = self._users[user_id]
+            if user.settled_count() == 0:
+                break
+            output +=  f"{str(i): >{2}}" + ". " + f"{user.name(): <{20}} " + format(key(user)) + "\n"
+            i += 1
+        return self._render_cache.put_board(kind, count, output)
+
+    @timed("betting.user_stats")
+    def user_stats(self, user):
+        return self._get_user(user).stats()
+
+    @timed("betting.print_money")
+    def print_money(self, user):
+        person = self._get_user(user)
+        return person.print_money()
+
+    @timed("betting.user_rank")
+    def user_rank(self, user):
+        person = self._get_user(user)
+        total = str(len(self._users))
+        return person.name() + " is ranked " + str(self._money_rank.rank(person._id)) + "/" + total + " by money and " + str(self._pnl_rank.rank(person._id)) + "/" + total + " by PnL."
+
+    @timed("betting.daily")
+    def daily(self, user):
+        person = self._get_user(user)
+        claimed = person._daily
+        output = person.daily()
+        if person._daily != claimed:
+            self._reindex(person)
+            self._log("daily", user=person._id, day=person._daily.isoformat())
+        return output
+
+    # gives the daily reward to every user who hasn't had it today, in one pass
+    # over just those users, returns how many got it
+    @timed("betting.credit_dailies")
+    def credit_dailies(self):
+        today = CLOCK.today()
+        user_ids = self._dailies.due(today)
+        for user_id in user_ids:
+            user = self._users[user_id]
+            user.claim_daily(today)
+            self._reindex(user)
+            self._log("daily", user=user_id, day=today.isoformat())
+        return len(user_ids)
+
+    @timed("betting.rename_user")
+    def rename_user(self, user):
+        person = self._get_user(user)
+        output = person.rename(user.display_name)
+        self._render_cache.drop_user(person._id)
+        self._render_cache.drop_boards("money", self._money_rank.rank(person._id))
+        self._render_cache.drop_boards("pnl", self._pnl_rank.rank(person._id))
+        for kind in STAT_BOARDS:
+            self._render_cache.drop_boards(kind, self._stat_ranks[kind].rank(person._id))
+        self._log("rename", user=person._id, name=user.display_name)
+        return output
+
+def custom_format(td):
+    minutes, _seconds = divmod(td.seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    hours += td.days * 24
+    return '{:d}hr {:02d}m'.format(hours, minutes)
+
+class User():
+    def __init__(self, name, userId):
+        self._id = userId
+        self._name = name
+        self._money = STARTING_MONEY
+        self._current_bets = {} # insertion ordered set of live bets
+        self._bets_by_event = {} # event id -> live bets on it
+        self._past_bets = []
+        self._daily = CLOCK.today() - timedelta(days=1)
+        self._total_pnl = 0
+        self._ongoing = 0 # total staked on current bets, the user's open exposure
+        self._monthly = {} # month -> MonthSummary of the bets rolled up out of history
+        self._reset_results()
+
+    # bets are pickled by BettingSystem, see BettingSystem.__getstate__
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_current_bets'] = {}
+        state['_bets_by_event'] = {}
+        state['_past_bets'] = []
+        return state
+
+    # fills in state added since older snapshots were written, run once the whole snapshot is unpickled
+    def _upgrade(self):
+        if not hasattr(self, '_won'):
+            self._count_results(self._past_bets)
+        if not hasattr(self, '_monthly'):
+            self._monthly = {}
+        if not hasattr(self, '_ongoing'):
+            self._ongoing = sum([bet._amount for bet in self._current_bets])
+        if not hasattr(self, '_bets_by_event'):
+            bets = self._current_bets
+            self._current_bets = {}
+            self._bets_by_event = {}
+            for bet in bets:
+                self._track_bet(bet)
+
+    def _track_bet(self, bet):
+        self._current_bets[bet] = None
+        self._bets_by_event.setdefault(bet._underlying._id, []).append(bet)
+
+    # totals over settled bets, kept up to date as bets are resolved so stats never read the history
+    def _reset_results(self):
+        self._won = 0
+        self._lost = 0
+        self._staked = 0 # total staked on settled bets
+        self._streak = 0 # wins in a row if positive, losses in a row if negative
+        self._best_streak = 0
+        self._worst_streak = 0
+
+    def _count_results(self, settled):
+        self._reset_results()
+        for bet in settled:
+            self._count_result(bet._resolution == "won", bet._amount)
+
+    def _count_result(self, won, amount):
+        self._staked += amount
+        if won:
+            self._won += 1
+            self._streak = self._streak + 1 if self._streak > 0 else 1
+            self._best_streak = max(self._best_streak, self._streak)
+        else:
+            self._lost += 1
+            self._streak = self._streak - 1 if self._streak < 0 else -1
+            self._worst_streak = max(self._worst_streak, -self._streak)
+
+    def settled_count(self):
+        return self._won + self._lost
+
+    def win_rate(self):
+        if self.settled_count() == 0:
+            return 0
+        return self._won / self.settled_count()
+
+    # PnL per dollar staked on settled bets
+    def roi(self):
+        if self._staked == 0:
+            return 0
+        return self._total_pnl / self._staked
+
+    def best_streak(self):
+        return self._best_streak
+
+    def exposure(self):
+        return self._ongoing
+
+    def stats(self):
+        output = self.name() + ": " + str(self._won) + " won, " + str(self._lost) + " lost"
+        if self.settled_count() > 0:
+            output += " (" + "{:.1f}".format(self.win_rate() * 100) + "% won)"
+        output += ", $" + "{:.2f}".format(self._staked) + " staked, ROI " + "{:.1f}".format(self.roi() * 100) + "%.\n"
+        streak = "none"
+        if self._streak > 0:
+            streak = str(self._streak) + " won"
+        elif self._streak < 0:
+            streak = str(-self._streak) + " lost"
+        output += "Current streak: " + streak + ", longest " + str(self._best_streak) + " won and " + str(self._worst_streak) + " lost in a row.\n"
+        output += "Open exposure: $" + "{:.2f}".format(self.exposure()) + " on " + str(len(self._current_bets)) + " live bets.\n"
+        return output
+
+    def name(self):
+        return self._name
+
+    def rename(self, name):
+        self._name = name
+        return name + " was renamed successfully."
+
+    def pnl(self):
+        return self._total_pnl
+
+    def money(self):
+        return self._money
+
+    def money_including_ongoing(self):
+        return self._ongoing + self.money()
+
+    def mention(self):
+        return "<@" + str(self._id) + ">"
+
+    def print_money(self):
+        return self.name() + " has " + "$" + "{:.2f}".format(self.money()) + "."
+
+    def pnl_summary(self, name):
+        neg = ""
+        if self._total_pnl < 0:
+            neg = "-"
+        return name + " has total PnL " + neg + "${:.2f}".format(abs(self._total_pnl)) + "."
+
+    def list_bets(self):
+        return self.pnl_summary(self.name()) + "\n" + "".join(self.iter_bets())
+
+    def list_past_bets(self, page=1):
+        return self.pnl_summary(self.mention()) + "\n```" + "".join(self.iter_past_bets(page)) + "```"
+
+    def iter_bets(self):
+        if len(self._current_bets) > 0:
+            yield "Live bets:\n"
+        else:
+            yield "No current bets.\n"
+        for bet in self._current_bets:
+            yield "\t" + bet.description() + "\n"
+
+    def past_bet_pages(self):
+        return page_bounds(len(self._past_bets) + len(self._monthly), 1, BETS_PER_PAGE)[2]
+
+    # settled bets newest first then the monthly totals of older ones, only the lines on the page are rendered
+    def iter_past_bets(self, page=1):
+        months = sorted(self._monthly, reverse=True)
+        (start, end, pages) = page_bounds(len(self._past_bets) + len(months), page, BETS_PER_PAGE)
+        if start >= end and page != 1:
+            yield "There are only " + str(pages) + " pages of past bets."
+            return
+        yield "Past bets" + (" (page " + str(page) + "/" + str(pages) + ")" if pages > 1 else "") + ":\n"
+        lines = chain((bet.description() for bet in reversed(self._past_bets)), (self._monthly[month].description(month) for month in months))
+        for line in islice(lines, start, end):
+            yield "\t" + line + "\n"
+
+    # moves the bets on a resolved event into history, as their settled records
+    def archive_bet(self, event_id, settled):
+        for bet in self._bets_by_event.pop(event_id, []):
+            del self._current_bets[bet]
+            self._ongoing -= bet._amount
+        self._past_bets.extend(settled)
+
+    # adds a bet on a rolled up event to the totals of the month it was resolved in
+    def roll_up(self, month, bet):
+        if not month in self._monthly:
+            self._monthly[month] = MonthSummary()
+        self._monthly[month].add(bet)
+
+    # returns the stakes of all live bets on an event
+    def refund_bets(self, event_id):
+        for bet in self._bets_by_event.pop(event_id, []):
+            del self._current_bets[bet]
+            self._money += bet.amount()
+            self._ongoing -= bet.amount()
+
+    def daily(self):
+        today = CLOCK.today()
+        if self._daily >= today:
+            # a claim can be dated after today if the timezone was changed since
+            wait = CLOCK.seconds_left() + (self._daily - today).days * 86400
+            return self.name() + " you need to wait " + custom_format(timedelta(seconds=wait)) + " more to retrieve your daily reward!"
+        self.claim_daily(today)
+        return self.name() + " gained ${:.2f}".format(abs(DAILY))
+
+    def claim_daily(self, day):
+        self._money += abs(DAILY)
+        self._daily = day
+
+    def has_money(self, amount):
+        return self._money >= amount
+
+    def win_bet(self, amount, odds):
+        self._money += amount * odds
+        self._total_pnl += amount * (odds-1)
+        self._count_result(True, amount)
+
+    def lose_bet(self, amount):
+        self._total_pnl -= amount
+        self._count_result(False, amount)
+
+    def place_bet(self, betEvent, amount, side):
+        assert(self.has_money(amount))
+        bet = Bet(betEvent, self, amount, side)
+        self._money -= amount
+        self._ongoing += amount
+        self._track_bet(bet)
+        return bet
+
+class BetEvent():
+    def __init__(self, eventId, description, odds, pool_weight=0):
+        self._id = eventId
+        self._description = description
+        self._bets = {} # insertion ordered set of bets
+        self._bets_by_user = {} # user id -> bets they placed
+        self._odds = odds #odds for "yes"
+        self._pool_weight = pool_weight # 0 for fixed odds, otherwise how much money the set odds count as against the pool
+        self._resolved = False
+        self._resolved_at = None # time.time() it was resolved at, None if before these were kept
+        self._result = "n/a"
+        self._locked = False
+        self._reset_pools()
+
+    # bets are pickled by BettingSystem, see BettingSystem.__getstate__
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_bets'] = ()
+        if self._bets_by_user is not None:
+            state['_largest'] = {True: [], False: []}
+        state['_bets_by_user'] = None
+        return state
+
+    def _upgrade(self):
+        if not hasattr(self, '_pool_weight'):
+            self._pool_weight = 0
+        if not hasattr(self, '_resolved_at'):
+            self._resolved_at = None
+        if not hasattr(self, '_bets_by_user'):
+            self._bets_by_user = {}
+            self._rebuild_pools()
+        if not hasattr(self, '_stakes'):
+            self._rebuild_pools()
+
+    # running totals for each side, kept up to date as bets are placed and cancelled
+    def _reset_pools(self):
+        self._stakes = {True: 0, False: 0}
+        self._bettor_counts = {True: 0, False: 0}
+        self._largest = {True: [], False: []} # heaps of (-amount, id, bet), cancelled bets are skipped when read
+
+    def _rebuild_pools(self):
+        self._reset_pools()
+        if self._bets_by_user is None:
+            bettors = {True: set(), False: set()}
+            largest = {True: 0, False: 0}
+            for bet in self._bets:
+                self._stakes[bet._side] += bet._amount
+                bettors[bet._side].add(bet._user._id)
+                largest[bet._side] = max(largest[bet._side], bet._amount)
+            self._bettor_counts = {side: len(bettors[side]) for side in bettors}
+            self._largest = largest
+            return
+        bets = list(self._bets)
+        self._bets = {}
+        self._bets_by_user = {}
+        for bet in bets:
+            self._track_bet(bet)
+
+    def _track_bet(self, bet):
+        self._bets[bet] = None
+        bets = self._bets_by_user.setdefault(bet._user._id, [])
+        if not any(other._side == bet._side for other in bets):
+            self._bettor_counts[bet._side] += 1
+        bets.append(bet)
+        self._stakes[bet._side] += bet._amount
+        heapq.heappush(self._largest[bet._side], (-bet._amount, id(bet), bet))
+
+    # removes all of a user's bets, returning them
+    def remove_bets(self, user_id):
+        bets = self._bets_by_user.pop(user_id, [])
+        for side in set([bet._side for bet in bets]):
+            self._bettor_counts[side] -= 1
+        for bet in bets:
+            del self._bets[bet]
+            self._stakes[bet._side] -= bet._amount
+        for side in [True, False]:
+            if self._bettor_counts[side] == 0:
+                self._stakes[side] = 0
+        return bets
+
+    def stake(self, side):
+        return self._stakes[side]
+
+    def bettor_count(self, side):
+        return self._bettor_counts[side]
+
+    def largest_bet(self, side):
+        if self._bets_by_user is None:
+            return self._largest[side]
+        heap = self._largest[side]
+        while heap and not heap[0][2] in self._bets:
+            heapq.heappop(heap)
+        return -heap[0][0] if heap else 0
+
+    # swaps the bets of a resolved event for settled records, returns old bet -> record
+    def _settle(self):
+        settled = {}
+        if self._bets_by_user is None:
+            return settled
+        self._largest = {side: self.largest_bet(side) for side in [True, False]}
+        for bet in self._bets:
+            settled[bet] = bet.settled()
+        self._bets = tuple(settled.values())
+        self._bets_by_user = None
+        return settled
+
+    # every user with a bet on this event
+    def bettors(self):
+        if self._bets_by_user is None:
+            return list({bet._user._id: bet._user for bet in self._bets}.values())
+        return [bets[0].user() for bets in self._bets_by_user.values()]
+
+    def add_bet(self, user, amount, side):
+        if user.has_money(amount):
+            self._track_bet(user.place_bet(self, amount, side))
+            return  user.name() + "'s $" + "{:.2f}".format(amount) + " bet placed successfully."
+        else:
+            return "insufficient funds " + user.name() + "!"
+
+    def payout(self, winning_side):
+        # pool odds are final once the event is resolved
+        self._odds = self.odds(True)
+        self._pool_weight = 0
+        self._resolved = True
+        self._locked = True
+        self._result = winning_side
+        for bet in self._bets:
+            bet.resolve(winning_side, self.odds(bet.side()))
+        bets_by_user = self._bets_by_user
+        settled = self._settle()
+        for bets in bets_by_user.values():
+            bets[0].user().archive_bet(self._id, [settled[bet] for bet in bets])
+    
+    def resolved(self):
+            return self._resolved
+
+    # "YYYY-MM" it was resolved in, "" if that wasn't kept
+    def month(self):
+        if self._resolved_at is None:
+            return ""
+        return time.strftime("%Y-%m", time.localtime(self._resolved_at))
+
+    def odds(self, side):
+        odds = self._odds
+        if self._pool_weight > 0:
+            odds = self._pool_odds()
+        if side:
+            return odds
+        return odds/(odds-1)  # x/(x-1) is the other side
+
+    # odds for "yes" from the share of the pool believing, with the set odds
+    # counting as pool_weight of money split the way they imply
+    def _pool_odds(self):
+        believing = self._pool_weight / self._odds + self._stakes[True]
+        total = self._pool_weight + self._stakes[True] + self._stakes[False]
+        return total / believing
+
+    def pool_information(self):
+        output = self._description + " @ $" + "{:.2f}".format(self.odds(True)) + "\n"
+        for (side, name) in [(True, "BELIEVERS"), (False, "DOUBTERS")]:
+            output += "{: <10}".format(name + ":") + " $" + "{:.2f}".format(self.stake(side)) + " from " + str(self.bettor_count(side)) + ", largest $" + "{:.2f}".format(self.largest_bet(side)) + ", pays $" + "{:.2f}".format(self.odds(side)) + "\n"
+        if self._pool_weight > 0 and not self._resolved:
+            output += "Odds follow the pool until the event is resolved.\n"
+        return output
+
+    def information(self, mention=False):
+        return "".join(self.iter_information(mention))
+
+    # one line for a resolved event: its result and what was won and lost on it
+    def settlement_summary(self):
+        won = [bet for bet in self._bets if bet._resolution == "won"]
+        lost = [bet for bet in self._bets if bet._resolution == "lost"]
+        return "<" + str(self._id) + "> " + self._description + " @ $" + "{:.2f}".format(self.odds(True)) + " RESULT: " + str(self._result).upper() + " - " + str(len(won)) + " won $" + "{:.2f}".format(sum([bet.winnings() for bet in won])) + ", " + str(len(lost)) + " lost $" + "{:.2f}".format(sum([bet.winnings() for bet in lost])) + "\n"
+
+    # the header (with the result once resolved) then one line per bet
+    def iter_information(self, mention=False):
+        header = ""
+        if mention:
+            header = "```"
+
+        locked = ""
+        if self.locked() and not(self.resolved()):
+            locked = " (locked)"
+        header += self._description + " @ $" + "{:.2f}".format(self.odds(True)) + locked + "\n"
+        if len(self._bets) > 0:
+            header += "POOL: $" + "{:.2f}".format(self.stake(True)) + " believing (" + str(self.bettor_count(True)) + "), $" + "{:.2f}".format(self.stake(False)) + " doubting (" + str(self.bettor_count(False)) + ")\n"
+        if self.resolved():
+            header += "RESULT: " + str(self._result).upper() + "\n"
+        if mention:
+            header += "```"
+        yield header
+        for bet in self._bets:
+            yield "\t" + bet.short_info(mention) + "\n"
+
+    def locked(self):
+        return self._locked
+
+    def lock(self):
+        if self._locked:
+            return "Already locked."
+        else:
+            self._locked = True
+            return "Event " + str(self._id) + " locked. Bets are now closed."
+    
+    def unlock(self):
+        if not(self._locked):
+            return "Already unlocked."
+        if self._resolved:
+            return "Already resolved - can't unlock."
+        else:
+            self._locked = False
+            return "Event " + str(self._id) + " unlocked. Bets are now reopened."
+
+# what live and settled bets have in common, everything is read from the same five fields
+class BetRecord():
+    __slots__ = ()
+
+    def description(self):
+        join = " that "
+        if not(self.side()):
+            join = " against "
+        if self._resolution == "n/a":
+            return self.user().name() + " bet " + "$" + "{:.2f}".format(self.amount()) + " @ $" + "{:.2f}".format(self.underlying().odds(self.side())) + join + self.underlying()._description
+        else:
+            return self.user().name() + " " + self._resolution + " " + "$" + "{:.2f}".format(self.winnings()) + " betting" + join + self.underlying()._description
+
+    def short_info(self, mention=False):
+        join = "DOUBTER:  "
+        if self.side():
+            join = "BELIEVER: "
+
+        name = self.user().name()
+        if mention:
+            name = self.user().mention()
+
+        if self._resolution == "n/a":
+            return join + self.user().name() + " bet " + "$" + "{:.2f}".format(self.amount())
+        else:
+            return join + name + " " + self._resolution + " " + "$" + "{:.2f}".format(self.winnings())
+
+    def winnings(self):
+        if self._resolution != "won":
+            return self._amount
+        return self.amount()*(self._underlying.odds(self.side())-1)
+
+    def side(self):
+        return self._side
+
+    def amount(self):
+        return self._amount
+
+    def user(self):
+        return self._user
+
+    def underlying(self):
+        return self._underlying
+
+class Bet(BetRecord):
+    def __init__(self, event, user, amount, side):
+        self._underlying = event
+        self._user = user
+        self._amount = amount
+        self._side = side
+        self._resolution = "n/a"
+
+    # the compact record kept once the bet is resolved
+    def settled(self):
+        return SettledBet(self._underlying, self._user, self._amount, self._side, self._resolution)
+
+    def resolve(self, outcome, odds):
+        if self._resolution != "n/a":
+            raise Exception("oops - double resolve bet")
+
+        if outcome == self.side():
+            self._resolution = "won"
+            self._user.win_bet(self.amount(), odds)
+        else:
+            self._resolution = "lost"
+            self._user.lose_bet(self.amount())
+
+# a resolved bet, without a __dict__ so history costs a few words per bet
+class SettledBet(BetRecord):
+    __slots__ = ('_underlying', '_user', '_amount', '_side', '_resolution')
+
+    def __init__(self, event, user, amount, side, resolution):
+        self._underlying = event
+        self._user = user
+        self._amount = amount
+        self._side = side
+        self._resolution = resolution
+
+    def settled(self):
+        return self
+
+# what a user's bets on the events of one month came to once they were rolled up out of history
+class MonthSummary():
+    __slots__ = ('_won', '_lost', '_staked', '_pnl')
+
+    def __init__(self, won=0, lost=0, staked=0, pnl=0):
+        self._won = won
+        self._lost = lost
+        self._staked = staked
+        self._pnl = pnl
+
+    def add(self, bet):
+        self._staked += bet._amount
+        if bet._resolution == "won":
+            self._won += 1
+            self._pnl += bet.winnings()
+        else:
+            self._lost += 1
+            self._pnl -= bet._amount
+
+    def description(self, month):
+        neg = ""
+        if self._pnl < 0:
+            neg = "-"
+        return (month or "Earlier") + ": " + str(self._won) + " won, " + str(self._lost) + " lost, $" + "{:.2f}".format(self._staked) + " staked, PnL " + neg + "$" + "{:.2f}".format(abs(self._pnl))
@@ -0,0 +1,58 @@
+# Imports
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from settings import STATE_SOCKET, WORKERS
+from service import DEFAULT_SOCKET, CONNECT_TIMEOUT
+
+################################################
+# Cluster
+#
+# Starts the state service (service.py) and `workers` bot processes on this
+# machine, each bot connecting to Discord as one shard and keeping its state in
+# the service, so commands are parsed and answered on several cores while every
+# guild still has a single writer. Stopping the cluster, or any of its
+# processes exiting, stops the bots first and then the service, which saves
+# everything on the way out.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def start(script, env):
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)], env=env)
+
+def stop(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        process.wait()
+
+def main():
+    path = STATE_SOCKET or DEFAULT_SOCKET
+    env = dict(os.environ, state_socket=path)
+    if os.path.exists(path):
+        os.remove(path)
+    service = start("service.py", env)
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while not os.path.exists(path) and service.poll() is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if not os.path.exists(path):
+        stop([service])
+        sys.exit("The state service didn't start")
+    workers = [start("Betting_Bot.py", dict(env, shard_id=str(i), shard_count=str(WORKERS))) for i in range(WORKERS)]
+
+    stopping = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.append(signum))
+    while not stopping and all([process.poll() is None for process in [service] + workers]):
+        time.sleep(1)
+    stop(workers)
+    stop([service])
+    codes = [process.returncode for process in [service] + workers if process.returncode not in (0, -signal.SIGTERM)]
+    sys.exit(codes[0] if codes and not stopping else 0)
+
+if __name__ == "__main__":
+    main()
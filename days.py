@@ -0,0 +1,89 @@
+# Imports
+from datetime import datetime, timedelta
+import heapq
+import time
+
+import pytz
+
+from settings import TIMEZONE
+
+################################################
+# Days
+#
+# Daily rewards go by the calendar day in the configured timezone. DayClock
+# works out where the current day starts and ends once and then only compares
+# the time against the end, so asking for today costs a clock read until the
+# day actually rolls over.
+#
+# DailyIndex buckets users by the day they can next claim their reward, with a
+# heap of those days, so everyone who can claim by a given day is found (and
+# taken out) in time proportional to how many of them there are, not to how
+# many users there are.
+
+ONE_DAY = timedelta(days=1)
+
+class DayClock():
+    def __init__(self, timezone):
+        self._timezone = pytz.timezone(timezone)
+        self._today = None
+        self._starts_at = 0 # epoch seconds the current day started at
+        self._ends_at = 0 # and ends at
+
+    # midnight at the start of the current day, as a naive datetime in the timezone
+    def today(self, now=None):
+        if now is None:
+            now = time.time()
+        if now >= self._ends_at or now < self._starts_at:
+            self._roll(now)
+        return self._today
+
+    # epoch seconds the next day starts at
+    def tomorrow_at(self, now=None):
+        self.today(now)
+        return self._ends_at
+
+    # seconds until the next day starts
+    def seconds_left(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.tomorrow_at(now) - now
+
+    def _roll(self, now):
+        local = datetime.fromtimestamp(now, self._timezone)
+        self._today = datetime(local.year, local.month, local.day)
+        self._starts_at = self._timezone.localize(self._today).timestamp()
+        self._ends_at = self._timezone.localize(self._today + ONE_DAY).timestamp()
+
+CLOCK = DayClock(TIMEZONE)
+
+class DailyIndex():
+    def __init__(self):
+        self._buckets = {} # day a claim is next allowed on -> ids of the users it is allowed for
+        self._days = [] # heap of the days in _buckets
+        self._users = {} # user id -> day of their bucket
+
+    def __len__(self):
+        return len(self._users)
+
+    # files a user under the day after the one they last claimed on
+    def update(self, user_id, claimed):
+        day = claimed + ONE_DAY
+        old = self._users.get(user_id)
+        if old == day:
+            return
+        if old is not None:
+            self._buckets[old].discard(user_id)
+        self._users[user_id] = day
+        if not day in self._buckets:
+            self._buckets[day] = set()
+            heapq.heappush(self._days, day)
+        self._buckets[day].add(user_id)
+
+    # takes out and returns the ids of every user who can claim on `today`
+    def due(self, today):
+        user_ids = []
+        while self._days and self._days[0] <= today:
+            for user_id in self._buckets.pop(heapq.heappop(self._days)):
+                del self._users[user_id]
+                user_ids.append(user_id)
+        return user_ids
@@ -0,0 +1,128 @@
+# Imports
+import asyncio
+from collections import OrderedDict
+import glob
+import os
+import time
+
+from autosave import Autosaver
+from metrics import METRICS
+from writer import Writer
+
+################################################
+# Guilds
+#
+# Every guild (server) has its own BettingSystem, kept in its own directory
+# with its own store, writer and autosave. A guild is loaded the first time one
+# of its commands needs it. Once more than `budget` guilds are loaded, the
+# least recently used ones that have been idle for `idle` seconds are saved and
+# dropped from memory, so memory and save cost follow the active guilds only.
+#
+# Files from before guilds had their own directories are moved into the
+# directory of `legacy_guild`, or of the first guild loaded when that is 0.
+
+class GuildState():
+    def __init__(self, guild_id, directory, store, autosave_interval):
+        self.id = guild_id
+        self.directory = directory
+        self.store = store
+        self.system = store.load()
+        self.writer = Writer(store)
+        self.autosave = Autosaver(store, autosave_interval)
+        self.used = time.monotonic()
+
+    def start(self):
+        self.writer.start()
+        self.autosave.start()
+
+    # applies a change to this guild's system through its writer, returns the reply once the change is saved
+    async def change(self, apply):
+        return await self.writer.submit(apply)
+
+    # saves everything and lets go of the store
+    async def stop(self):
+        await self.writer.stop()
+        await self.autosave.stop()
+        self.store.close()
+
+class GuildRegistry():
+    def __init__(self, directory, open_store, legacy_files=[], legacy_guild=0, budget=50, idle=600, autosave_interval=300, on_load=None):
+        self._directory = directory
+        self._open_store = open_store # function taking a directory, returns an unloaded store
+        self._legacy_files = legacy_files
+        self._legacy_guild = legacy_guild
+        self._budget = budget
+        self._idle = idle
+        self._autosave_interval = autosave_interval
+        self._on_load = on_load # called with each newly loaded GuildState
+        self._loaded = OrderedDict() # guild id -> GuildState, least recently used first
+        self._loading = {} # guild id -> lock held while it loads
+        self._stopping = {} # guild id -> task saving a guild that is no longer loaded
+
+    def loaded(self):
+        return list(self._loaded.values())
+
+    async def get(self, guild_id):
+        if guild_id in self._loaded:
+            self._loaded.move_to_end(guild_id)
+            state = self._loaded[guild_id]
+            state.used = time.monotonic()
+            return state
+        lock = self._loading.setdefault(guild_id, asyncio.Lock())
+        async with lock:
+            if not guild_id in self._loaded:
+                # a guild is only opened again once its files are let go of
+                if guild_id in self._stopping:
+                    await asyncio.wait([self._stopping[guild_id]])
+                self._loaded[guild_id] = self._load(guild_id)
+                await self._evict()
+        self._loading.pop(guild_id, None)
+        return await self.get(guild_id)
+
+    async def close(self):
+        while self._loaded:
+            (_guild_id, state) = self._loaded.popitem(last=False)
+            await self._stop(state)
+        if self._stopping:
+            await asyncio.wait(list(self._stopping.values()))
+
+    def _load(self, guild_id):
+        start = time.perf_counter()
+        directory = os.path.join(self._directory, str(guild_id))
+        os.makedirs(directory, exist_ok=True)
+        if self._legacy_guild in (0, guild_id):
+            self._adopt_legacy_files(directory)
+        state = GuildState(guild_id, directory, self._open_store(directory), self._autosave_interval)
+        state.start()
+        if self._on_load is not None:
+            self._on_load(state)
+        METRICS.observe("guild.load", time.perf_counter() - start)
+        return state
+
+    def _adopt_legacy_files(self, directory):
+        for name in self._legacy_files:
+            paths = [name] + [path for path in glob.glob(glob.escape(name) + ".*") if path[len(name) + 1:].isdigit()]
+            for path in paths:
+                target = os.path.join(directory, os.path.basename(path))
+                if os.path.exists(path) and not os.path.exists(target):
+                    os.replace(path, target)
+                    print("Moved " + path + " into " + directory)
+
+    async def _evict(self):
+        now = time.monotonic()
+        for state in list(self._loaded.values()):
+            if len(self._loaded) <= self._budget:
+                return
+            if now - state.used >= self._idle:
+                del self._loaded[state.id]
+                await self._stop(state)
+
+    # stops a guild taken out of _loaded, a get for it meanwhile waits for this before loading it again
+    async def _stop(self, state):
+        stopping = asyncio.ensure_future(state.stop())
+        self._stopping[state.id] = stopping
+        try:
+            await asyncio.shield(stopping)
+        finally:
+            if self._stopping.get(state.id) is stopping:
+                del self._stopping[state.id]
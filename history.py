@@ -0,0 +1,311 @@
+# Imports
+from collections import OrderedDict
+import os
+import pickle
+import struct
+import time
+
+from betting import BetEvent, SettledBet
+from metrics import METRICS
+
+################################################
+# History segments
+#
+# Past events and settled bets are never needed to start the bot, so a
+# JournalStore snapshot keeps them out of the pickle and in a segment file next
+# to it: one pickled record per past event, then an index of where each event
+# is, which events each user bet on (in the order of their history) and how
+# many settled bets they have, then the index's position in a fixed-size
+# trailer. Startup only opens the file. The index is read the first time
+# history is asked for, and events are read one at a time as pages need them,
+# keeping the most recently used ones in memory.
+#
+# Events resolved since the snapshot are kept in memory on top of the segment.
+# The next snapshot copies the segment's events as they are, appends the new
+# ones and a new index, and once it is written the store switches over to it,
+# so memory only holds what changed since the last snapshot. Events rolled up
+# into monthly totals (see BettingSystem.retain_history) are the oldest ones,
+# so they are dropped from the index straight away and left out of the copy.
+
+TRAILER = struct.Struct(">QQ") # offset and length of the index
+
+class Segment():
+    def __init__(self, filename):
+        self.filename = filename
+        self._handle = open(filename, 'rb')
+        self._index = None
+
+    # (event id -> (offset, length) in resolution order, user id -> event ids, user id -> settled bet count)
+    def index(self):
+        if self._index is None:
+            start = time.perf_counter()
+            size = os.fstat(self._handle.fileno()).st_size
+            (offset, length) = TRAILER.unpack(self._read(size - TRAILER.size, TRAILER.size))
+            (events, users, counts) = pickle.loads(self._read(offset, length))
+            self._index = (OrderedDict(events), users, counts, offset)
+            METRICS.observe("history.index", time.perf_counter() - start)
+        return self._index
+
+    def read_event(self, event_id):
+        (offset, length) = self.index()[0][event_id]
+        return pickle.loads(self._read(offset, length))
+
+    # takes events out of the index along with each user's bets on them, the file is left as it is
+    def drop(self, event_ids):
+        (events, users, counts, _end) = self.index()
+        for event_id in event_ids:
+            if not event_id in events:
+                continue
+            bets = self.read_event(event_id)[5]
+            del events[event_id]
+            for (user_id, _amount, _side, _resolution) in bets:
+                counts[user_id] -= 1
+            for user_id in set([bet[0] for bet in bets]):
+                users[user_id].remove(event_id)
+
+    # the records of every event still in the index, as the bytes they are stored
+    # as, returns how far they moved. Dropped events are always the oldest ones.
+    def copy_events(self, handle):
+        (events, _users, _counts, end) = self.index()
+        position = end
+        if events:
+            position = next(iter(events.values()))[0]
+        shift = handle.tell() - position
+        while position < end:
+            block = self._read(position, min(1 << 20, end - position))
+            handle.write(block)
+            position += len(block)
+        return shift
+
+    # reads at an offset without moving a shared file position, a forked snapshot may be reading too
+    def _read(self, offset, length):
+        if hasattr(os, 'pread'):
+            return os.pread(self._handle.fileno(), length, offset)
+        self._handle.seek(offset)
+        return self._handle.read(length)
+
+    def close(self):
+        self._handle.close()
+
+# writes every past event of the system to a new segment
+def write_segment(filename, system):
+    history = system._past_events
+    temp_filename = filename + ".tmp" + str(os.getpid())
+    with open(temp_filename, 'wb') as handle:
+        events = OrderedDict()
+        users = {}
+        counts = {}
+        if history._segment is not None:
+            shift = history._segment.copy_events(handle)
+            (old_events, old_users, old_counts, _end) = history._segment.index()
+            events.update([(event_id, (offset + shift, length)) for (event_id, (offset, length)) in old_events.items()])
+            users = {user_id: list(event_ids) for (user_id, event_ids) in old_users.items()}
+            counts = dict(old_counts)
+        for event in history._recent.values():
+            data = pickle.dumps((event._id, event._description, event._odds, event._locked, event._result,
+                                 [(bet._user._id, bet._amount, bet._side, bet._resolution) for bet in event._bets], event._resolved_at), protocol=pickle.HIGHEST_PROTOCOL)
+            events[event._id] = (handle.tell(), len(data))
+            handle.write(data)
+        for user in system._users.values():
+            event_ids = users.setdefault(user._id, [])
+            recent = history.past_bets(user)._recent
+            for bet in recent:
+                if not event_ids or event_ids[-1] != bet._underlying._id:
+                    event_ids.append(bet._underlying._id)
+            counts[user._id] = counts.get(user._id, 0) + len(recent)
+        offset = handle.tell()
+        index = pickle.dumps((list(events.items()), users, counts), protocol=pickle.HIGHEST_PROTOCOL)
+        handle.write(index)
+        handle.write(TRAILER.pack(offset, len(index)))
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temp_filename, filename)
+
+# BettingSystem._past_events: the events in a segment followed by those resolved since
+class PastEvents():
+    def __init__(self, users, segment=None, recent=None, capacity=64):
+        self._users = users
+        self._segment = segment
+        self._recent = OrderedDict(recent or {})
+        self._cache = OrderedDict() # events read from the segment, most recently used last
+        self._capacity = capacity
+        self._generation = 0 # bumped by clear, a snapshot started before then no longer applies
+        self._dropped = [] # events rolled up since the running snapshot started
+
+    def _stored(self):
+        if self._segment is None:
+            return OrderedDict()
+        return self._segment.index()[0]
+
+    def __getitem__(self, event_id):
+        if event_id in self._recent:
+            return self._recent[event_id]
+        if event_id in self._cache:
+            self._cache.move_to_end(event_id)
+            return self._cache[event_id]
+        if not event_id in self._stored():
+            raise KeyError(event_id)
+        event = self._build(self._segment.read_event(event_id))
+        self._cache[event_id] = event
+        while len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+        return event
+
+    def __setitem__(self, event_id, event):
+        self._recent[event_id] = event
+
+    def __contains__(self, event_id):
+        return event_id in self._recent or event_id in self._stored()
+
+    def __iter__(self):
+        yield from list(self._stored())
+        yield from list(self._recent)
+
+    def __reversed__(self):
+        yield from list(reversed(self._recent))
+        yield from list(reversed(self._stored()))
+
+    def __len__(self):
+        return len(self._stored()) + len(self._recent)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        for event_id in self:
+            yield self[event_id]
+
+    def items(self):
+        for event_id in self:
+            yield (event_id, self[event_id])
+
+    def clear(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = None
+        self._recent.clear()
+        self._cache.clear()
+        self._dropped = []
+        self._generation += 1
+
+    # drops the oldest events and every bet on them
+    def compact(self, event_ids):
+        for event_id in event_ids:
+            self._recent.pop(event_id, None)
+            self._cache.pop(event_id, None)
+        if self._segment is not None:
+            self._segment.drop(event_ids)
+        dropped = set(event_ids)
+        for user in self._users.values():
+            self.past_bets(user).drop(dropped)
+        self._dropped.extend(event_ids)
+
+    # segments written before resolution times were kept have one field less
+    def _build(self, record):
+        (event_id, description, odds, locked, result, bets) = record[:6]
+        event = BetEvent(event_id, description, odds)
+        event._locked = locked
+        event._resolved = True
+        if len(record) > 6:
+            event._resolved_at = record[6]
+        event._result = result
+        event._bets = tuple([SettledBet(event, self._users[user_id], amount, side, resolution) for (user_id, amount, side, resolution) in bets])
+        event._bets_by_user = None
+        event._rebuild_pools()
+        return event
+
+    # a user's history, users added since the history was attached start with a plain list
+    def past_bets(self, user):
+        if not isinstance(user._past_bets, PastBets):
+            user._past_bets = PastBets(self, user._id, user._past_bets)
+        return user._past_bets
+
+    # how much of the history a snapshot starting now will cover: the recent
+    # events and the last recent bet of each user
+    def mark(self):
+        self._dropped = []
+        last_bets = {}
+        for user in self._users.values():
+            recent = self.past_bets(user)._recent
+            if recent:
+                last_bets[user._id] = recent[-1]
+        return (self._generation, list(self._recent), last_bets)
+
+    # switches to a newly written segment holding everything up to the mark,
+    # less what was rolled up while it was being written
+    def rebase(self, segment, mark):
+        (generation, recent, last_bets) = mark
+        if generation != self._generation:
+            segment.close()
+            return
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = segment
+        segment.drop(self._dropped)
+        self._dropped = []
+        covered = set(recent)
+        self._recent = OrderedDict([(event_id, event) for (event_id, event) in self._recent.items() if not event_id in covered])
+        self._cache.clear()
+        for user in self._users.values():
+            self.past_bets(user).rebase(last_bets.get(user._id))
+
+# User._past_bets: the user's bets on events in the segment followed by those settled since
+class PastBets():
+    def __init__(self, events, user_id, recent=None):
+        self._events = events
+        self._user_id = user_id
+        self._recent = list(recent or [])
+
+    def _stored(self):
+        if self._events._segment is None:
+            return []
+        return self._events._segment.index()[1].get(self._user_id, [])
+
+    def append(self, bet):
+        self._recent.append(bet)
+
+    def extend(self, bets):
+        self._recent.extend(bets)
+
+    def clear(self):
+        self._recent.clear()
+
+    # the segment's index is updated by Segment.drop, only recent bets are left to go
+    def drop(self, event_ids):
+        if self._recent:
+            self._recent = [bet for bet in self._recent if not bet._underlying._id in event_ids]
+
+    # forgets the recent bets up to the last one a new segment holds, if it was
+    # rolled up since then so was every bet before it
+    def rebase(self, last):
+        for (i, bet) in enumerate(self._recent):
+            if bet is last:
+                self._recent = self._recent[i + 1:]
+                return
+
+    def _bets_on(self, event_id):
+        return [bet for bet in self._events[event_id]._bets if bet._user._id == self._user_id]
+
+    def __iter__(self):
+        for event_id in self._stored():
+            yield from self._bets_on(event_id)
+        yield from list(self._recent)
+
+    def __reversed__(self):
+        yield from list(reversed(self._recent))
+        for event_id in reversed(self._stored()):
+            yield from reversed(self._bets_on(event_id))
+
+    def __len__(self):
+        stored = 0
+        if self._events._segment is not None:
+            stored = self._events._segment.index()[2].get(self._user_id, 0)
+        return stored + len(self._recent)
+
+# swaps a system's past events and histories for the lazy ones, keeping what they hold
+def attach_history(system, segment=None):
+    if isinstance(system._past_events, PastEvents):
+        return
+    system._past_events = PastEvents(system._users, segment, system._past_events)
+    for user in system._users.values():
+        system._past_events.past_bets(user)
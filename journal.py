@@ -0,0 +1,301 @@
+# Imports
+import asyncio
+import glob
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import pickle
+import time
+import traceback
+
+from betting import BettingSystem
+from backup import write_backup_in_background
+from history import Segment, write_segment, attach_history
+from metrics import METRICS
+
+################################################
+# Persistence
+#
+# Every change to a BettingSystem is appended to the journal as one JSON line
+# tagged with a sequence number. Periodically the whole state is pickled to the
+# snapshot file (which remembers the last sequence number it covers) and the
+# journal records it covers are deleted, so startup loads the snapshot and only
+# replays the records written after it.
+#
+# When a snapshot starts the journal is moved aside into a segment named after
+# the last sequence number in it and a fresh journal is started; the segment is
+# deleted once a snapshot covering it has been written.
+#
+# With group_commit records are only buffered as they are written; commit()
+# makes everything written so far durable with one fsync in a worker thread,
+# and records written while that runs are covered by the next one.
+#
+# Past events and settled bets are not part of the snapshot pickle. Each
+# snapshot writes them to a history segment named after its sequence number
+# (see history.py), which is only read once history is asked for, so startup
+# costs the users, live events and settings plus the journal tail.
+
+# snapshots from before the bot was split into modules were pickled by the bot
+# script and refer to its __main__, which isn't the bot when a state service loads them
+class SnapshotUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == "__main__":
+            module = "betting"
+        return super().find_class(module, name)
+
+class JournalStore():
+    def __init__(self, snapshot_filename, journal_filename, snapshot_every=500, group_commit=False):
+        self._snapshot_filename = snapshot_filename
+        self._journal_filename = journal_filename
+        self._snapshot_every = snapshot_every
+        self._system = None
+        self._handle = None
+        self._seq = 0
+        self._since_snapshot = 0
+        self._executor = None
+        self._pending = None # background snapshot still being written
+        self._group_commit = group_commit
+        self._synced = 0 # last record known to be on disk
+        self._syncing = None # fsync running in a worker thread
+
+    # loads the latest snapshot, replays the journal tail and attaches to the result
+    def load(self):
+        start = time.perf_counter()
+        system = self._read_snapshot()
+        history = system.__dict__.pop('_history', None)
+        segment = None
+        if history is not None:
+            segment = Segment(os.path.join(os.path.dirname(self._snapshot_filename), history))
+        attach_history(system, segment)
+        METRICS.observe("startup.snapshot", time.perf_counter() - start)
+        start = time.perf_counter()
+        for filename in self._segments() + [self._journal_filename]:
+            for record in self._read_journal(filename):
+                if record["seq"] > system._journal_seq:
+                    system.replay(record)
+                    self._since_snapshot += 1
+        METRICS.observe("startup.replay", time.perf_counter() - start)
+        self._drop_history(history)
+        self._seq = system._journal_seq
+        self._synced = self._seq
+        self._handle = open(self._journal_filename, 'a', encoding='utf-8')
+        self.attach(system)
+        return system
+
+    def attach(self, system):
+        attach_history(system)
+        self._system = system
+        system._store = self
+
+    # swaps in a whole new state (e.g. an uploaded save) and snapshots it straight away
+    def replace(self, system):
+        self.attach(system)
+        self.snapshot()
+        return system
+
+    def record(self, op, fields):
+        self._seq += 1
+        fields["seq"] = self._seq
+        fields["op"] = op
+        self._handle.write(json.dumps(fields, separators=(",", ":")) + "\n")
+        if not self._group_commit:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._synced = self._seq
+        self._system._journal_seq = self._seq
+        self._since_snapshot += 1
+
+    # returns once every record written so far is on disk
+    async def commit(self):
+        seq = self._seq
+        while self._synced < seq:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._sync())
+            await asyncio.shield(self._syncing)
+
+    # the journal may be rotated while the fsync runs, so it gets its own descriptor
+    async def _sync(self):
+        seq = self._seq
+        self._handle.flush()
+        fd = os.dup(self._handle.fileno())
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, fd)
+            self._synced = max(self._synced, seq)
+        finally:
+            os.close(fd)
+            self._syncing = None
+
+    # whether anything changed since the last snapshot was started
+    def dirty(self):
+        return self._since_snapshot > 0
+
+    def needs_snapshot(self):
+        return self._since_snapshot >= self._snapshot_every
+
+    # writes the full state atomically then drops the journal records it covers,
+    # returns the file holding the state
+    def snapshot(self):
+        self._wait_for_pending()
+        seq = self._rotate()
+        mark = self._system._past_events.mark()
+        self._write_snapshot(seq)
+        self._switch_history(seq, mark)
+        self._drop_segments(seq)
+        return self._snapshot_filename
+
+    # same as snapshot but without blocking the event loop: a forked child process
+    # sees the state exactly as it is now and writes it while this process carries on
+    async def snapshot_in_background(self):
+        self._wait_for_pending()
+        seq = self._rotate()
+        mark = self._system._past_events.mark()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self._write_snapshot(seq)
+                    os._exit(0)
+                except BaseException:
+                    traceback.print_exc()
+                    os._exit(1)
+            self._pending = self._executor.submit(self._wait_for_child, pid)
+        else:
+            write_segment(self._history_filename(seq), self._system)
+            data = self._without_history(seq, lambda: pickle.dumps(self._system, protocol=pickle.HIGHEST_PROTOCOL))
+            self._pending = self._executor.submit(self._write_file, lambda handle: handle.write(data))
+        await asyncio.wrap_future(self._pending)
+        self._pending = None
+        self._switch_history(seq, mark)
+        self._drop_segments(seq)
+        return self._snapshot_filename
+
+    # writes a backup of the state as it is now, returns the backup's file
+    async def backup(self, filename):
+        return await write_backup_in_background(self._system, filename)
+
+    def _wait_for_child(self, pid):
+        (_pid, status) = os.waitpid(pid, 0)
+        if status != 0:
+            raise OSError("snapshot process failed with status " + str(status))
+
+    # a snapshot started later must not be overwritten by one still being written
+    def _wait_for_pending(self):
+        if self._pending is not None:
+            try:
+                self._pending.result()
+            except Exception:
+                traceback.print_exc()
+            self._pending = None
+
+    # moves the journal aside so the next snapshot covers everything in it
+    def _rotate(self):
+        self._system._journal_seq = self._seq
+        self._since_snapshot = 0
+        self._close_journal()
+        if os.path.exists(self._journal_filename):
+            os.replace(self._journal_filename, self._journal_filename + "." + str(self._seq))
+        self._handle = open(self._journal_filename, 'a', encoding='utf-8')
+        return self._seq
+
+    def _write_snapshot(self, seq):
+        write_segment(self._history_filename(seq), self._system)
+        self._write_file(lambda handle: self._without_history(seq, lambda: pickle.dump(self._system, handle, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    # runs write with the history taken out of the system and the name of the segment holding it put in
+    def _without_history(self, seq, write):
+        system = self._system
+        past_events = system._past_events
+        past_bets = [(user, user._past_bets) for user in system._users.values()]
+        system._past_events = {}
+        for (user, _bets) in past_bets:
+            user._past_bets = []
+        system._history = os.path.basename(self._history_filename(seq))
+        try:
+            return write()
+        finally:
+            del system._history
+            system._past_events = past_events
+            for (user, bets) in past_bets:
+                user._past_bets = bets
+
+    def _history_filename(self, seq):
+        return os.path.splitext(self._snapshot_filename)[0] + ".history." + str(seq)
+
+    # once a snapshot is on disk its segment replaces the history read so far and older segments go
+    def _switch_history(self, seq, mark):
+        self._system._past_events.rebase(Segment(self._history_filename(seq)), mark)
+        self._drop_history(os.path.basename(self._history_filename(seq)))
+
+    # removes every history segment but the one the snapshot on disk refers to,
+    # segments still open here stay readable until they are closed
+    def _drop_history(self, keep):
+        base = os.path.splitext(self._snapshot_filename)[0] + ".history."
+        for filename in glob.glob(glob.escape(base) + "*"):
+            if os.path.basename(filename) != keep:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    traceback.print_exc()
+
+    # the new file only replaces the old one once it is completely on disk
+    def _write_file(self, write):
+        temp_filename = self._snapshot_filename + ".tmp" + str(os.getpid())
+        with open(temp_filename, 'wb') as handle:
+            write(handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_filename, self._snapshot_filename)
+
+    # journal segments oldest first
+    def _segments(self):
+        segments = []
+        for filename in glob.glob(glob.escape(self._journal_filename) + ".*"):
+            suffix = filename[len(self._journal_filename) + 1:]
+            if suffix.isdigit():
+                segments.append((int(suffix), filename))
+        return [filename for (_seq, filename) in sorted(segments)]
+
+    def _drop_segments(self, seq):
+        for filename in self._segments():
+            if int(filename[len(self._journal_filename) + 1:]) <= seq:
+                os.remove(filename)
+
+    # lets go of the journal and the history segment the system reads from
+    def close(self):
+        self._close_journal()
+        self._handle = None
+        if self._system is not None and self._system._past_events._segment is not None:
+            self._system._past_events._segment.close()
+
+    def _close_journal(self):
+        if self._handle is not None:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._synced = self._seq
+            self._handle.close()
+
+    def _read_snapshot(self):
+        try:
+            with open(self._snapshot_filename, 'rb') as handle:
+                system = SnapshotUnpickler(handle).load()
+            print("Successfully loaded " + self._snapshot_filename)
+        except FileNotFoundError:
+            print("Couldn't find snapshot file " + self._snapshot_filename)
+            system = BettingSystem()
+        return system
+
+    def _read_journal(self, filename):
+        try:
+            handle = open(filename, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn final line from a crash mid-write, nothing after it was acknowledged
+                    break
+                yield record
@@ -0,0 +1,110 @@
+# Imports
+import random
+
+################################################
+# Ranking
+#
+# An indexable skiplist ordered by key. Each link also stores how many entries
+# it jumps over, so inserting, removing, finding the rank of an entry and
+# walking the first k entries all take O(log n) (plus k for the walk).
+
+MAX_LEVELS = 24
+
+class _Node():
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+class RankIndex():
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVELS)
+        self._keys = {} # item -> key it is currently stored under
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, item):
+        return item in self._keys
+
+    # (re)positions an item, keys sort ascending with the item as the last element,
+    # returns whether anything changed
+    def update(self, item, key):
+        key = (key, item)
+        old = self._keys.get(item)
+        if old == key:
+            return False
+        if old is not None:
+            self._remove(old)
+        self._insert(key)
+        self._keys[item] = key
+        return True
+
+    def remove(self, item):
+        if item in self._keys:
+            self._remove(self._keys.pop(item))
+
+    # 1-based position of an item
+    def rank(self, item):
+        key = self._keys[item]
+        node = self._head
+        position = 0
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position + 1
+
+    # the first k items in key order
+    def top(self, k):
+        items = []
+        node = self._head.next[0]
+        while node is not None and len(items) < k:
+            items.append(node.key[-1])
+            node = node.next[0]
+        return items
+
+    def _insert(self, key):
+        chain = [None] * MAX_LEVELS
+        steps_at_level = [0] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = 1
+        while levels < MAX_LEVELS and random.random() < 0.5:
+            levels += 1
+        new = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, MAX_LEVELS):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def _remove(self, key):
+        chain = [None] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        for level in range(len(target.next)):
+            previous = chain[level]
+            previous.width[level] += target.width[level] - 1
+            previous.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self._size -= 1
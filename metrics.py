@@ -0,0 +1,185 @@
+# Imports
+import asyncio
+from bisect import bisect_left
+from functools import wraps
+import inspect
+import os
+import time
+import traceback
+
+################################################
+# Metrics
+#
+# Call latencies, error counts and reply sizes, kept as fixed-bucket histograms
+# so recording is a couple of clock reads and a bisect. Commands are timed by
+# the bot's invoke hooks, BettingSystem methods by the @timed decorator. The
+# totals can be listed with the botstats command and are written to a Prometheus
+# text file every so often for node_exporter's textfile collector.
+
+SECONDS_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTES_BUCKETS = [16, 64, 256, 512, 1024, 2048, 4096, 16384, 65536]
+
+class Histogram():
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket is +Inf
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0
+
+    # upper bound of the bucket holding the q-th observation
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return 0
+
+class Metrics():
+    def __init__(self):
+        self._timings = {} # name -> Histogram of seconds
+        self._errors = {} # name -> count
+        self._sizes = {} # name -> Histogram of bytes
+
+    def timing(self, name):
+        if not name in self._timings:
+            self._timings[name] = Histogram(SECONDS_BUCKETS)
+        return self._timings[name]
+
+    def observe(self, name, seconds):
+        self.timing(name).observe(seconds)
+
+    def error(self, name):
+        self._errors[name] = self._errors.get(name, 0) + 1
+
+    def size(self, name, size):
+        if not name in self._sizes:
+            self._sizes[name] = Histogram(BYTES_BUCKETS)
+        self._sizes[name].observe(size)
+
+    # one line per name that has been called, busiest first. Percentiles are the
+    # upper bound of the bucket they fall in.
+    def summary(self):
+        lines = ["{: <32}{: >8}{: >7}{: >10}{: >10}{: >10}{: >9}\n".format("name", "calls", "errors", "mean ms", "p50 ms", "p99 ms", "bytes")]
+        for (name, timing) in sorted(self._timings.items(), key=lambda item: -item[1].count):
+            if timing.count == 0:
+                continue
+            size = self._sizes.get(name)
+            lines.append("{: <32}{: >8}{: >7}{: >10.3f}{: >10.3f}{: >10.3f}{: >9}\n".format(name, timing.count, self._errors.get(name, 0), timing.mean() * 1000, timing.quantile(0.5) * 1000, timing.quantile(0.99) * 1000, "{:.0f}".format(size.mean()) if size else "-"))
+        if len(lines) == 1:
+            return ["Nothing recorded yet."]
+        return lines
+
+    # the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        lines += self._histogram_lines("betting_bot_call_seconds", "Time spent handling a call.", self._timings)
+        lines.append("# HELP betting_bot_errors_total Calls that raised an error.")
+        lines.append("# TYPE betting_bot_errors_total counter")
+        for (name, count) in sorted(self._errors.items()):
+            lines.append("betting_bot_errors_total{name=\"" + name + "\"} " + str(count))
+        lines += self._histogram_lines("betting_bot_reply_bytes", "Size of the messages sent in reply.", self._sizes)
+        return "\n".join(lines) + "\n"
+
+    def _histogram_lines(self, metric, description, histograms):
+        lines = ["# HELP " + metric + " " + description, "# TYPE " + metric + " histogram"]
+        for (name, histogram) in sorted(histograms.items()):
+            label = "name=\"" + name + "\""
+            cumulative = 0
+            for (bound, count) in zip(histogram.bounds + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(metric + "_bucket{" + label + ",le=\"" + str(bound) + "\"} " + str(cumulative))
+            lines.append(metric + "_sum{" + label + "} " + repr(histogram.total))
+            lines.append(metric + "_count{" + label + "} " + str(histogram.count))
+        return lines
+
+    # replaced atomically so the collector never reads half a file
+    def export(self, filename):
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'w', encoding='utf-8') as handle:
+            handle.write(self.prometheus())
+        os.replace(temp_filename, filename)
+
+METRICS = Metrics()
+
+# times every call of a function, counting the calls that raise. A generator is
+# timed over its whole iteration but only for the time spent inside it.
+def timed(name):
+    def decorate(function):
+        histogram = METRICS.timing(name)
+        if inspect.isgeneratorfunction(function):
+            @wraps(function)
+            def timed_generator(*args, **kwargs):
+                elapsed = 0
+                iterator = function(*args, **kwargs)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    except Exception:
+                        METRICS.error(name)
+                        raise
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield item
+                histogram.observe(elapsed)
+            return timed_generator
+
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                METRICS.error(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed_function
+    return decorate
+
+# writes the metrics file every interval seconds while the bot runs
+# the file one of several processes exports to, e.g. betting_bot.prom -> betting_bot.shard1.prom
+def process_filename(filename, name):
+    if not filename:
+        return filename
+    (root, extension) = os.path.splitext(filename)
+    return root + "." + name + extension
+
+class Exporter():
+    def __init__(self, metrics, filename, interval=60):
+        self._metrics = metrics
+        self._filename = filename
+        self._interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None and self._filename:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._metrics.export(self._filename)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                self._metrics.export(self._filename)
+            except Exception:
+                traceback.print_exc()
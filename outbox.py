@@ -0,0 +1,58 @@
+# Imports
+import asyncio
+import time
+
+from metrics import METRICS
+from render import chunk, MESSAGE_LIMIT
+
+################################################
+# Outbox
+#
+# Short confirmations (bets, money, dailies) are collected per channel and
+# posted together. A channel has at most one send in flight: replies queued
+# while it is out, or within `window` seconds of the first one, go out in the
+# next message, so a rush of bets turns into a few messages instead of one per
+# bet and discord.py's rate limits are never hit by this channel's replies.
+# A reply waits at most the window plus one send per message ahead of it.
+
+class Outbox():
+    def __init__(self, window=0.25, format=None):
+        self._window = window
+        self._format = format or (lambda text: text)
+        self._limit = MESSAGE_LIMIT - len(self._format(""))
+        self._pending = {} # channel id -> [(text, future, time queued)]
+        self._senders = {} # channel id -> task sending that channel's replies
+
+    # queues a reply for the channel, returns once the message holding it has been sent
+    async def send(self, channel, text):
+        future = asyncio.get_event_loop().create_future()
+        self._pending.setdefault(channel.id, []).append((text, future, time.perf_counter()))
+        if not channel.id in self._senders:
+            self._senders[channel.id] = asyncio.ensure_future(self._drain(channel))
+        await future
+
+    async def _drain(self, channel):
+        try:
+            while self._pending.get(channel.id):
+                await asyncio.sleep(self._window)
+                replies = self._pending.pop(channel.id)
+                sent = time.perf_counter()
+                for (_text, _future, queued) in replies:
+                    METRICS.observe("outbox.wait", sent - queued)
+                error = None
+                try:
+                    for message in chunk([text + "\n" for (text, _future, _queued) in replies], self._limit):
+                        message = self._format(message)
+                        METRICS.size("outbox.message", len(message.encode('utf-8')))
+                        await channel.send(message)
+                except Exception as failure:
+                    error = failure
+                for (_text, future, _queued) in replies:
+                    if future.cancelled():
+                        continue
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(None)
+        finally:
+            self._senders.pop(channel.id, None)
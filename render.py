@@ -0,0 +1,97 @@
+# Imports
+from collections import OrderedDict
+
+################################################
+# Rendering helpers
+#
+# Listings are produced as generators of lines so that only the rows on the
+# requested page are formatted, and are then grouped into as few Discord
+# messages as fit under the message length limit.
+
+MESSAGE_LIMIT = 2000
+
+# groups lines into chunks of at most limit characters, splitting any single line longer than that
+def chunk(lines, limit=MESSAGE_LIMIT):
+    parts = []
+    size = 0
+    for line in lines:
+        while len(line) > limit:
+            if parts:
+                yield "".join(parts)
+                parts = []
+                size = 0
+            yield line[:limit]
+            line = line[limit:]
+        if size + len(line) > limit:
+            yield "".join(parts)
+            parts = []
+            size = 0
+        parts.append(line)
+        size += len(line)
+    if parts:
+        yield "".join(parts)
+
+# the slice [start, end) of a 1-based page and the number of pages, the slice
+# is empty for a page before the first as well as after the last
+def page_bounds(total, page, per_page):
+    pages = max(1, -(-total // per_page))
+    if page < 1:
+        return (0, 0, pages)
+    start = (page - 1) * per_page
+    return (start, min(start + per_page, total), pages)
+
+def page_header(page, pages):
+    if pages == 1:
+        return ""
+    return "Page " + str(page) + "/" + str(pages) + "\n"
+
+# Rendered text of events, bet listings and leaderboards. Entries are dropped by
+# the changes that affect them, and the least recently used are evicted once
+# there are more than capacity of them (leaderboards are few and never evicted).
+class RenderCache():
+    def __init__(self, capacity=256):
+        self._capacity = capacity
+        self._entries = OrderedDict() # key -> (lines, ids of the users they show)
+        self._boards = {} # leaderboard kind -> {count: text}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, lines, user_ids=()):
+        self._entries[key] = (lines, frozenset(user_ids))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+        return lines
+
+    def drop(self, key):
+        self._entries.pop(key, None)
+
+    # drops every entry showing the user (e.g. after a rename)
+    def drop_user(self, user_id):
+        for key in [key for (key, entry) in self._entries.items() if user_id in entry[1]]:
+            del self._entries[key]
+
+    def board(self, kind, count):
+        return self._boards.get(kind, {}).get(count)
+
+    def put_board(self, kind, count, text):
+        self._boards.setdefault(kind, {})[count] = text
+        return text
+
+    def has_boards(self, kind):
+        return len(self._boards.get(kind, {})) > 0
+
+    # drops the leaderboards long enough to include the given rank
+    def drop_boards(self, kind, rank):
+        boards = self._boards.get(kind, {})
+        for count in [count for count in boards if count >= rank]:
+            del boards[count]
+
+    def clear(self):
+        self._entries.clear()
+        self._boards.clear()
@@ -0,0 +1,67 @@
+# Imports
+import asyncio
+import heapq
+import time
+import traceback
+
+################################################
+# Scheduled locks
+#
+# One task and one heap of (deadline, key) for every scheduled lock in every
+# guild, so thousands of deadlines cost a heap entry each rather than a sleeping
+# task. The task sleeps until the earliest deadline (or until an earlier one is
+# added) and then hands every due key to `fire`. Deadlines are wall clock times
+# kept in each BettingSystem, so they survive restarts and are added back here
+# when a guild is loaded; an entry whose deadline was changed or dropped since
+# is skipped by `fire`.
+#
+# Bets check the deadline themselves, so a busy event loop can delay the
+# announcement but never lets a late bet in.
+
+MAX_SLEEP = 60 # wake up regularly in case the wall clock jumped
+
+class Scheduler():
+    def __init__(self, fire):
+        self._fire = fire # async function taking a key
+        self._heap = []
+        self._wake = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def add(self, key, at):
+        heapq.heappush(self._heap, (at, key))
+        if self._heap[0] == (at, key):
+            self._poke()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _poke(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+            if due:
+                for result in await asyncio.gather(*[self._fire(key) for key in due], return_exceptions=True):
+                    if isinstance(result, Exception):
+                        traceback.print_exception(type(result), result, result.__traceback__)
+                continue
+            delay = MAX_SLEEP
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - now)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,244 @@
+# Imports
+import asyncio
+import builtins
+import itertools
+import json
+import os
+import signal
+import struct
+import time
+import traceback
+
+from settings import STATE_SOCKET, METRICS_FILENAME, METRICS_INTERVAL
+from states import LocalStates, Member
+from metrics import METRICS, Exporter, process_filename
+
+################################################
+# State service
+#
+# Runs the betting state of every guild (a LocalStates) in a process of its own,
+# behind a Unix socket, for one or more bot processes (shards) to share. The bots
+# then only parse commands, format replies and talk to Discord, while every
+# change to a guild still goes through that guild's single writer here.
+#
+# Each message is a 4 byte big-endian length followed by that many bytes of
+# compact JSON. Requests are [id, method, args], a method of LocalStates
+# (query, update, save, load) or metrics, answered by [id, "ok", result] or
+# [id, "error", [exception type, message]]. Requests are handled as they
+# arrive, so a slow one (a load) doesn't hold up the rest, and a connection can
+# have any number of them waiting. Scheduled lock announcements are pushed to
+# every bot as [0, "announce", [channel id, text]] and each posts the ones for
+# channels it can see.
+
+DEFAULT_SOCKET = "betting_state.sock"
+HEADER = struct.Struct(">I")
+MAX_MESSAGE = 64 * 1024 * 1024
+CONNECT_TIMEOUT = 30 # seconds a bot keeps trying to reach a service that is still starting
+
+def encode(message):
+    body = json.dumps(message, separators=(",", ":")).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+async def read_message(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ValueError("message of " + str(length) + " bytes is too long")
+    return json.loads(await reader.readexactly(length))
+
+# members are the only arguments that aren't plain JSON
+def encode_argument(value):
+    if isinstance(value, Member):
+        return {"member": [value.id, value.display_name]}
+    return value
+
+def decode_argument(value):
+    if isinstance(value, dict) and "member" in value:
+        return Member(*value["member"])
+    return value
+
+class ServiceError(Exception):
+    pass
+
+# errors come back as the builtin exception they were, when they were one
+def remote_error(name, message):
+    error = getattr(builtins, name, None)
+    if not (isinstance(error, type) and issubclass(error, Exception)):
+        error = ServiceError
+    return error(message)
+
+class StateService():
+    def __init__(self, path):
+        self._path = path
+        self._states = LocalStates(self._announce)
+        self._methods = {"query": self._states.query, "update": self._states.update, "save": self._states.save, "load": self._states.load, "metrics": self._metrics}
+        self._server = None
+        self._writers = set() # one per connected bot
+
+    async def start(self):
+        if os.path.exists(self._path):
+            os.remove(self._path) # left behind by a service that didn't shut down cleanly
+        self._states.start()
+        self._server = await asyncio.start_unix_server(self._serve, path=self._path)
+
+    # stops taking requests and saves everything
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+        await self._states.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                asyncio.ensure_future(self._handle(writer, message))
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _handle(self, writer, message):
+        (request_id, method, args) = message
+        start = time.perf_counter()
+        try:
+            if not method in self._methods or (method in ("query", "update") and str(args[1]).startswith("_")):
+                raise ValueError("unknown method " + str(method))
+            reply = [request_id, "ok", await self._methods[method](*[decode_argument(arg) for arg in args])]
+        except Exception as error:
+            if not isinstance(error, (ValueError, KeyError, IndexError, TypeError)):
+                traceback.print_exc()
+            reply = [request_id, "error", [type(error).__name__, str(error)]]
+        METRICS.observe("service." + str(method), time.perf_counter() - start)
+        if not writer.is_closing():
+            writer.write(encode(reply))
+            await writer.drain()
+
+    async def _metrics(self):
+        return METRICS.summary()
+
+    async def _announce(self, channel_id, text):
+        for writer in list(self._writers):
+            if not writer.is_closing():
+                writer.write(encode([0, "announce", [channel_id, text]]))
+
+# a bot's side of the service, with the same methods as LocalStates
+class StateClient():
+    def __init__(self, path, announce):
+        self._path = path
+        self._announce = announce # async function taking a channel id and text
+        self._ids = itertools.count(1)
+        self._pending = {} # request id -> future for its reply
+        self._writer = None
+        self._reader_task = None
+        self._connecting = None
+
+    def start(self):
+        pass
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def query(self, guild_id, name, *args):
+        return await self._call("query", guild_id, name, *args)
+
+    async def update(self, guild_id, name, *args):
+        return await self._call("update", guild_id, name, *args)
+
+    async def save(self, guild_id):
+        return await self._call("save", guild_id)
+
+    async def load(self, guild_id, filename, legacy=False):
+        return await self._call("load", guild_id, os.path.abspath(filename), legacy)
+
+    async def metrics(self):
+        return await self._call("metrics")
+
+    async def _call(self, method, *args):
+        writer = await self._connection()
+        request_id = next(self._ids)
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        writer.write(encode([request_id, method, [encode_argument(arg) for arg in args]]))
+        await writer.drain()
+        return await future
+
+    # connects on first use, waiting for a service that is still starting
+    async def _connection(self):
+        if self._writer is not None:
+            return self._writer
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            return await asyncio.shield(self._connecting)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    async def _connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                (reader, writer) = await asyncio.open_unix_connection(self._path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+        self._writer = writer
+        self._reader_task = asyncio.ensure_future(self._read(reader))
+        return writer
+
+    async def _read(self, reader):
+        try:
+            while True:
+                (request_id, status, result) = await read_message(reader)
+                if status == "announce":
+                    asyncio.ensure_future(self._announce(*result))
+                    continue
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if status == "ok":
+                    future.set_result(result)
+                else:
+                    future.set_exception(remote_error(*result))
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            print("Lost the state service: " + repr(error))
+        finally:
+            # the next call connects again, the ones waiting now have failed
+            self._writer = None
+            self._reader_task = None
+            pending = self._pending
+            self._pending = {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ServiceError("lost the state service"))
+
+async def serve(path):
+    service = StateService(path)
+    await service.start()
+    exporter = Exporter(METRICS, process_filename(METRICS_FILENAME, "state"), METRICS_INTERVAL)
+    exporter.start()
+    print("State service listening on " + path)
+    stopped = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    await stopped.wait()
+    await service.close()
+    exporter.stop()
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(serve(STATE_SOCKET or DEFAULT_SOCKET))
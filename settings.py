@@ -0,0 +1,63 @@
+# Imports
+import configparser
+import os
+
+################################################
+# Setup
+TOKEN = ""
+PREFIX = ""
+TIMEZONE = "Australia/Sydney"
+DAILY = 100
+STARTING_MONEY = 10000
+
+CONFIG = 'config.ini'
+parser = configparser.ConfigParser()
+try:
+    parser.read(CONFIG)
+    TOKEN = str(parser['DISCORD']['token'])
+    PREFIX = str(parser['DISCORD']['prefix'])
+    TIMEZONE = str(parser['DISCORD']['timezone'])
+    DAILY = int(parser['DISCORD']['daily'])
+    STARTING_MONEY = int(parser['DISCORD']['starting_money'])
+except:
+    TOKEN = str(os.environ.get('token', TOKEN))
+    PREFIX = str(os.environ.get('prefix', PREFIX))
+    TIMEZONE = str(os.environ.get('timezone', TIMEZONE))
+    DAILY = int(os.environ.get('daily', DAILY))
+    STARTING_MONEY = int(os.environ.get('starting_money', STARTING_MONEY))
+
+
+# optional settings fall back to their defaults when missing from both config.ini and the environment
+def setting(name, default):
+    try:
+        return type(default)(parser['DISCORD'][name])
+    except KeyError:
+        return type(default)(os.environ.get(name, default))
+
+SNAPSHOT_FILENAME = setting('snapshot_file', 'betting_system.pickle')
+JOURNAL_FILENAME = setting('journal_file', 'betting_system.journal')
+SNAPSHOT_EVERY = setting('snapshot_every', 500)
+STORAGE = setting('storage', 'journal') # "journal" or "sqlite"
+DATABASE_FILENAME = setting('database_file', 'betting_system.db')
+LEADERBOARD_SIZE = setting('leaderboard_size', 25)
+EVENTS_PER_PAGE = setting('events_per_page', 5)
+BETS_PER_PAGE = setting('bets_per_page', 20)
+RENDER_CACHE_SIZE = setting('render_cache_size', 256)
+AUTOSAVE_INTERVAL = setting('autosave_interval', 300)
+METRICS_FILENAME = setting('metrics_file', 'betting_bot.prom') # empty to turn the export off
+METRICS_INTERVAL = setting('metrics_interval', 60)
+REPLY_WINDOW = setting('reply_window', 0.25) # seconds bet, money and daily confirmations are collected for
+GUILD_DIRECTORY = setting('guild_dir', 'guilds') # each guild's files go in a directory named after it in here
+GUILD_BUDGET = setting('guild_budget', 50) # guilds kept in memory before idle ones are saved and dropped
+GUILD_IDLE = setting('guild_idle', 600) # seconds without commands before a guild may be dropped
+LEGACY_GUILD = setting('legacy_guild', 0) # guild that takes over files from before per-guild storage, 0 for the first one loaded
+POOL_ODDS_WEIGHT = setting('pool_odds_weight', 0.0) # money the set odds of a new event count as once odds follow the pool, 0 keeps odds fixed
+BACKUP_FILENAME = setting('backup_file', 'betting_system.jsonl.gz') # name of the file save uploads, gzipped when it ends in .gz
+HISTORY_KEEP_EVENTS = setting('history_keep_events', 0) # past events kept in full, older ones are rolled into monthly totals, 0 keeps them all
+HISTORY_KEEP_DAYS = setting('history_keep_days', 0) # days past events are kept in full, 0 keeps them regardless of age
+STATE_SOCKET = setting('state_socket', '') # Unix socket of a separate state service (service.py), empty keeps the betting state in the bot's process
+SHARD_COUNT = setting('shard_count', 1) # bot processes splitting the guilds between them, each needs state_socket
+SHARD_ID = setting('shard_id', 0) # which of them this one is, from 0
+WORKERS = setting('workers', 2) # bot processes cluster.py starts next to the state service
+BATCH_SIZE = setting('batch_size', 100) # events one admin command can create, lock, unlock or resolve
+AUTO_DAILY = setting('auto_daily', 0) # 1 gives every user their daily reward as each day starts (in timezone) instead of waiting for ~daily
@@ -0,0 +1,104 @@
+# Imports
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+################################################
+# Bulk settlement
+#
+# Resolves many events in one go, e.g. every match of a tournament. The money
+# and PnL each bet adds to its user are worked out for all bets at once over
+# columns of amounts, odds and outcomes, then added to each user's totals in
+# bet order, so the results are the same to the last bit as resolving the
+# events one after another with BetEvent.payout. NumPy is used when it is
+# installed, the same sums are done in plain Python when it isn't.
+
+# settles (event, winning side) pairs in order, returns every user who had a bet on them
+def settle(results):
+    bets = []
+    for (event, side) in results:
+        if event._resolved or any(bet._resolution != "n/a" for bet in event._bets):
+            raise Exception("oops - double resolve bet")
+    for (event, side) in results:
+        event._odds = event.odds(True)
+        event._pool_weight = 0
+        event._resolved = True
+        event._locked = True
+        event._result = side
+        bets.extend(event._bets)
+    if numpy is not None:
+        (money, pnl, won) = _deltas_numpy(results)
+    else:
+        (money, pnl, won) = _deltas(results)
+
+    users = {} # user id -> user, in the order they were first seen
+    for bet in bets:
+        users.setdefault(bet._user._id, bet._user)
+    _apply(users, bets, money, pnl, won)
+
+    for (i, bet) in enumerate(bets):
+        bet._resolution = "won" if won[i] else "lost"
+        bet._user._count_result(won[i], bet._amount)
+    for (event, side) in results:
+        bets_by_user = event._bets_by_user
+        settled = event._settle()
+        for user_bets in bets_by_user.values():
+            user_bets[0].user().archive_bet(event._id, [settled[bet] for bet in user_bets])
+    return list(users.values())
+
+# the money and PnL every bet adds, as BetEvent.payout works them out: a win
+# adds amount * odds to money and amount * (odds - 1) to PnL, a loss takes the
+# amount off PnL
+def _deltas(results):
+    (money, pnl, won) = ([], [], [])
+    for (event, side) in results:
+        odds = {True: event.odds(True), False: event.odds(False)}
+        for bet in event._bets:
+            if bet._side == side:
+                money.append(bet._amount * odds[side])
+                pnl.append(bet._amount * (odds[side] - 1))
+                won.append(True)
+            else:
+                money.append(0)
+                pnl.append(-bet._amount)
+                won.append(False)
+    return (money, pnl, won)
+
+def _deltas_numpy(results):
+    (amounts, odds, won) = ([], [], [])
+    for (event, side) in results:
+        count = len(event._bets)
+        amounts.append(numpy.fromiter((bet._amount for bet in event._bets), dtype=numpy.float64, count=count))
+        sides = numpy.fromiter((bet._side for bet in event._bets), dtype=bool, count=count)
+        odds.append(numpy.where(sides, event.odds(True), event.odds(False)))
+        won.append(sides == side)
+    if not amounts:
+        return ([], [], [])
+    amounts = numpy.concatenate(amounts)
+    odds = numpy.concatenate(odds)
+    won = numpy.concatenate(won)
+    money = numpy.where(won, amounts * odds, 0.0)
+    pnl = numpy.where(won, amounts * (odds - 1), -amounts)
+    return (money, pnl, won.tolist())
+
+# adds the deltas to the users one bet at a time, in the order payout would
+def _apply(users, bets, money, pnl, won):
+    if numpy is None or len(bets) == 0:
+        for (i, bet) in enumerate(bets):
+            if won[i]:
+                bet._user._money += money[i]
+            bet._user._total_pnl += pnl[i]
+        return
+    index = {user_id: i for (i, user_id) in enumerate(users)}
+    owners = numpy.fromiter((index[bet._user._id] for bet in bets), dtype=numpy.intp, count=len(bets))
+    totals = numpy.array([user._money for user in users.values()], dtype=numpy.float64)
+    pnls = numpy.array([user._total_pnl for user in users.values()], dtype=numpy.float64)
+    # add.at is unbuffered, so each user's deltas are added one after another in bet order
+    numpy.add.at(totals, owners, money)
+    numpy.add.at(pnls, owners, pnl)
+    winners = set(owners[numpy.asarray(won, dtype=bool)].tolist())
+    for (i, user) in enumerate(users.values()):
+        if i in winners:
+            user._money = totals[i].item()
+        user._total_pnl = pnls[i].item()
@@ -0,0 +1,132 @@
+# Imports
+import asyncio
+from collections import namedtuple
+import inspect
+import os
+import time
+
+from settings import SNAPSHOT_FILENAME, JOURNAL_FILENAME, SNAPSHOT_EVERY, STORAGE, DATABASE_FILENAME, AUTOSAVE_INTERVAL, GUILD_DIRECTORY, GUILD_BUDGET, GUILD_IDLE, LEGACY_GUILD, BACKUP_FILENAME, AUTO_DAILY
+from journal import JournalStore
+from storage import SqliteStore
+from guilds import GuildRegistry
+from scheduler import Scheduler
+from days import CLOCK
+from backup import read_backup, read_pickle
+
+################################################
+# State host
+#
+# Everything the commands do to betting state goes through one of these, by
+# guild id and BettingSystem method name: `query` runs a read-only method right
+# away and `update` queues a change on the guild's writer. LocalStates keeps the
+# guilds in this process; service.py's StateClient has the same methods and
+# forwards them to a LocalStates in a separate state service, so the bot's
+# commands don't change with the deployment.
+#
+# Arguments and results stay plain (numbers, strings, lists of strings) so they
+# can cross a socket, and users are passed as Members rather than discord
+# objects.
+
+Member = namedtuple('Member', ['id', 'display_name'])
+ROLLOVER = (0, "rollover") # scheduler key for the start of the next day, locks are keyed (guild id, event id)
+
+def member(user):
+    return Member(user.id, user.display_name)
+
+def open_store(directory):
+    if STORAGE == "sqlite":
+        return SqliteStore(os.path.join(directory, os.path.basename(DATABASE_FILENAME)), group_commit=True)
+    return JournalStore(os.path.join(directory, os.path.basename(SNAPSHOT_FILENAME)), os.path.join(directory, os.path.basename(JOURNAL_FILENAME)), SNAPSHOT_EVERY, group_commit=True)
+
+class LocalStates():
+    def __init__(self, announce):
+        self._announce = announce # async function taking a channel id and text, for scheduled locks
+        self._registry = GuildRegistry(GUILD_DIRECTORY, open_store, [SNAPSHOT_FILENAME, JOURNAL_FILENAME, DATABASE_FILENAME, os.path.splitext(SNAPSHOT_FILENAME)[0] + ".history"], LEGACY_GUILD, GUILD_BUDGET, GUILD_IDLE, AUTOSAVE_INTERVAL, self._loaded)
+        self._scheduler = Scheduler(self._fire)
+        self._rolling = False # whether the next rollover is on the scheduler
+
+    # the bot starts this on every (re)connect, the rollover reschedules itself after the first
+    def start(self):
+        self._scheduler.start()
+        if AUTO_DAILY and not self._rolling:
+            self._rolling = True
+            self._scheduler.add(ROLLOVER, CLOCK.tomorrow_at())
+
+    # saves any unsaved changes of every loaded guild
+    async def close(self):
+        self._scheduler.stop()
+        await self._registry.close()
+
+    # the result of a read-only method of a guild's system, with anything it yields
+    # (or a cached tuple of lines) listed, the same as it comes back from the service
+    async def query(self, guild_id, name, *args):
+        guild = await self._registry.get(guild_id)
+        result = getattr(guild.system, name)(*args)
+        if inspect.isgenerator(result) or isinstance(result, tuple):
+            return list(result)
+        return result
+
+    # applies a method of a guild's system as a change, returns its reply once the change is saved
+    async def update(self, guild_id, name, *args):
+        guild = await self._registry.get(guild_id)
+        if name == "user_bet":
+            await self._lock_if_due(guild, args[0])
+        output = await guild.change(lambda: getattr(guild.system, name)(*args))
+        if name == "schedule_lock":
+            scheduled = guild.system.scheduled_lock(args[0])
+            if scheduled is not None:
+                self._scheduler.add((guild.id, args[0]), scheduled[0])
+        return output
+
+    # saves a guild and writes a backup of it, returns the backup's full path
+    async def save(self, guild_id):
+        guild = await self._registry.get(guild_id)
+        await guild.autosave.save()
+        return os.path.abspath(await guild.store.backup(os.path.join(guild.directory, os.path.basename(BACKUP_FILENAME))))
+
+    # replaces a guild's system with the one in a backup, or in a pickle from an older version
+    async def load(self, guild_id, filename, legacy=False):
+        guild = await self._registry.get(guild_id)
+        # the new system is built on its own, away from the one in use
+        system = await asyncio.get_event_loop().run_in_executor(None, read_pickle if legacy else read_backup, filename)
+        guild.system = await guild.change(lambda: guild.store.replace(system))
+        self._loaded(guild)
+
+    # the bot's own metrics already cover this process
+    async def metrics(self):
+        return []
+
+    # deadlines of a freshly loaded guild go back on the scheduler, and with
+    # auto_daily its users who haven't had today's reward get it, once however
+    # many days the guild spent unloaded
+    def _loaded(self, guild):
+        for (event_id, (at, _channel)) in guild.system.lock_schedule().items():
+            self._scheduler.add((guild.id, event_id), at)
+        if AUTO_DAILY:
+            asyncio.ensure_future(guild.change(lambda: guild.system.credit_dailies()))
+
+    async def _fire(self, key):
+        if key == ROLLOVER:
+            await self._rollover()
+        else:
+            await self._lock_on_time(key)
+
+    # a new day has started, every loaded guild's users get their daily reward
+    async def _rollover(self):
+        self._scheduler.add(ROLLOVER, CLOCK.tomorrow_at())
+        await asyncio.gather(*[guild.change(lambda guild=guild: guild.system.credit_dailies()) for guild in self._registry.loaded()])
+
+    # locks an event whose scheduled time has come and announces it where the lock was scheduled
+    async def _lock_on_time(self, key):
+        (guild_id, event_id) = key
+        await self._lock_if_due(await self._registry.get(guild_id), event_id)
+
+    # a bet can get to an event after its deadline but before the scheduler does,
+    # it is locked and announced first the same way
+    async def _lock_if_due(self, guild, event_id):
+        scheduled = guild.system.scheduled_lock(event_id)
+        if scheduled is None or scheduled[0] > time.time():
+            return
+        output = await guild.change(lambda: guild.system.lock_if_due(event_id))
+        if output is not None and scheduled[1] is not None:
+            await self._announce(scheduled[1], output)
@@ -0,0 +1,370 @@
+# Imports
+import json
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime
+
+from betting import BettingSystem, User, BetEvent, Bet, SettledBet, MonthSummary
+from backup import write_backup_in_background
+
+################################################
+# SQLite storage
+#
+# Keeps users, events and bets in indexed tables. Users and ongoing events are
+# loaded into memory as usual, while past events and each user's settled bets
+# are read from disk when something asks for them, so resident memory does not
+# grow with history. Changes are written through as BettingSystem logs them,
+# and with group_commit they are only committed when commit() is called.
+# Monthly totals of events rolled up out of history are kept per user in the
+# summaries table and the number of events they cover in meta.
+#
+# Past events are numbered in the order they were resolved (resolved_seq), which
+# is the order history is listed and rolled up in, the same as the other stores.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT NOT NULL, money REAL NOT NULL, pnl REAL NOT NULL, daily TEXT NOT NULL, won INTEGER NOT NULL DEFAULT 0, lost INTEGER NOT NULL DEFAULT 0, staked REAL NOT NULL DEFAULT 0, streak INTEGER NOT NULL DEFAULT 0, best_streak INTEGER NOT NULL DEFAULT 0, worst_streak INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, description TEXT NOT NULL, odds REAL NOT NULL, locked INTEGER NOT NULL, resolved INTEGER NOT NULL, result TEXT NOT NULL, pool_weight REAL NOT NULL DEFAULT 0, resolved_at REAL, resolved_seq INTEGER);
+CREATE TABLE IF NOT EXISTS bets (id INTEGER PRIMARY KEY AUTOINCREMENT, event INTEGER NOT NULL, user INTEGER NOT NULL, amount REAL NOT NULL, side INTEGER NOT NULL, resolution TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS lock_times (event INTEGER PRIMARY KEY, at REAL NOT NULL, channel INTEGER);
+CREATE TABLE IF NOT EXISTS summaries (user INTEGER NOT NULL, month TEXT NOT NULL, won INTEGER NOT NULL, lost INTEGER NOT NULL, staked REAL NOT NULL, pnl REAL NOT NULL, PRIMARY KEY (user, month));
+CREATE INDEX IF NOT EXISTS events_by_state ON events (resolved, id);
+CREATE INDEX IF NOT EXISTS bets_by_event ON bets (event, user);
+CREATE INDEX IF NOT EXISTS bets_by_user ON bets (user, resolution, id);
+"""
+
+class SqliteStore():
+    def __init__(self, filename, cached_events=64, group_commit=False):
+        self._filename = filename
+        self._db = None
+        self._system = None
+        self._past_events = None
+        self._cached_events = cached_events
+        self._group_commit = group_commit
+
+    def load(self):
+        self._db = sqlite3.connect(self._filename)
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        system = BettingSystem()
+        system._eventIds = self._meta("event_ids", 0)
+        system.MAX_BET = self._meta("max_bet", system.MAX_BET)
+        for (user_id, name, money, pnl, daily, won, lost, staked, streak, best_streak, worst_streak) in self._db.execute("SELECT id, name, money, pnl, daily, won, lost, staked, streak, best_streak, worst_streak FROM users"):
+            user = User(name, user_id)
+            user._money = money
+            user._total_pnl = pnl
+            user._daily = datetime.fromisoformat(daily)
+            (user._won, user._lost, user._staked, user._streak, user._best_streak, user._worst_streak) = (won, lost, staked, streak, best_streak, worst_streak)
+            user._past_bets = PastBets(self, user_id)
+            system._users[user_id] = user
+        for (user_id, month, won, lost, staked, pnl) in self._db.execute("SELECT user, month, won, lost, staked, pnl FROM summaries"):
+            system._users[user_id]._monthly[month] = MonthSummary(won, lost, staked, pnl)
+        system._rolled_up = json.loads(self._meta("rolled_up", "{}"))
+        for row in self._db.execute("SELECT id, description, odds, locked, resolved, result, pool_weight, resolved_at FROM events WHERE resolved = 0 ORDER BY id"):
+            event = self._build_event(row, system._users)
+            for bet in event._bets:
+                bet.user()._track_bet(bet)
+                bet.user()._ongoing += bet.amount()
+            system._curr_events[event._id] = event
+        for (event_id, at, channel) in self._db.execute("SELECT event, at, channel FROM lock_times"):
+            system._lock_times[event_id] = (at, channel)
+        system._past_events = PastEvents(self, self._cached_events)
+        system._rebuild_indexes()
+        print("Successfully loaded " + self._filename)
+        self.attach(system)
+        return system
+
+    def attach(self, system):
+        self._system = system
+        self._past_events = system._past_events
+        system._store = self
+
+    # imports a whole state (e.g. an uploaded pickle), replacing everything on disk
+    def replace(self, system):
+        with self._db:
+            for table in ["meta", "users", "events", "bets", "lock_times", "summaries"]:
+                self._db.execute("DELETE FROM " + table)
+            self._set_meta("event_ids", system._eventIds)
+            self._set_meta("max_bet", system.MAX_BET)
+            self._set_meta("rolled_up", json.dumps(system._rolled_up))
+            for user in system._users.values():
+                self._write_user(user)
+                self._write_summaries(user)
+            for event in list(system._curr_events.values()) + list(system._past_events.values()):
+                self._write_event(event)
+                for bet in event._bets:
+                    self._db.execute("INSERT INTO bets (event, user, amount, side, resolution) VALUES (?, ?, ?, ?, ?)", (event._id, bet.user()._id, bet.amount(), bet.side(), bet._resolution))
+            for (event_id, (at, channel)) in system._lock_times.items():
+                self._db.execute("INSERT INTO lock_times (event, at, channel) VALUES (?, ?, ?)", (event_id, at, channel))
+        self._db.close()
+        return self.load()
+
+    def record(self, op, fields):
+        if self._group_commit:
+            self._write(op, fields)
+        else:
+            with self._db:
+                self._write(op, fields)
+
+    # sqlite connections stay on the thread that opened them, so this commits in place
+    async def commit(self):
+        self._db.commit()
+
+    # writes a backup of the state as it is now, returns the backup's file. The child
+    # writing it reads history through a connection of its own, so what is written so far is committed first
+    async def backup(self, filename):
+        self._db.commit()
+        return await write_backup_in_background(self._system, filename, self._reopen)
+
+    def _reopen(self):
+        self._db = sqlite3.connect(self._filename)
+
+    def _write(self, op, fields):
+        system = self._system
+        if op == "user":
+            user = system._users[fields["user"]]
+            user._past_bets = PastBets(self, user._id)
+            self._write_user(user)
+        elif op == "rename":
+            self._db.execute("UPDATE users SET name = ? WHERE id = ?", (fields["name"], fields["user"]))
+        elif op == "event":
+            self._write_event(system._curr_events[fields["event"]])
+            self._set_meta("event_ids", system._eventIds)
+        elif op == "bet":
+            self._db.execute("INSERT INTO bets (event, user, amount, side, resolution) VALUES (?, ?, ?, ?, 'n/a')", (fields["event"], fields["user"], fields["amount"], fields["side"]))
+            self._write_user(system._users[fields["user"]])
+        elif op == "resolve":
+            event = self._past_events.settled(fields["event"])
+            self._write_event(event)
+            self._db.execute("UPDATE bets SET resolution = CASE WHEN side = ? THEN 'won' ELSE 'lost' END WHERE event = ?", (fields["side"], event._id))
+            for user in event.bettors():
+                self._write_user(user)
+            self._db.execute("DELETE FROM lock_times WHERE event = ?", (event._id,))
+        elif op == "cancel":
+            self._db.execute("DELETE FROM bets WHERE event = ? AND user = ?", (fields["event"], fields["user"]))
+            self._write_user(system._users[fields["user"]])
+        elif op == "daily":
+            self._write_user(system._users[fields["user"]])
+        elif op == "lock" or op == "unlock":
+            self._db.execute("UPDATE events SET locked = ? WHERE id = ?", (op == "lock", fields["event"]))
+            if op == "lock":
+                self._db.execute("DELETE FROM lock_times WHERE event = ?", (fields["event"],))
+        elif op == "lock_at":
+            self._db.execute("INSERT OR REPLACE INTO lock_times (event, at, channel) VALUES (?, ?, ?)", (fields["event"], fields["at"], fields["channel"]))
+        elif op == "max_bet":
+            self._set_meta("max_bet", fields["amount"])
+        elif op == "clear":
+            self._db.execute("DELETE FROM bets WHERE event IN (SELECT id FROM events WHERE resolved = 1)")
+            self._db.execute("DELETE FROM events WHERE resolved = 1")
+            self._db.execute("DELETE FROM summaries")
+            self._set_meta("rolled_up", "{}")
+        elif op == "compact":
+            users = set()
+            for event_id in fields["events"]:
+                users.update([row[0] for row in self._db.execute("SELECT DISTINCT user FROM bets WHERE event = ?", (event_id,))])
+            self._db.executemany("DELETE FROM bets WHERE event = ?", [(event_id,) for event_id in fields["events"]])
+            self._db.executemany("DELETE FROM events WHERE id = ?", [(event_id,) for event_id in fields["events"]])
+            for user_id in users:
+                self._write_summaries(system._users[user_id])
+            self._set_meta("rolled_up", json.dumps(system._rolled_up))
+        else:
+            raise ValueError("unknown record " + str(op))
+
+    # every change is committed to the database, snapshots are only taken when asked for
+    def dirty(self):
+        return False
+
+    def needs_snapshot(self):
+        return False
+
+    async def snapshot_in_background(self):
+        return self.snapshot()
+
+    # copies the live database into a standalone file, returns that file
+    def snapshot(self):
+        self._db.commit()
+        filename = self._filename + ".bak"
+        backup = sqlite3.connect(filename)
+        with backup:
+            self._db.backup(backup)
+        backup.close()
+        return filename
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def _meta(self, key, default):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    # columns added since the first version of the schema
+    def _migrate(self):
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(events)")]
+        if not "pool_weight" in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE events ADD COLUMN pool_weight REAL NOT NULL DEFAULT 0")
+        if not "resolved_at" in columns:
+            with self._db:
+                self._db.execute("ALTER TABLE events ADD COLUMN resolved_at REAL")
+        if not "resolved_seq" in columns:
+            # events resolved before resolution times were kept count as the oldest
+            with self._db:
+                self._db.execute("ALTER TABLE events ADD COLUMN resolved_seq INTEGER")
+                rows = self._db.execute("SELECT id FROM events WHERE resolved = 1 ORDER BY resolved_at IS NOT NULL, resolved_at, id").fetchall()
+                self._db.executemany("UPDATE events SET resolved_seq = ? WHERE id = ?", [(seq + 1, event_id) for (seq, (event_id,)) in enumerate(rows)])
+        self._db.execute("CREATE INDEX IF NOT EXISTS events_by_resolution ON events (resolved, resolved_seq)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(users)")]
+        if not "won" in columns:
+            with self._db:
+                for column in ["won INTEGER", "lost INTEGER", "staked REAL", "streak INTEGER", "best_streak INTEGER", "worst_streak INTEGER"]:
+                    self._db.execute("ALTER TABLE users ADD COLUMN " + column + " NOT NULL DEFAULT 0")
+                self._count_results()
+
+    # fills in each user's results from their settled bets, in the order they were placed
+    def _count_results(self):
+        for (user_id,) in self._db.execute("SELECT id FROM users").fetchall():
+            user = User("", user_id)
+            user._count_results(SettledBet(None, user, amount, None, resolution) for (amount, resolution) in self._db.execute("SELECT amount, resolution FROM bets WHERE user = ? AND resolution != 'n/a' ORDER BY id", (user_id,)))
+            self._db.execute("UPDATE users SET won = ?, lost = ?, staked = ?, streak = ?, best_streak = ?, worst_streak = ? WHERE id = ?", (user._won, user._lost, user._staked, user._streak, user._best_streak, user._worst_streak, user_id))
+
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _write_user(self, user):
+        self._db.execute("INSERT OR REPLACE INTO users (id, name, money, pnl, daily, won, lost, staked, streak, best_streak, worst_streak) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (user._id, user._name, user._money, user._total_pnl, user._daily.isoformat(), user._won, user._lost, user._staked, user._streak, user._best_streak, user._worst_streak))
+
+    def _write_summaries(self, user):
+        for (month, summary) in user._monthly.items():
+            self._db.execute("INSERT OR REPLACE INTO summaries (user, month, won, lost, staked, pnl) VALUES (?, ?, ?, ?, ?, ?)", (user._id, month, summary._won, summary._lost, summary._staked, summary._pnl))
+
+    # an event is numbered after every other past event when it is written resolved
+    def _write_event(self, event):
+        seq = None
+        if event._resolved:
+            seq = self._db.execute("SELECT COALESCE(MAX(resolved_seq), 0) + 1 FROM events").fetchone()[0]
+        self._db.execute("INSERT OR REPLACE INTO events (id, description, odds, locked, resolved, result, pool_weight, resolved_at, resolved_seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (event._id, event._description, event._odds, event._locked, event._resolved, str(event._result), event._pool_weight, event._resolved_at, seq))
+
+    def _build_event(self, row, users):
+        (event_id, description, odds, locked, resolved, result, pool_weight, resolved_at) = row
+        event = BetEvent(event_id, description, odds, pool_weight)
+        event._locked = bool(locked)
+        event._resolved = bool(resolved)
+        event._resolved_at = resolved_at
+        rows = self._db.execute("SELECT user, amount, side, resolution FROM bets WHERE event = ? ORDER BY id", (event_id,))
+        if resolved:
+            event._result = result == "True"
+            event._bets = tuple([SettledBet(event, users[user_id], amount, bool(side), resolution) for (user_id, amount, side, resolution) in rows])
+            event._bets_by_user = None
+            event._rebuild_pools()
+            return event
+        for (user_id, amount, side, resolution) in rows:
+            event._track_bet(Bet(event, users[user_id], amount, bool(side)))
+        return event
+
+    def _past_event(self, event_id):
+        row = self._db.execute("SELECT id, description, odds, locked, resolved, result, pool_weight, resolved_at FROM events WHERE id = ? AND resolved = 1", (event_id,)).fetchone()
+        if row is None:
+            raise KeyError(event_id)
+        return self._build_event(row, self._system._users)
+
+# BettingSystem._past_events read from the events table, keeping only the most recently used events in memory
+class PastEvents():
+    def __init__(self, store, capacity):
+        self._store = store
+        self._capacity = capacity
+        self._cache = OrderedDict()
+
+    def __getitem__(self, event_id):
+        if event_id in self._cache:
+            self._cache.move_to_end(event_id)
+            return self._cache[event_id]
+        return self._remember(self._store._past_event(event_id))
+
+    # an event that has just been resolved, its rows are written from this object
+    def __setitem__(self, event_id, event):
+        self._remember(event)
+
+    def settled(self, event_id):
+        return self._cache[event_id]
+
+    def __contains__(self, event_id):
+        return self._store._db.execute("SELECT 1 FROM events WHERE id = ? AND resolved = 1", (event_id,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self._store._db.execute("SELECT id FROM events WHERE resolved = 1 ORDER BY resolved_seq")])
+
+    def __reversed__(self):
+        return iter([row[0] for row in self._store._db.execute("SELECT id FROM events WHERE resolved = 1 ORDER BY resolved_seq DESC")])
+
+    def __len__(self):
+        return self._store._db.execute("SELECT COUNT(*) FROM events WHERE resolved = 1").fetchone()[0]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        for event_id in self:
+            yield self[event_id]
+
+    def items(self):
+        for event_id in self:
+            yield (event_id, self[event_id])
+
+    def clear(self):
+        self._cache.clear()
+
+    # the rows of rolled up events are deleted by the compact record
+    def compact(self, event_ids):
+        for event_id in event_ids:
+            self._cache.pop(event_id, None)
+
+    def _remember(self, event):
+        self._cache[event._id] = event
+        self._cache.move_to_end(event._id)
+        while len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+        return event
+
+# User._past_bets read from the bets table, settled bets are written by the resolve record
+class PastBets():
+    def __init__(self, store, user_id):
+        self._store = store
+        self._user_id = user_id
+
+    def append(self, bet):
+        pass
+
+    def extend(self, bets):
+        pass
+
+    def clear(self):
+        pass
+
+    def __iter__(self):
+        return self._bets("ASC")
+
+    def __reversed__(self):
+        return self._bets("DESC")
+
+    # in the order their events were resolved, like the other stores keep them. Only the
+    # event headers are needed to describe a bet, the rest of each event's bets are not loaded
+    def _bets(self, order):
+        user = self._store._system._users[self._user_id]
+        events = {}
+        rows = self._store._db.execute("SELECT b.amount, b.side, b.resolution, e.id, e.description, e.odds, e.locked, e.resolved, e.result FROM bets b JOIN events e ON e.id = b.event WHERE b.user = ? AND b.resolution != 'n/a' ORDER BY e.resolved_seq " + order + ", b.id " + order, (self._user_id,))
+        for (amount, side, resolution, event_id, description, odds, locked, resolved, result) in rows:
+            if not event_id in events:
+                event = BetEvent(event_id, description, odds)
+                event._locked = bool(locked)
+                event._resolved = bool(resolved)
+                event._result = result == "True"
+                events[event_id] = event
+            yield SettledBet(events[event_id], user, amount, bool(side), resolution)
+
+    def __len__(self):
+        return self._store._db.execute("SELECT COUNT(*) FROM bets WHERE user = ? AND resolution != 'n/a'", (self._user_id,)).fetchone()[0]
@@ -0,0 +1,77 @@
+# Imports
+import asyncio
+import time
+import traceback
+
+from metrics import METRICS
+
+################################################
+# Single writer
+#
+# Every change to the betting system is queued and applied by one task in the
+# order it was submitted, so changes never interleave whatever the commands
+# await around them. A change is applied as soon as the writer reaches it and
+# its reply is held back until the store has made it durable. The store commits
+# everything written while its previous commit was running in one go, so a
+# rush of bets costs a handful of fsyncs instead of one each, and later changes
+# are applied while earlier ones are still being committed.
+
+class Writer():
+    def __init__(self, store):
+        self._store = store
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._commits = set() # batches applied but not yet on disk
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    # queues a change (a function taking no arguments), returns its result once it is saved
+    async def submit(self, change):
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((change, future))
+        return await future
+
+    # lets everything already queued be applied and committed
+    async def stop(self):
+        if self._task is not None:
+            await self._queue.join()
+            await asyncio.gather(*self._commits)
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            applied = []
+            for (change, future) in batch:
+                try:
+                    applied.append((future, change(), None))
+                except Exception as error:
+                    applied.append((future, None, error))
+                self._queue.task_done()
+            commit = asyncio.ensure_future(self._commit(applied))
+            self._commits.add(commit)
+            commit.add_done_callback(self._commits.discard)
+
+    async def _commit(self, applied):
+        start = time.perf_counter()
+        failure = None
+        try:
+            await self._store.commit()
+        except Exception as error:
+            traceback.print_exc()
+            failure = error
+        METRICS.observe("store.commit", time.perf_counter() - start)
+        for (future, result, error) in applied:
+            if future.cancelled():
+                continue
+            if error is None:
+                error = failure
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)